@@ -13,9 +13,25 @@ parse the results, and and parse query parameters to create a QuerySet
 that filters your model.
 """
 
+# System imports
+#
+import re
+import math
+import time
+import datetime
+import decimal
+
 # Django imports
 #
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousOperation
+from django.utils.encoding import force_unicode
+
+# asutils imports
+#
+from asutils import querycache
 
 # Create some additional filter specs so that we can filter on more fields
 # then the filter spects in the admin app provide.
@@ -137,6 +153,407 @@ from django.db import models
 
 # FilterSpec.register(lambda f: isinstance(f, models.CharField), CharFilterSpec)
 
+# The process wide cache of compiled filter plans. The key is the tuple
+# (model, field names).
+#
+_filter_plans = {}
+
+# The process wide cache of filter spec instances. The key is the tuple
+# (model, field name). See FilterSpec.create()
+#
+_filter_spec_cache = {}
+
+# Per field filtering policies set via 'set_field_policy()'. The key is the
+# tuple (model, field path).
+#
+_field_policies = {}
+
+# The case policies a CharFilterSpec understands. See 'set_field_policy()'
+#
+CASE_INSENSITIVE = 'insensitive'
+CASE_SENSITIVE = 'sensitive'
+CASE_LOWER = 'lower'
+CASE_POLICIES = (CASE_INSENSITIVE, CASE_SENSITIVE, CASE_LOWER)
+
+# The ways FilterFields.count() can count the results of a filter.
+#
+COUNT_EXACT = 'exact'
+COUNT_CACHED = 'cached'
+COUNT_ESTIMATED = 'estimated'
+
+# Patterns the numeric values in a query must match before we convert them.
+# Besides rejecting garbage this bounds how long a number can be (int() on
+# a 100,000 digit string is not free.)
+#
+int_re = re.compile(r'^\s*[-+]?\d{1,20}\s*$')
+
+# The range of values parse_int() accepts: a signed 64 bit integer, the
+# largest integer column any database we run on has. Bigger values make
+# the database driver raise OverflowError.
+#
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 63 - 1
+decimal_re = re.compile(r'^\s*[-+]?(\d{1,40}(\.\d{0,40})?|\.\d{1,40})\s*$')
+float_re = re.compile(r'^\s*[-+]?(\d{1,40}(\.\d{0,40})?|\.\d{1,40})'
+                      r'([eE][-+]?\d{1,3})?\s*$')
+
+# The formats we accept for dates and date times in a query.
+#
+DATE_FORMATS = ('%Y-%m-%d',)
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+# The strings we accept for true and false in a query.
+#
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y', 'on')
+FALSE_VALUES = ('0', 'false', 'f', 'no', 'n', 'off')
+
+# Things that are not fields on a model but that can be filtered on as if
+# they were, ie: a text index (see asutils.textindex.) The key is the tuple
+# (model, name). See 'add_pseudo_field()'
+#
+_pseudo_fields = {}
+
+############################################################################
+#
+class FilterValueError(SuspiciousOperation, ValueError):
+    """
+    Raised when the value of a query parameter can not be used for the
+    filter it is for, ie: '?id__in=1,2,bloop', or it is a list with too many
+    values.
+
+    This is the client's fault so it should result in a 400 Bad Request. It
+    is a SuspiciousOperation so newer versions of django do that on their
+    own, for older ones use asutils.middleware.FilterErrorMiddleware.
+    """
+    pass
+
+############################################################################
+#
+def parse_int(value):
+    """
+    Convert a query value to an int, raising FilterValueError if it is not
+    one or if it is outside of MIN_INT to MAX_INT.
+    """
+    if not int_re.match(value):
+        raise FilterValueError("'%s' is not an integer" % value[:64])
+    result = int(value)
+    if not MIN_INT <= result <= MAX_INT:
+        raise FilterValueError("'%s' is out of range" % value[:64])
+    return result
+
+############################################################################
+#
+def parse_float(value):
+    """
+    Convert a query value to a float, raising FilterValueError if it is not
+    one. An exponent can still take a value past the largest float, ie:
+    '1e999', which float() makes infinity. We do not accept that (or NaN.)
+    """
+    if not float_re.match(value):
+        raise FilterValueError("'%s' is not a number" % value[:64])
+    result = float(value)
+    if math.isinf(result) or math.isnan(result):
+        raise FilterValueError("'%s' is out of range" % value[:64])
+    return result
+
+############################################################################
+#
+def parse_decimal(value):
+    """
+    Convert a query value to a Decimal, raising FilterValueError if it is
+    not one. 'NaN', 'Infinity' and exponents are not accepted.
+    """
+    if not decimal_re.match(value):
+        raise FilterValueError("'%s' is not a decimal number" % value[:64])
+    return decimal.Decimal(value.strip())
+
+############################################################################
+#
+def parse_bool(value):
+    """
+    Convert a query value to True or False, raising FilterValueError if it
+    is not one of TRUE_VALUES or FALSE_VALUES.
+    """
+    lowered = value.strip().lower()
+    if lowered in TRUE_VALUES:
+        return True
+    if lowered in FALSE_VALUES:
+        return False
+    raise FilterValueError("'%s' is not true or false" % value[:64])
+
+############################################################################
+#
+def _parse_time(value, formats):
+    """
+    Try each of the formats on the value, returning the struct_time of the
+    first one that works.
+    """
+    value = value.strip()
+    for fmt in formats:
+        try:
+            return time.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise FilterValueError("'%s' is not a date" % value[:64])
+
+############################################################################
+#
+def parse_date(value):
+    """
+    Convert a query value (YYYY-MM-DD) to a date, raising FilterValueError if
+    it is not one.
+    """
+    return datetime.date(*_parse_time(value, DATE_FORMATS)[:3])
+
+############################################################################
+#
+def parse_datetime(value):
+    """
+    Convert a query value (YYYY-MM-DD HH:MM:SS, or one of the other
+    DATETIME_FORMATS) to a datetime, raising FilterValueError if it is not
+    one.
+    """
+    return datetime.datetime(*_parse_time(value, DATETIME_FORMATS)[:6])
+
+############################################################################
+#
+def parse_list(value, convert, max_length):
+    """
+    Convert a comma separated query value (ie: for an 'in' lookup) to a list
+    of values, using 'convert' on each one.
+
+    If there are more than 'max_length' values we raise FilterValueError
+    without splitting the value up, so that a client can not make us build
+    (and send to the database) a giant 'IN (...)' clause.
+    """
+    if value.count(',') >= max_length:
+        raise FilterValueError("too many values, at most %d are allowed" % \
+                               max_length)
+    return [convert(x) for x in value.split(',')]
+
+############################################################################
+#
+def parse_range(value, convert):
+    """
+    Convert a query value of the form 'low,high' (ie: for a 'range' lookup)
+    to the list [low, high], using 'convert' on each one. Raises
+    FilterValueError if there are not exactly two values or if low is
+    greater than high.
+    """
+    values = parse_list(value, convert, 2)
+    if len(values) != 2:
+        raise FilterValueError("a range needs two values, 'low,high'")
+    if values[0] > values[1]:
+        raise FilterValueError("the start of a range can not be after its "
+                               "end")
+    return values
+
+############################################################################
+#
+def get_filter_plan(model, field_names):
+    """
+    Return the FilterPlan for filtering the given model on the given field
+    names, compiling it and remembering it if this is the first time we have
+    been asked for it.
+
+    NOTE: We do not lock around compiling a plan. If two threads ask for the
+          same plan at the same time they may both compile it, but they will
+          both compile the same thing and whichever one goes in to the cache
+          last wins.
+    """
+    key = (model, tuple(field_names))
+    try:
+        return _filter_plans[key]
+    except KeyError:
+        plan = FilterPlan(model, field_names)
+        _filter_plans[key] = plan
+        return plan
+
+############################################################################
+#
+def invalidate_filter_plans(model=None):
+    """
+    Throw away compiled filter plans (and the cached filter specs they are
+    built from) so that they will be re-compiled the next time they are
+    asked for. If 'model' is given only the plans for that model are
+    discarded, otherwise they all are.
+
+    This is called whenever a new FilterSpec is registered. It is also
+    handy for tests that register their own filter specs or fiddle with a
+    model's fields.
+    """
+    if model is None:
+        _filter_plans.clear()
+        _filter_spec_cache.clear()
+        return
+    for cache in (_filter_plans, _filter_spec_cache):
+        for key in cache.keys():
+            if key[0] is model:
+                del cache[key]
+    return
+
+############################################################################
+#
+def set_field_policy(model, field_path, case = None, lookups = None):
+    """
+    Set how filtering on a specific field of a model is done. 'field_path'
+    is the field name as given to FilterFields, ie: 'name' or 'author__name'
+
+    case: Only used for CharField's. One of:
+
+          CASE_INSENSITIVE - (the default) rewrite lookups that can be case
+                             insensitive to be case insensitive, ie:
+                             'exact' becomes 'iexact'. This is what we have
+                             always done, but on most databases it means an
+                             index on the column can not be used.
+
+          CASE_SENSITIVE   - pass lookups through as they were given, so
+                             'exact' and 'startswith' can use a plain index
+                             on the column.
+
+          CASE_LOWER       - for columns whose values are always stored
+                             lower cased. 'exact', 'startswith', 'contains'
+                             and 'endswith' (and their case insensitive
+                             forms) become the case sensitive lookup and the
+                             value is lower cased, so a search is still case
+                             insensitive but can use a plain index on the
+                             column.
+
+    lookups: The field lookups that may be used on this field. Either a
+             list of lookups (ie: ('exact', 'startswith')), in which case any
+             other lookup the filter spec supports is refused, or a
+             dictionary mapping the lookup in the query to the lookup we
+             actually pass to 'filter()'. The latter lets you send expensive
+             lookups somewhere cheaper, ie: {'icontains': 'search'} to use a
+             full text index, or {'icontains': 'trigram_similar'}. A value of
+             None in the dictionary means use the filter spec's usual
+             rewriting of that lookup.
+
+    Any compiled filter plans for the model are thrown away so the new
+    policy takes effect on the next request.
+    """
+    if case is not None and case not in CASE_POLICIES:
+        raise ValueError("Unknown case policy '%s', must be one of: %s" % \
+                         (case, ", ".join(CASE_POLICIES)))
+    _field_policies[(model, field_path)] = { 'case'    : case,
+                                             'lookups' : lookups }
+    invalidate_filter_plans(model)
+    return
+
+############################################################################
+#
+def add_pseudo_field(model, field):
+    """
+    Make 'field' available to FilterFields on 'model' as if it were a field
+    of the model named 'field.name'. A filter spec must be registered whose
+    test accepts 'field'. Like a model field it should have a 'name', a
+    'verbose_name' and a 'rel' (which will be None.)
+
+    This is how something that is not a database column, like a text index
+    over several columns, gets a FilterSpec.
+    """
+    _pseudo_fields[(model, field.name)] = field
+    invalidate_filter_plans(model)
+    return
+
+############################################################################
+#
+def remove_pseudo_field(model, field):
+    """
+    Undo 'add_pseudo_field()'
+    """
+    if _pseudo_fields.get((model, field.name)) is field:
+        del _pseudo_fields[(model, field.name)]
+        invalidate_filter_plans(model)
+    return
+
+############################################################################
+#
+def resolve_field_path(model, field_path):
+    """
+    Given a model and a field path, ie: 'author__name', follow the
+    relationships in the path and return the tuple:
+
+        (field, related path, multi valued, field model)
+
+    where 'field' is the django model field at the end of the path (the
+    'name' field on the model that 'author' refers to), 'related path' is
+    the part of the path that is relationships ('author') or None if the
+    path is just a field on 'model', and 'multi valued' is True if any of
+    the relationships in the path are many to many relationships (which
+    means filtering across them can return the same object more than once.)
+    'field model' is the model 'field' is on (the model 'author' refers to.)
+
+    We can follow ForeignKey, OneToOneField and ManyToManyField fields.
+    Raises FieldDoesNotExist if a field in the path does not exist or if
+    anything but the last field in the path is not a relationship.
+
+    A pseudo field added with 'add_pseudo_field()' is also a valid path.
+    """
+    try:
+        return _pseudo_fields[(model, field_path)], None, False, model
+    except KeyError:
+        pass
+
+    names = field_path.split("__")
+    opts = model._meta
+    related = []
+    multi_valued = False
+    for name in names[:-1]:
+        f = opts.get_field(name)
+        if f.rel is None:
+            raise FieldDoesNotExist("'%s' in the field path '%s' is not a "
+                                    "relationship" % (name, field_path))
+        if isinstance(f, models.ManyToManyField):
+            multi_valued = True
+        related.append(name)
+        model = f.rel.to
+        opts = model._meta
+    return (opts.get_field(names[-1]), "__".join(related) or None,
+            multi_valued, model)
+
+############################################################################
+#
+class ParsedLookup(tuple):
+    """
+    The result of matching a query parameter and its value against a
+    FilterSpec. It is immutable (it is a tuple) and has the attributes:
+
+        field         - the django model field being filtered
+        field_lookup  - the lookup the query asked for, ie: 'contains'
+        filter_lookup - the keyword argument to pass to django's 'filter()'
+                        method, ie: 'name__icontains'
+        value         - the value to pass to 'filter()', already converted
+                        by the filter spec, ie: [1, 2, 3] for 'id__in=1,2,3'
+        field_path    - the path to the field from the model being
+                        filtered, ie: 'name' or 'author__name'
+
+    Everything about a single request's use of a filter spec lives in one of
+    these, not in the filter spec itself.
+    """
+    __slots__ = ()
+
+    ########################################################################
+    #
+    def __new__(cls, field, field_lookup, filter_lookup, value,
+                field_path = None):
+        if field_path is None:
+            field_path = field.name
+        return tuple.__new__(cls, (field, field_lookup, filter_lookup, value,
+                                   field_path))
+
+    field = property(lambda self: self[0])
+    field_lookup = property(lambda self: self[1])
+    filter_lookup = property(lambda self: self[2])
+    value = property(lambda self: self[3])
+    field_path = property(lambda self: self[4])
+
+    ########################################################################
+    #
+    def __repr__(self):
+        return "<ParsedLookup %s=%r>" % (self.filter_lookup, self.value)
+
 ############################################################################
 #
 class FilterSpec(object):
@@ -175,12 +592,13 @@ class FilterSpec(object):
     This is because we know that 'name' is a char field and we know what
     kinds of filters are allowed on a char field.
 
-    NOTE: We do not support foreign key relationships. This is mostly a
-    problem with how we specify the fields that can be filtered on. If you
-    specify a foreign key field you need to specify what field on that related
-    object you want to do the filtering on. I figure eventually we will
-    support this by letting you specify a field as
-    'foreignkeyfieldname__subfield'
+    NOTE: Foreign key relationships are supported by specifying the field
+    on the related object you want to filter on as
+    'foreignkeyfieldname__subfield' (ie: 'author__name'). This can go through
+    ForeignKey, OneToOneField and ManyToManyField fields and as many of them
+    as you like (ie: 'author__publisher__name'.) The filter spec is the one
+    for the field at the end of the path and the query parameters it
+    accepts are the path followed by the lookup, ie: 'author__name__exact'
 
     NOTE: How do you use this? This base class is implemented by sub-classes
     knowing how to filter a specific field type. Those sub-classes register
@@ -188,6 +606,11 @@ class FilterSpec(object):
 
     Then, when a FilterSpec is created it finds out which registered filter
     specs apply to which fields it has been told to allow filtering on.
+
+    NOTE: A filter spec holds no state about any request. Matching a query
+    parameter returns a ParsedLookup and leaves the filter spec untouched.
+    This means a single instance is created per model field (see 'create()')
+    and it is shared across requests and threads without any locking.
     """
 
     # This is a class instance variable that holds the list of registered
@@ -195,11 +618,39 @@ class FilterSpec(object):
     #
     filter_specs = []
 
+    # The field lookups this filter spec supports. Sub-classes fill this in.
+    #
+    field_lookups = ()
+
+    # The most values we accept in the comma separated list for an 'in'
+    # lookup.
+    #
+    max_list_length = 100
+
     ########################################################################
     #
-    def __init__(self, f, request, params, model):
+    def __init__(self, f, model, field_path = None):
         self.field = f
-        self.params = params
+        self.model = model
+        if field_path is None:
+            field_path = f.name
+        self.field_path = field_path
+
+        # Maps each field lookup we accept for this field to the lookup we
+        # actually pass to 'filter()'. This takes in to account any policy
+        # set for this field with 'set_field_policy()'.
+        #
+        self.lookup_map = self.get_lookup_map(
+            _field_policies.get((model, field_path), {}))
+
+        # The query parameters this filter spec accepts, ie:
+        # 'name__icontains', mapped to the field lookup part, ie:
+        # 'icontains'. This lets us match a query parameter with a single
+        # dictionary lookup instead of picking it apart.
+        #
+        self.query_params = dict(("%s__%s" % (field_path, field_lookup),
+                                  str(field_lookup)) \
+                                 for field_lookup in self.lookup_map)
 
     ########################################################################
     #
@@ -214,23 +665,44 @@ class FilterSpec(object):
         filter spec supports.)
 
         You also provide the 'factor' which the class invoked to create an
-        instance of the filter spec of the appropriate type.
+        instance of the filter spec of the appropriate type. It is called
+        with the field, the model being filtered and the path to the field
+        from that model (ie: 'author__name'.)
         """
         cls.filter_specs.append((test, factory))
 
+        # A new filter spec may change which spec a field resolves to, so
+        # any filter plans compiled before now are stale.
+        #
+        invalidate_filter_plans()
+
     ########################################################################
     #
     @classmethod
-    def create(cls, f, request, params, model):
+    def create(cls, f, model, field_path = None):
         """
         This class method is what is used by the FilterFields class to search
         through the registered filter specs looking for one whose test returns
         True for the given field. It will then instantiate the appropriate
         FilterSpec sub-class with the given parameters.
+
+        Since filter specs hold no per-request state the instance is cached
+        and the same one is returned every time we are asked for a filter
+        spec for the same field path on the same model.
         """
+        if field_path is None:
+            field_path = f.name
+        key = (model, field_path)
+        try:
+            return _filter_spec_cache[key]
+        except KeyError:
+            pass
+
         for test, factory in cls.filter_specs:
             if test(f):
-                return factory(f, request, params, model)
+                spec = factory(f, model, field_path)
+                _filter_spec_cache[key] = spec
+                return spec
         raise NotImplementedError("No suppoted FilterSpec for a field of "
                                   "type %s (field name: '%s')" % \
                                   (type(f), f.name))
@@ -281,26 +753,73 @@ class FilterSpec(object):
         # but this will work fairly well for most classes of filter spec
         # out of the box.
         #
+        # NOTE: We do not record anything about the match on this
+        #       instance. Filter specs are shared by every request that uses
+        #       the same FilterPlan.
+        #
+        return param in self.query_params
+
+    ########################################################################
+    #
+    def parse_query_param(self, param, value):
+        """
+        If the given query parameter is one that this filter spec supports
+        return a ParsedLookup for it and its value. Otherwise return None.
+
+        ie: for a filter spec on an IntegerField named 'id' calling this with
+        ('id__in', '1,2,3') would return a ParsedLookup whose filter_lookup
+        is 'id__in' and whose value is [1, 2, 3].
+        """
         try:
-            field_name, field_lookup = param.split("__")
-        except ValueError:
-            return False
-
-        if field_name != self.field.name:
-            return False
-
-        if field_lookup in self.field_lookups:
-            # We stash the field lookup being used in our object for later
-            # use by the field_lookup() and field_value() methods. Because
-            # we are holding state like this in a single object that may be
-            # used multiple times in a single request this requires
-            # that the field_lookup() and field_value() methods if they
-            # require this information follow this method invocation.
-            #
-            self.field_lookup_value = str(field_lookup)
-            return True
-        return False
+            field_lookup = self.query_params[param]
+        except KeyError:
+            return None
+        return ParsedLookup(self.field, field_lookup, self.field_lookup(param),
+                            self.field_value(value, field_lookup),
+                            self.field_path)
 
+    ########################################################################
+    #
+    def default_lookup_map(self, policy):
+        """
+        Returns a dictionary mapping each field lookup this filter spec
+        supports to the field lookup we pass to 'filter()', before any
+        restrictions from the field's policy are applied.
+
+        If 'field_lookups' is a dictionary it is used as is, otherwise every
+        field lookup maps to itself.
+        """
+        if isinstance(self.field_lookups, dict):
+            return dict(self.field_lookups)
+        return dict((x, x) for x in self.field_lookups)
+
+    ########################################################################
+    #
+    def get_lookup_map(self, policy):
+        """
+        Returns a dictionary mapping each field lookup we accept to the field
+        lookup we pass to 'filter()'.
+
+        We start with 'default_lookup_map()'. The 'lookups' entry of the
+        given policy (see 'set_field_policy()') then restricts and re-routes
+        that.
+        """
+        lookup_map = self.default_lookup_map(policy)
+
+        allowed = policy.get('lookups')
+        if allowed is None:
+            return lookup_map
+
+        if isinstance(allowed, dict):
+            restricted = {}
+            for field_lookup, target in allowed.items():
+                if target is None:
+                    target = lookup_map.get(field_lookup)
+                    if target is None:
+                        continue
+                restricted[field_lookup] = target
+            return restricted
+        return dict((x, lookup_map[x]) for x in allowed if x in lookup_map)
 
     ########################################################################
     #
@@ -311,17 +830,60 @@ class FilterSpec(object):
         rewrite queries from one form in to another. One possible use, for
         instance, is to convert all 'contains' 'startswith' etc, in to
         'icontains', 'istartswith'
+
+        The rewriting is driven by our 'lookup_map'.
         """
-        return str(param)
+        field_path, field_lookup = param.rsplit("__", 1)
+        return "%s__%s" % (str(field_path), self.lookup_map[field_lookup])
 
     ########################################################################
     #
-    def field_value(self, value):
+    def field_value(self, value, field_lookup = None):
         """
         This does any normalization or cleaning we need to on the value of a
-        field lookup.  The default case will just pass the result through.
+        field lookup.
+
+        'field_lookup' is the lookup part of the query parameter the value
+        came from (ie: 'in' for 'id__in'.) 'isnull' takes true or false, 'in'
+        takes a comma separated list of at most 'max_list_length' values and
+        'range' takes 'low,high'. Single values are converted by
+        'convert_value()'.
+
+        Raises FilterValueError if the value is not valid.
+        """
+        if field_lookup == 'isnull':
+            return parse_bool(value)
+        if field_lookup == 'in':
+            return parse_list(value,
+                              lambda x: self.convert_value(x, field_lookup),
+                              self.max_list_length)
+        if field_lookup == 'range':
+            return parse_range(value,
+                               lambda x: self.convert_value(x, field_lookup))
+        return self.convert_value(value, field_lookup)
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        """
+        Convert a single value from a query for this filter spec's field.
+        The default case will just pass the result through.
+        """
+        return force_unicode(value)
+
+    ########################################################################
+    #
+    def value_coercer(self, field_lookup):
+        """
+        Returns a callable that takes the value of a query parameter for the
+        given field lookup (ie: 'contains', 'in', etc.) and returns the value
+        we should pass to django's 'filter()' method.
+
+        This is what a FilterPlan stores in its dispatch table so that it
+        does not need to work out how to convert a value on every request.
+        The default calls our 'field_value()' method.
         """
-        return str(value)
+        return lambda value: self.field_value(value, field_lookup)
     
 ############################################################################
 #
@@ -349,8 +911,9 @@ class CharFilterSpec(FilterSpec):
         name__regex
         name__iregex
 
-    NOTE: Maybe we should convert fields that may be case insensitive to
-    be case insensitive.
+    By default lookups that may be case insensitive are converted to be case
+    insensitive. Since that keeps the database from using a regular index on
+    the column this can be changed per field with 'set_field_policy()'.
     """
 
     # The field lookups we support. The actual lookup is going to be
@@ -378,15 +941,52 @@ class CharFilterSpec(FilterSpec):
         'iregex'      : 'iregex',
         }
 
+    # The lookups to use for the CASE_LOWER policy. Lookups not in here are
+    # rewritten the same way as for CASE_INSENSITIVE.
+    #
+    lower_lookups = {
+        'exact'       : 'exact',
+        'iexact'      : 'exact',
+        'contains'    : 'contains',
+        'icontains'   : 'contains',
+        'startswith'  : 'startswith',
+        'istartswith' : 'startswith',
+        'endswith'    : 'endswith',
+        'iendswith'   : 'endswith',
+        }
+
     ########################################################################
     #
-    def field_lookup(self, param):
+    def __init__(self, f, model, field_path = None):
+        super(CharFilterSpec, self).__init__(f, model, field_path)
+        policy = _field_policies.get((model, self.field_path), {})
+        self.lower_values = policy.get('case') == CASE_LOWER
+
+    ########################################################################
+    #
+    def default_lookup_map(self, policy):
         """
-        Convert lookups to case insensitive ones.
+        The lookups we use depend on the case policy for this field.
         """
-        field_name, field_lookup = param.split("__")
-        return "%s__%s" % (str(field_name),
-                           CharFilterSpec.field_lookups[field_lookup])
+        case = policy.get('case') or CASE_INSENSITIVE
+        if case == CASE_SENSITIVE:
+            return dict((x, x) for x in self.field_lookups)
+
+        lookup_map = dict(self.field_lookups)
+        if case == CASE_LOWER:
+            lookup_map.update(self.lower_lookups)
+        return lookup_map
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        """
+        With the CASE_LOWER policy the column is lower cased so the value
+        we compare it with has to be as well.
+        """
+        if self.lower_values and field_lookup in self.lower_lookups:
+            value = value.lower()
+        return force_unicode(value)
 
 FilterSpec.register(lambda f: isinstance(f, models.CharField), CharFilterSpec)
 
@@ -413,19 +1013,287 @@ class IntFilterSpec(FilterSpec):
     
     ########################################################################
     #
-    def field_value(self, value):
+    def convert_value(self, value, field_lookup = None):
         """
-        For an int, we need to return a value as an int. Also if the
-        field lookup is 'in' or 'range' we need to return a list, we
-        assume that the value is a comma separated list of ints.
+        For an int, we need to return a value as an int.
         """
-        if self.field_lookup_value in ('in', 'range'):
-            return [int(x) for x in value.split(',')]
-        return int(value)
+        return parse_int(value)
 
 FilterSpec.register(lambda f: isinstance(f, models.IntegerField), IntFilterSpec)
 FilterSpec.register(lambda f: isinstance(f, models.AutoField), IntFilterSpec)
 
+############################################################################
+#
+class FloatFilterSpec(FilterSpec):
+    """
+    A FilterSpec that understands how to filter FloatFields.
+
+    This will support the following django field lookups:
+
+       name__exact
+       name__in    (comma separated list)
+       name__gt
+       name__gte
+       name__lt
+       name__lte
+       name__isnull
+       name__range (comma separate list of two values)
+    """
+
+    field_lookups = ('exact','in','gt','gte','lt','lte','isnull','range')
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        return parse_float(value)
+
+FilterSpec.register(lambda f: isinstance(f, models.FloatField),
+                    FloatFilterSpec)
+
+############################################################################
+#
+class DecimalFilterSpec(FloatFilterSpec):
+    """
+    A FilterSpec that understands how to filter DecimalFields. It supports
+    the same lookups as the FloatFilterSpec but the values are Decimal's.
+    """
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        return parse_decimal(value)
+
+FilterSpec.register(lambda f: isinstance(f, models.DecimalField),
+                    DecimalFilterSpec)
+
+############################################################################
+#
+class BooleanFilterSpec(FilterSpec):
+    """
+    A FilterSpec that understands how to filter BooleanFields and
+    NullBooleanFields.
+
+    This will support the following django field lookups:
+
+       name__exact   (1, true, yes, on / 0, false, no, off)
+       name__isnull
+    """
+
+    field_lookups = ('exact', 'isnull')
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        return parse_bool(value)
+
+FilterSpec.register(lambda f: isinstance(f, (models.BooleanField,
+                                             models.NullBooleanField)),
+                    BooleanFilterSpec)
+
+############################################################################
+#
+class DateFilterSpec(FilterSpec):
+    """
+    A FilterSpec that understands how to filter DateFields.
+
+    This will support the following django field lookups:
+
+       name__exact  (YYYY-MM-DD)
+       name__in     (comma separated list)
+       name__gt
+       name__gte
+       name__lt
+       name__lte
+       name__isnull
+       name__range  (comma separate list of two values)
+       name__year   (an int)
+       name__month  (an int)
+       name__day    (an int)
+    """
+
+    field_lookups = ('exact','in','gt','gte','lt','lte','isnull','range',
+                     'year','month','day')
+
+    ########################################################################
+    #
+    def convert_value(self, value, field_lookup = None):
+        if field_lookup in ('year', 'month', 'day'):
+            return parse_int(value)
+        return self.parse_date(value)
+
+    ########################################################################
+    #
+    def parse_date(self, value):
+        return parse_date(value)
+
+############################################################################
+#
+class DateTimeFilterSpec(DateFilterSpec):
+    """
+    A FilterSpec that understands how to filter DateTimeFields. It supports
+    the same lookups as DateFilterSpec. Values may be a date and time
+    (YYYY-MM-DD HH:MM:SS, or without the seconds) or just a date, which
+    means midnight.
+    """
+
+    ########################################################################
+    #
+    def parse_date(self, value):
+        return parse_datetime(value)
+
+# DateTimeField is a sub-class of DateField so it needs to be registered
+# first.
+#
+FilterSpec.register(lambda f: isinstance(f, models.DateTimeField),
+                    DateTimeFilterSpec)
+FilterSpec.register(lambda f: isinstance(f, models.DateField),
+                    DateFilterSpec)
+
+############################################################################
+#
+class FilterPlan(object):
+    """
+    A FilterPlan is the compiled form of 'filter model X on fields Y'.
+
+    Working out which FilterSpec applies to each field means calling
+    '_meta.get_field()' for every field name and running every registered
+    filter spec's test against it. None of that depends on the request being
+    processed so we do it once per (model, field names) and keep the result
+    around for the life of the process. See 'get_filter_plan()'.
+
+    Along with the list of filter specs a plan has a 'dispatch' table. This
+    maps every query parameter we will accept (ie: 'name__contains') to a
+    tuple of:
+
+        (filter spec, field lookup, lookup to pass to filter(), value coercer)
+
+    where the field lookup is the part of the query parameter after the
+    field name (ie: 'contains'), the lookup to pass to filter() has already
+    been rewritten by the filter spec (ie: 'name__icontains') and the value
+    coercer is a callable that converts the query parameter's value in to
+    what we pass to filter().
+
+    This means that when we process a request all we need to do is a
+    dictionary lookup for each query parameter.
+
+    Field names may span relationships (ie: 'author__name'.) For those the
+    plan records, in 'relations', the related path ('author') and whether
+    it passes through a many to many relationship. 'follow_relations()'
+    uses this to avoid a query per row when the results are listed. The
+    models those relationships lead to are in 'related_models'.
+    """
+
+    ########################################################################
+    #
+    def __init__(self, model, field_names):
+        self.model = model
+        self.field_names = tuple(field_names)
+        self.filter_specs = []
+        self.dispatch = {}
+        self.relations = {}
+        self.related_models = []
+
+        for field_name in self.field_names:
+            f, related_path, multi_valued, field_model = \
+               resolve_field_path(model, field_name)
+            spec = FilterSpec.create(f, model, field_name)
+            if spec and spec.has_output():
+                self.filter_specs.append(spec)
+                if related_path is not None:
+                    self.relations[field_name] = (related_path, multi_valued)
+                    if field_model not in self.related_models:
+                        self.related_models.append(field_model)
+
+        for spec in self.filter_specs:
+            for param, field_lookup in spec.query_params.items():
+                self.dispatch[param] = (spec, str(field_lookup),
+                                        spec.field_lookup(param),
+                                        spec.value_coercer(field_lookup))
+        return
+
+    ########################################################################
+    #
+    def parse(self, query):
+        """
+        Given a QueryDict (or any dictionary like object) of query
+        parameters return a list of ParsedLookup's, one for each query
+        parameter that one of our filter specs supports.
+
+        This is a single pass over the query parameters. Parameters that are
+        not in our dispatch table are ignored. We hold no state from one call
+        to the next so a plan can be used by any number of requests at once.
+
+        Raises FilterValueError if the value of a query parameter is not
+        valid for its filter.
+        """
+        lookups = []
+        dispatch = self.dispatch
+        for param, value in query.items():
+            try:
+                fs, field_lookup, filter_lookup, coerce = dispatch[param]
+            except KeyError:
+                continue
+            try:
+                value = coerce(value)
+            except FilterValueError as e:
+                raise FilterValueError("%s: %s" % (param, e))
+            lookups.append(ParsedLookup(fs.field, field_lookup, filter_lookup,
+                                        value, fs.field_path))
+        return lookups
+
+    ########################################################################
+    #
+    def filter_kwargs(self, query):
+        """
+        Given a QueryDict (or any dictionary like object) of query
+        parameters return the dictionary of keyword arguments to pass to
+        django's 'filter()' method.
+        """
+        return dict((parsed.filter_lookup, parsed.value) \
+                    for parsed in self.parse(query))
+
+    ########################################################################
+    #
+    def follow_relations(self, queryset, lookups):
+        """
+        Given a query set that has been filtered by the given list of
+        ParsedLookup's, return a query set that also fetches the related
+        objects those filters went through.
+
+        For lookups that only go through ForeignKey and OneToOneField
+        relationships we add a 'select_related()' for the related path. The
+        join is already being done for the filter so fetching the related
+        object along with it is nearly free and it saves a query per row when
+        the results are listed.
+
+        For lookups that go through a ManyToManyField the filter can match
+        the same object more than once so we add a 'distinct()'. If this
+        version of django has 'prefetch_related()' we also use that to fetch
+        the related objects in one query.
+        """
+        select_related = []
+        prefetch_related = []
+        multi_valued = False
+        for parsed in lookups:
+            try:
+                related_path, many = self.relations[parsed.field_path]
+            except KeyError:
+                continue
+            if many:
+                multi_valued = True
+                if related_path not in prefetch_related:
+                    prefetch_related.append(related_path)
+            elif related_path not in select_related:
+                select_related.append(related_path)
+
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if multi_valued:
+            queryset = queryset.distinct()
+            if prefetch_related and hasattr(queryset, 'prefetch_related'):
+                queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
 ############################################################################
 #
 class FilterFields(object):
@@ -457,7 +1325,8 @@ class FilterFields(object):
                on.
 
         fields: The names of the fields in our model that the user can use for
-                filtering. (a list or tuple)
+                filtering. (a list or tuple) These may span relationships,
+                ie: 'author__name'
         """
         self.model = model
         self.opts = model._meta
@@ -466,33 +1335,34 @@ class FilterFields(object):
         self.manager = self.model.objects
         self.field_names = field_names
         self.request = request
-        self.params = dict(request.GET.items())
+        self.plan = get_filter_plan(model, field_names)
         self.filter_specs, self.has_filters = self.get_filters(request)
+        self.lookups = None
+        self.count_is_estimate = False
         return
 
+    ########################################################################
+    #
+    @property
+    def params(self):
+        """
+        The query parameters of our request as a plain dictionary. Nothing
+        here uses this any more (our FilterPlan reads request.GET directly)
+        so it is only worked out for code that still asks for it.
+        """
+        return dict(self.request.GET.items())
+
     ########################################################################
     #
     def get_filters(self,request):
         """
         Retrieves a list of FilterSpec objects based on the fields we may
         filter on.
-        """
-        filter_specs = []
-
-        # Get references to the actual fields in the model that we want to be
-        # able to filter on.
-        #
-        filter_fields = [self.lookup_opts.get_field(field_name) \
-                         for field_name in self.field_names]
-
-        # For each of the fields that we want to filter on, instantiate the
-        # proper FilterSpec (based on the type of the field.)
-        #
-        for f in filter_fields:
-            spec = FilterSpec.create(f, self.request, self.params, self.model)
-            if spec and spec.has_output():
-                filter_specs.append(spec)
 
+        The filter specs come from our compiled FilterPlan so they are shared
+        with every other FilterFields for the same model and fields.
+        """
+        filter_specs = list(self.plan.filter_specs)
         return filter_specs, bool(filter_specs)
 
     ########################################################################
@@ -523,6 +1393,141 @@ class FilterFields(object):
         """
         pass
     
+    ########################################################################
+    #
+    def get_lookups(self):
+        """
+        Returns the list of ParsedLookup's for the filters in our request.
+        They are worked out the first time we are called.
+        """
+        if self.lookups is None:
+            self.lookups = self.plan.parse(self.request.GET)
+        return self.lookups
+
+    ########################################################################
+    #
+    def cache_models(self):
+        """
+        The models whose changes can change the results of our filter. This
+        is our model and any models our filters reach through relationships.
+        Sub-classes that filter on other things add to this.
+        """
+        return [self.model] + self.plan.related_models
+
+    ########################################################################
+    #
+    def filter_key_params(self):
+        """
+        Returns a list of (name, value) pairs that identify the filtering
+        being done for this request. Two requests with the same filter key
+        params return the same results. This is what cached results are
+        keyed by.
+
+        It is the keyword arguments we pass to 'filter()', so query
+        parameters that we ignore, or that are different ways of writing the
+        same filter (ie: 'name__contains' and 'name__icontains') do not
+        matter. Sub-classes that filter on more than our filter specs add to
+        this.
+        """
+        return [(parsed.filter_lookup, parsed.value) \
+                for parsed in self.get_lookups()]
+
+    ########################################################################
+    #
+    def cache_key(self, kind, *extra):
+        """
+        Returns the key to cache something of 'kind' (ie: 'count') computed
+        from our filtered query set under. The key changes whenever an object
+        of any of our 'cache_models()' is saved or deleted.
+        """
+        models = self.cache_models()
+        generations = tuple(querycache.generation(m) for m in models[1:])
+        return querycache.make_key(kind, self.model, self.filter_key_params(),
+                                   generations, *extra)
+
+    ########################################################################
+    #
+    def count(self, strategy = COUNT_EXACT, timeout = None, queryset = None):
+        """
+        Return the number of objects our filtered query set has. Counting
+        the rows of a big table is frequently the most expensive thing a
+        paginated page does so there are several ways of doing it:
+
+          COUNT_EXACT     - ask the database (ie: 'SELECT COUNT(*) ...')
+
+          COUNT_CACHED    - an exact count, cached in django's cache under
+                            'cache_key()' for 'timeout' seconds (the cache's
+                            default if None.) Saving or deleting an object of
+                            the model makes the cached count stale.
+
+          COUNT_ESTIMATED - ask the database's query planner how many rows it
+                            expects. This is cheap but only an estimate. If
+                            the database backend does not give us one we do
+                            an exact count.
+
+        'self.count_is_estimate' is set to True if the count we return is an
+        estimate.
+
+        'queryset' is our filtered query set if you already have it.
+        """
+        if queryset is None:
+            queryset = self.get_query_set()
+        self.count_is_estimate = False
+
+        if strategy == COUNT_ESTIMATED:
+            estimate = querycache.estimate_count(queryset)
+            if estimate is not None:
+                self.count_is_estimate = True
+                return estimate
+            return queryset.count()
+
+        if strategy == COUNT_CACHED:
+            key = self.cache_key('count')
+            count = cache.get(key)
+            if count is None:
+                count = queryset.count()
+                cache.set(key, count, timeout)
+            return count
+
+        return queryset.count()
+
+    ########################################################################
+    #
+    def get_counted_query_set(self, strategy = COUNT_CACHED, timeout = None):
+        """
+        Returns our filtered query set wrapped so that its 'count()' is the
+        count from 'count()' using the given strategy. Hand this to django's
+        Paginator, or the object_list generic view, and they will use our
+        count instead of doing a 'COUNT(*)' of their own.
+        """
+        queryset = self.get_query_set()
+        return querycache.CountedQuerySet(queryset,
+                                          self.count(strategy, timeout,
+                                                     queryset))
+
+    ########################################################################
+    #
+    def get_cached_query_set(self, order_by = None, timeout = None):
+        """
+        Returns our filtered query set (ordered by the list 'order_by' if
+        given) wrapped in a querycache.CachedQuerySet. Pages sliced from it
+        are cached as lists of primary keys under 'cache_key()' along with
+        the ordering and the slice, so a page that has been asked for
+        before (shared links, crawlers paging through the same filters) is
+        a cache hit and one 'in_bulk()' fetch by primary key.
+
+        The objects are fetched with the same 'select_related()' our filters
+        would have used. Hand this to django's Paginator or the object_list
+        generic view like any query set.
+        """
+        queryset = self.get_query_set()
+        if order_by:
+            queryset = queryset.order_by(*order_by)
+        fetch = self.plan.follow_relations(self.manager.all(),
+                                           self.get_lookups())
+        return querycache.CachedQuerySet(queryset, self.cache_key, fetch,
+                                         timeout)
+
     ########################################################################
     #
     def get_query_set(self):
@@ -530,8 +1535,6 @@ class FilterFields(object):
         Based on the filter fields specified in the query construct
         a chain of query sets that will filter the model appropriately.
         """
-        kwargs = {}
-
         # if we have no filters, then we return all the objects.
         #
         if not self.has_filters:
@@ -542,25 +1545,23 @@ class FilterFields(object):
         # in.
         #
 
-        # Go through all of the parameters in the GET query. We are looking
-        # for ones that match a pattern that one of our filter specs matches.
+        # Our plan goes through all of the parameters in the GET query
+        # once, looking for ones that are in its dispatch table. Those tell
+        # it the lookup to use and how to convert the value.
         #
-        for fs in self.filter_specs:
-            for param,value in self.request.GET.items():
-
-                # See if the parameter is one that the current filter spec
-                # matches.
-                #
-                if fs.match_query_param(param):
-                    kwargs[fs.field_lookup(param)] = fs.field_value(value)
+        lookups = self.get_lookups()
 
         # If at the end of apply every parameter to every filter set we find
         # no matches, return the 'all' objects queryset.
         #
-        if len(kwargs) == 0:
+        if len(lookups) == 0:
             return self.manager.all()
 
         # Otherwise return a query set that is filtered according to the
-        # arguments in the request object.
+        # arguments in the request object, fetching along with it any
+        # related objects the filters went through.
         #
-        return self.manager.filter(**kwargs)
+        kwargs = dict((parsed.filter_lookup, parsed.value) \
+                      for parsed in lookups)
+        return self.plan.follow_relations(self.manager.filter(**kwargs),
+                                          lookups)
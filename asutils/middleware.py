@@ -8,7 +8,9 @@ Bits of django middleware that we find useful in a number of projects.
 import urllib
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponseBadRequest
+
+from asutils.filterfields import FilterValueError
 
 #############################################################################
 #
@@ -90,3 +92,22 @@ class iPhoneMiddleware(object):
             request.iphone = False
             # settings.TEMPLATE_DIRS = local_settings.TEMPLATE_DIRS
         return
+
+#############################################################################
+#
+class FilterErrorMiddleware(object):
+    """
+    Turns a FilterValueError (a query parameter for a FilterFields filter
+    that we could not use, like '?id__in=1,2,bloop' or an 'in' list with too
+    many values) in to a 400 Bad Request instead of a 500 server error.
+
+    Newer versions of django do this on their own since FilterValueError is
+    a SuspiciousOperation.
+    """
+    ########################################################################
+    #
+    def process_exception(self, request, exception):
+        if isinstance(exception, FilterValueError):
+            return HttpResponseBadRequest("Bad filter: %s" % exception,
+                                          content_type = "text/plain")
+        return None
@@ -0,0 +1,15 @@
+#
+# File: $Id$
+#
+"""
+asutils has no models of its own (asutils.textindex is a separate app.)
+django imports this module when it loads the apps in INSTALLED_APPS, so it
+is where we start bumping asutils.querycache generations on every save and
+delete, even in processes that never use a cached query themselves.
+"""
+
+# asutils imports
+#
+from asutils import querycache
+
+querycache.connect_signals()
@@ -0,0 +1,354 @@
+#
+# File: $Id$
+#
+"""
+Helpers for caching things computed from a query on a model (counts, lists
+of ids) in django's cache.
+
+Every cached value is keyed by the model, a canonical form of the filter
+arguments and the model's current 'generation'. The generation is a
+counter kept in the cache that is bumped whenever an object of the model
+is saved or deleted. Bumping it means every key built with the old
+generation is never asked for again, so we never have to find and delete
+the stale entries ourselves.
+
+We listen for the saves and deletes of every model, not just the ones we
+have cached something for, as soon as this module is imported (and the
+asutils app's models module imports it.) A process that only ever saves
+objects (the admin, a cron job) has to bump the generations too, or the
+processes serving cached results would never see its changes.
+"""
+
+# System imports
+#
+import re
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+# Django imports
+#
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import signals
+
+# For pulling the planner's row estimate out of a postgresql EXPLAIN.
+#
+pg_rows_re = re.compile(r'rows=(\d+)')
+
+#############################################################################
+#
+def model_label(model):
+    """
+    Returns 'app_label.modelname' for the given model.
+    """
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+#############################################################################
+#
+def concrete_model(model):
+    """
+    Returns the model whose table the given model's objects are in. A
+    proxy model (or the class django makes for 'defer()') shares its
+    generation with the model it is a proxy for.
+    """
+    while model._meta.proxy:
+        model = model._meta.proxy_for_model
+    return model
+
+#############################################################################
+#
+def generation_key(model):
+    return "asutils.querycache.gen.%s" % model_label(concrete_model(model))
+
+#############################################################################
+#
+def key_generation(key):
+    """
+    Returns the current value of the generation counter kept in the cache
+    under 'key'. Anything can have a generation, not just a model (see
+    asutils.tagindex.)
+    """
+    gen = cache.get(key)
+    if gen is None:
+        # Nothing in the cache (never bumped, or evicted.) Start a
+        # generation. 'add' so that we do not stomp on someone else doing
+        # the same thing at the same time.
+        #
+        cache.add(key, 1)
+        gen = cache.get(key, 1)
+    return gen
+
+#############################################################################
+#
+def bump_key_generation(key):
+    """
+    Start a new generation for the counter kept in the cache under 'key'.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        # incr raises ValueError if the key is not in the cache.
+        #
+        cache.set(key, 2)
+    return
+
+#############################################################################
+#
+def generation(model):
+    """
+    Returns the current generation of the given model.
+    """
+    return key_generation(generation_key(model))
+
+#############################################################################
+#
+def bump_generation(model):
+    """
+    Start a new generation for the given model, making everything cached
+    for it so far stale.
+    """
+    bump_key_generation(generation_key(model))
+    return
+
+#############################################################################
+#
+def _model_changed(sender, **kwargs):
+    bump_generation(sender)
+
+#############################################################################
+#
+def connect_signals():
+    """
+    Bump a model's generation whenever one of its objects is saved or
+    deleted. Called when this module is imported. Safe to call more than
+    once.
+    """
+    signals.post_save.connect(_model_changed, weak = False,
+                              dispatch_uid = 'asutils.querycache.save')
+    signals.post_delete.connect(_model_changed, weak = False,
+                                dispatch_uid = 'asutils.querycache.delete')
+    return
+
+connect_signals()
+
+#############################################################################
+#
+def watch(model):
+    """
+    Kept for callers from before every model was watched. Saving or
+    deleting an object of any model already bumps its generation.
+    """
+    connect_signals()
+    return
+
+#############################################################################
+#
+def normalize(value):
+    """
+    Returns a form of a filter argument's value that is the same for equal
+    filters and is safe to put in a cache key. Query sets (ie: for 'pk__in'
+    sub-queries) are turned in to their SQL instead of being evaluated.
+    """
+    if hasattr(value, 'query'):
+        return str(value.query)
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(x) for x in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+#############################################################################
+#
+def make_key(kind, model, filters, *extra):
+    """
+    Returns the cache key for something of 'kind' (ie: 'count') computed
+    from 'model' filtered by 'filters'. 'filters' is a dictionary or a
+    sequence of (name, value) pairs (ie: the keyword arguments passed to
+    'filter()'). They are sorted so the order they were given in does not
+    matter. Anything in 'extra' (ie: ordering) is also part of the key.
+
+    The model's generation is in the key so saving or deleting an object of
+    the model makes every key built before then stale.
+    """
+    if isinstance(filters, dict):
+        filters = filters.items()
+    canonical = repr((sorted((str(k), normalize(v)) for k, v in filters),
+                      normalize(extra)))
+    return "asutils.querycache.%s.%s.%s.%s" % (kind, model_label(model),
+                                               generation(model),
+                                               md5(canonical).hexdigest())
+
+#############################################################################
+#
+def backend_name():
+    """
+    The name of the database backend, ie: 'postgresql' or 'mysql'
+    """
+    vendor = getattr(connection, 'vendor', None)
+    if vendor:
+        return vendor
+    return settings.DATABASE_ENGINE
+
+#############################################################################
+#
+def query_sql(queryset):
+    """
+    Returns the (sql, params) for the given query set.
+    """
+    query = queryset.query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(queryset.db).as_sql()
+    return query.as_sql()
+
+#############################################################################
+#
+def estimate_count(queryset):
+    """
+    Ask the database's query planner how many rows it thinks the given
+    query set will return. This is much cheaper than a 'COUNT(*)' on a big
+    table but it is only an estimate.
+
+    Returns None if we do not know how to get an estimate from this
+    database backend.
+    """
+    backend = backend_name()
+    if 'postgresql' in backend:
+        sql, params = query_sql(queryset)
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        match = pg_rows_re.search(row[0])
+        if match is None:
+            return None
+        return int(match.group(1))
+    elif 'mysql' in backend:
+        sql, params = query_sql(queryset)
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        columns = [x[0] for x in cursor.description]
+        row = cursor.fetchone()
+        if row is None or 'rows' not in columns:
+            return None
+        return int(row[columns.index('rows')] or 0)
+    return None
+
+#############################################################################
+#
+class CountedQuerySet(object):
+    """
+    Wraps a query set and a count we already know for it, so that things
+    like django's Paginator (and the object_list generic view) use our
+    count instead of doing a 'COUNT(*)' of their own.
+
+    Anything else is passed through to the query set.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, queryset, count):
+        self.queryset = queryset
+        self._count = count
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(self.queryset)
+
+    def __getitem__(self, item):
+        return self.queryset[item]
+
+    def _clone(self):
+        return CountedQuerySet(self.queryset._clone(), self._count)
+
+    def __getattr__(self, name):
+        return getattr(self.queryset, name)
+
+#############################################################################
+#
+class CachedQuerySet(object):
+    """
+    Wraps a query set so that the pages sliced from it (ie: by django's
+    Paginator) and its count are cached.
+
+    For a slice we cache the list of primary keys of the objects in it,
+    keyed by 'make_key("ids", ordering, start, stop)'. When a page is asked
+    for again we fetch the objects with a single 'in_bulk()' on their
+    primary keys from the 'fetch' query set (the model's default manager if
+    not given) instead of running the filter again. The count is cached
+    under 'make_key("count")'.
+
+    'make_key' is something like FilterFields.cache_key(), which puts the
+    model's generation in the key so a save or delete makes what we cached
+    stale.
+
+    Anything else is passed through to the query set.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, queryset, make_key, fetch = None, timeout = None):
+        self.queryset = queryset
+        self.make_key = make_key
+        if fetch is None:
+            fetch = queryset.model._default_manager.all()
+        self.fetch = fetch
+        self.timeout = timeout
+
+    #########################################################################
+    #
+    def count(self):
+        key = self.make_key('count')
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, self.timeout)
+        return count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.queryset)
+
+    #########################################################################
+    #
+    def get_ids(self, start, stop):
+        """
+        The primary keys of the objects in the slice [start:stop], from the
+        cache if we have them.
+        """
+        key = self.make_key('ids', tuple(self.queryset.query.order_by),
+                            start, stop)
+        ids = cache.get(key)
+        if ids is None:
+            ids = list(self.queryset.values_list('pk', flat = True)[start:stop])
+            cache.set(key, ids, self.timeout)
+        return ids
+
+    #########################################################################
+    #
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step is not None:
+            return self.queryset[item]
+        ids = self.get_ids(item.start or 0, item.stop)
+        if not ids:
+            return []
+        objects = self.fetch.in_bulk(ids)
+        return [objects[x] for x in ids if x in objects]
+
+    def _clone(self):
+        return CachedQuerySet(self.queryset._clone(), self.make_key,
+                              self.fetch, self.timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.queryset, name)
@@ -6,19 +6,212 @@ The source code in this file originally came from:
 
     http://www.djangosnippets.org/snippets/365/
     
+Pushing every byte of a big file through python ties up a django worker
+for as long as the download takes. If the web server in front of django
+can send files itself set SENDFILE_BACKEND in your settings and send_file()
+and stream_file() will just tell it which file to send:
+
+    'python'   - send the file ourselves (the default)
+    'xsendfile' - Apache with mod_xsendfile ('X-Sendfile' header)
+    'nginx'    - nginx ('X-Accel-Redirect' header.) nginx wants the url
+                 of an 'internal' location, not a path, so also set
+                 SENDFILE_NGINX_LOCATIONS to a list of (directory, url)
+                 pairs, ie: (('/var/media/', '/protected/'),) for:
+
+                     location /protected/ {
+                         internal;
+                         alias /var/media/;
+                     }
+
+    'lighttpd' - lighttpd ('X-LIGHTTPD-send-file' header)
+
+SENDFILE_BACKEND may also be the dotted path of your own function (or the
+function itself.) It is called with the request, the absolute path of the
+file and its content type and returns the response, or None to have us
+send the file ourselves.
+
+The web server handles range requests for the files it sends.
+
+Without one, if the WSGI server has a 'wsgi.file_wrapper' (gunicorn, uWSGI
+and mod_wsgi do) it can use os.sendfile() to send the file, or the range of
+it we were asked for, without the data going through python. Django does
+not hand the server its file wrapper itself so use our handler in your
+.wsgi file:
+
+    from asutils.sendfile import SendfileWSGIHandler
+    application = SendfileWSGIHandler()
 """
 
 import os
 import os.path
-import tempfile
 import zipfile
 import re
+import mmap
+import time
+import random
+import threading
+try:
+    from email.utils import parsedate_tz, mktime_tz
+except ImportError:
+    from email.Utils import parsedate_tz, mktime_tz
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.utils.encoding import smart_str
+from django.core.handlers.wsgi import WSGIHandler
+from django.dispatch import Signal
 
-from django.http import HttpResponse
-from django.core.servers.basehttp import FileWrapper
+from asutils import zipstream
+
+# These moved or went away in later versions of django.
+#
+try:
+    from django.utils.http import urlquote
+except ImportError:
+    from urllib.parse import quote as urlquote
+try:
+    from django.core.servers.basehttp import FileWrapper
+except ImportError:
+    from wsgiref.util import FileWrapper
 
 http_range_re = re.compile('^bytes=(?P<start>\d+)?-(?P<end>\d+)?')
 
+# One 'first-last' (or '-suffix') in a Range header.
+#
+range_spec_re = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# Sent when send_file() or stream_file() is done sending a file (the WSGI
+# server closed the response.) The sender is the function that sent it.
+# The arguments are:
+#
+#   request        - the request
+#   filename       - the file that was sent
+#   status         - the response's status (200 or 206)
+#   ranged         - True if only part of the file was asked for
+#   bytes_expected - the number of bytes we meant to send
+#   bytes_sent     - the number of bytes we did send, None if the WSGI
+#                    server's file wrapper sent them
+#   duration       - seconds from when the response was made to when it
+#                    was closed
+#   aborted        - True if the client went away before it got everything
+#                    (None if we can not tell, see 'bytes_sent')
+#
+FILE_SENT_ARGS = ['request', 'filename', 'status', 'ranged', 'bytes_expected',
+                  'bytes_sent', 'duration', 'aborted']
+try:
+    file_sent = Signal(providing_args = FILE_SENT_ARGS)
+except TypeError:
+    # django 4.0 and later do not take 'providing_args'
+    #
+    file_sent = Signal()
+
+# The most files stream_file() keeps memory mapped (see get_mapping())
+#
+MAX_MAPPINGS = 64
+
+# The memory mapped files. The key is (path, inode, mtime) so a file that
+# is modified or replaced gets a new mapping. '_mapping_order' is the keys
+# from oldest to newest.
+#
+_mappings = {}
+_mapping_order = []
+_mappings_lock = threading.Lock()
+
+# A Range header asking for more ranges than this (after overlapping ones
+# are merged) is ignored and the whole file is sent. Lots of tiny ranges
+# are a cheap way to make us do a lot of work.
+#
+MAX_RANGES = 64
+
+####################################################################
+#
+def xsendfile_backend(request, filename, content_type):
+    """
+    Have Apache's mod_xsendfile send the file.
+    """
+    response = HttpResponse('', content_type = str(content_type))
+    response['X-Sendfile'] = smart_str(filename)
+    return response
+
+####################################################################
+#
+def lighttpd_backend(request, filename, content_type):
+    """
+    Have lighttpd send the file.
+    """
+    response = HttpResponse('', content_type = str(content_type))
+    response['X-LIGHTTPD-send-file'] = smart_str(filename)
+    return response
+
+####################################################################
+#
+def nginx_location(filename):
+    """
+    Return the url of the nginx internal location that the given file can
+    be fetched through, from settings.SENDFILE_NGINX_LOCATIONS, or None if
+    the file is not under any of them.
+    """
+    for directory, location in getattr(settings, 'SENDFILE_NGINX_LOCATIONS',
+                                       ()):
+        directory = os.path.join(os.path.abspath(directory), '')
+        if filename.startswith(directory):
+            return location.rstrip('/') + '/' + \
+                   urlquote(filename[len(directory):])
+    return None
+
+####################################################################
+#
+def nginx_backend(request, filename, content_type):
+    """
+    Have nginx send the file. If the file is not under one of the
+    directories in settings.SENDFILE_NGINX_LOCATIONS nginx can not get at
+    it so we send it ourselves.
+    """
+    location = nginx_location(filename)
+    if location is None:
+        return None
+    response = HttpResponse('', content_type = str(content_type))
+    response['X-Accel-Redirect'] = location
+    return response
+
+# The values of settings.SENDFILE_BACKEND we know about. None means send the
+# file ourselves.
+#
+BACKENDS = {
+    'python'    : None,
+    'xsendfile' : xsendfile_backend,
+    'nginx'     : nginx_backend,
+    'lighttpd'  : lighttpd_backend,
+    }
+
+####################################################################
+#
+def get_backend():
+    """
+    Return the function for settings.SENDFILE_BACKEND, or None if we are
+    sending files ourselves.
+    """
+    backend = getattr(settings, 'SENDFILE_BACKEND', 'python')
+    if callable(backend):
+        return backend
+    if backend in BACKENDS:
+        return BACKENDS[backend]
+    module, attr = backend.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)
+
+####################################################################
+#
+def offload(request, filename, content_type):
+    """
+    If we have a backend that has the web server send files, return its
+    response for the given file. Otherwise return None.
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+    return backend(request, os.path.abspath(filename), content_type)
+
 ####################################################################
 #
 def handle_uploaded_file(f, destination):
@@ -30,13 +223,293 @@ def handle_uploaded_file(f, destination):
     - `f`: file like thing that lets us get an uploaded file in chunks.
     - `destination`: The name of the file we are going to write this data to.
     """
-    print "Writing file to: '%s'" % destination
+    print("Writing file to: '%s'" % destination)
     d = open(destination, 'wb+')
     for chunk in f.chunks():
         d.write(chunk)
     d.close()
     return
 
+#############################################################################
+#
+class RangeFile(object):
+    """
+    A file limited to the bytes from 'start' to 'end' (inclusive.) It is
+    what we give to the WSGI server's 'wsgi.file_wrapper'. The server can
+    use 'fileno()' and the file position (which we seek to 'start') with
+    the response's Content-Length to os.sendfile() just our range. Servers
+    that 'read()' it instead do not get past 'end'.
+
+    The file should be unbuffered. A buffered file's descriptor is not
+    necessarily at the position we seek to.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, filelike, start, end):
+        self.filelike = filelike
+        self.start = start
+        self.end = end
+        self.curr = start
+        self.on_close = None
+        self.filelike.seek(start, 0)
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def tell(self):
+        return self.curr
+
+    #########################################################################
+    #
+    def untouched(self):
+        """
+        True if nothing has read from the file since we seeked it to
+        'start'. Middleware that reads a response's content (ie: to make an
+        ETag) reads it through the same file descriptor. After that a
+        server that os.sendfile()'s from the descriptor's position would
+        send the wrong bytes, or none.
+        """
+        return self.curr == self.start and \
+               self.filelike.tell() == self.start
+
+    #########################################################################
+    #
+    def read(self, size = -1):
+        remaining = self.end - self.curr + 1
+        if remaining <= 0:
+            return ''
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.filelike.read(size)
+        self.curr += len(data)
+        return data
+
+    #########################################################################
+    #
+    def close(self):
+        """
+        Close the file, and the django response if SendfileWSGIHandler
+        gave it to us (so django's request_finished signal is sent.)
+        """
+        self.filelike.close()
+        if self.on_close is not None:
+            self.on_close()
+
+#############################################################################
+#
+def use_file_wrapper(request, response, filelike, start, end, blksize):
+    """
+    If the WSGI server has a 'wsgi.file_wrapper' note on the response the
+    part of 'filelike' from 'start' to 'end' it is sending so that
+    SendfileWSGIHandler (or a django whose handler looks for it) can give
+    it to the server's file wrapper instead of iterating over the response.
+    """
+    if 'wsgi.file_wrapper' not in request.META:
+        return
+    response.file_to_stream = RangeFile(filelike, start, end)
+    response.block_size = blksize
+    return
+
+#############################################################################
+#
+class AdaptiveBlockSize(object):
+    """
+    Picks the size of the next block to send based on how long the WSGI
+    server took to send the last one. A server asks for the next block when
+    it has written the last one to the client, so that is how fast the
+    client is taking them.
+
+    If it took less than 'fast' seconds we double the block size (up to
+    'maximum'), fewer, bigger blocks being cheaper for a fast client. If it
+    took more than 'slow' seconds we halve it (down to 'minimum') so we are
+    not holding big blocks in memory for a slow one.
+
+    Set settings.SENDFILE_ADAPTIVE_BLKSIZE to True to use one with these
+    defaults, or to your own AdaptiveBlockSize.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, minimum = 16384, maximum = 1048576, fast = 0.01,
+                 slow = 0.25):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fast = fast
+        self.slow = slow
+
+    #########################################################################
+    #
+    def next_size(self, blksize, elapsed):
+        if elapsed < self.fast:
+            return min(blksize * 2, self.maximum)
+        if elapsed > self.slow:
+            return max(blksize // 2, self.minimum)
+        return blksize
+
+#############################################################################
+#
+def get_adaptive_blksize():
+    """
+    The AdaptiveBlockSize from settings.SENDFILE_ADAPTIVE_BLKSIZE, or None
+    if block sizes are fixed.
+    """
+    adaptive = getattr(settings, 'SENDFILE_ADAPTIVE_BLKSIZE', False)
+    if adaptive is True:
+        return AdaptiveBlockSize()
+    if not adaptive:
+        return None
+    return adaptive
+
+#############################################################################
+#
+class InstrumentedWrapper(object):
+    """
+    Wraps the iterator over a file that send_file() and stream_file() send
+    (a StreamFileWrapper or the like) to count the bytes sent and time how
+    long sending them took. When the WSGI server closes it we send the
+    'file_sent' signal with what we found.
+
+    If we have an AdaptiveBlockSize it sets the block size ('blksize') of
+    the wrapped iterator before every block.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, wrapper, sender, request, filename, status,
+                 bytes_expected, adaptive = None):
+        self.wrapper = wrapper
+        self.iterator = iter(wrapper)
+        self.next_block = getattr(self.iterator, '__next__', None) or \
+                          self.iterator.next
+        self.sender = sender
+        self.request = request
+        self.filename = filename
+        self.status = status
+        self.bytes_expected = bytes_expected
+        self.adaptive = adaptive
+        self.bytes_sent = 0
+        self.started = time.time()
+        self.last = None
+        self.finished = False
+        self.reported = False
+        self.file_wrapper = False
+
+    def __iter__(self):
+        return self
+
+    #########################################################################
+    #
+    def next(self):
+        if self.adaptive is not None and self.last is not None:
+            self.wrapper.blksize = self.adaptive.next_size(self.wrapper.blksize,
+                                                           time.time() - \
+                                                           self.last)
+        try:
+            data = self.next_block()
+        except StopIteration:
+            self.finished = True
+            raise
+        self.bytes_sent += len(data)
+        self.last = time.time()
+        return data
+
+    __next__ = next
+
+    #########################################################################
+    #
+    def close(self):
+        if hasattr(self.wrapper, 'close'):
+            self.wrapper.close()
+        self.report()
+
+    #########################################################################
+    #
+    def report(self):
+        """
+        Send the 'file_sent' signal with how many bytes we sent and whether
+        that was all of them. Only the first call does anything.
+        """
+        if self.reported:
+            return
+        self.reported = True
+        if self.file_wrapper:
+            bytes_sent = None
+            aborted = None
+        else:
+            bytes_sent = self.bytes_sent
+            aborted = not self.finished and bytes_sent < self.bytes_expected
+        file_sent.send(sender = self.sender, request = self.request,
+                       filename = self.filename, status = self.status,
+                       ranged = self.status == 206,
+                       bytes_expected = self.bytes_expected,
+                       bytes_sent = bytes_sent,
+                       duration = time.time() - self.started,
+                       aborted = aborted)
+
+#############################################################################
+#
+def instrumented_response(wrapper, sender, request, filename, bytes_expected,
+                          content_type, status = 200):
+    """
+    Return an HttpResponse whose body is an InstrumentedWrapper around
+    'wrapper'. It is also the response's 'instrumented' attribute.
+    """
+    body = InstrumentedWrapper(wrapper, sender, request, filename, status,
+                               bytes_expected, get_adaptive_blksize())
+    response = HttpResponse(body, status = status, content_type = content_type)
+    response.instrumented = body
+    return response
+
+#############################################################################
+#
+def file_wrapper_usable(environ, response):
+    """
+    True if SendfileWSGIHandler can give the WSGI server the file that
+    'response' (from send_file() or stream_file()) is for, instead of the
+    response itself.
+
+    Not if the server has no 'wsgi.file_wrapper', and not if something
+    after us has changed the response or read from the file: its status
+    is no longer the 200 or 206 we made, it has a Content-Encoding (ie: it
+    was gzipped), or its content was read (see RangeFile.untouched())
+    """
+    filelike = getattr(response, 'file_to_stream', None)
+    if filelike is None or 'wsgi.file_wrapper' not in environ:
+        return False
+    if response.status_code not in (200, 206) or \
+           response.has_header('Content-Encoding'):
+        return False
+    stats = getattr(response, 'instrumented', None)
+    if stats is not None and (stats.last is not None or stats.finished):
+        return False
+    return filelike.untouched()
+
+#############################################################################
+#
+class SendfileWSGIHandler(WSGIHandler):
+    """
+    Django's WSGI handler, except that for responses from send_file() and
+    stream_file() it returns the WSGI server's 'wsgi.file_wrapper' around
+    the file so the server can os.sendfile() it.
+
+    If something changed the response or read its content after we made it
+    (see file_wrapper_usable()) the response is sent as usual.
+    """
+
+    #########################################################################
+    #
+    def __call__(self, environ, start_response):
+        response = WSGIHandler.__call__(self, environ, start_response)
+        if not file_wrapper_usable(environ, response):
+            return response
+        filelike = response.file_to_stream
+        filelike.on_close = response.close
+        stats = getattr(response, 'instrumented', None)
+        if stats is not None:
+            stats.file_wrapper = True
+        return environ['wsgi.file_wrapper'](filelike, response.block_size)
+
 #############################################################################
 #
 def send_file(request, filename, content_type='text/plain', blksize = 8192):
@@ -44,35 +517,227 @@ def send_file(request, filename, content_type='text/plain', blksize = 8192):
     Send a file through Django without loading the whole file into              
     memory at once. The FileWrapper will turn the file object into an           
     iterator for chunks of 8KB.                                                 
+
+    If we have a SENDFILE_BACKEND the web server sends the file instead.
+
+    If the client already has the current version of the file we send it a
+    304 (see not_modified()) without opening the file.
     """
-    wrapper = FileWrapper(file(filename), blksize = blksize)
-    response = HttpResponse(wrapper, content_type=content_type)
+    st = os.stat(filename)
+    response = not_modified(request, st)
+    if response is not None:
+        return response
+
+    response = offload(request, filename, content_type)
+    if response is None:
+        # Unbuffered, so that the position of the file descriptor is where
+        # we seek to (see RangeFile.) We only read it in big blocks anyways.
+        #
+        f = open(filename, 'rb', 0)
+        size = st.st_size
+        wrapper = FileWrapper(f, blksize = blksize)
+        response = instrumented_response(wrapper, send_file, request,
+                                         filename, size, content_type)
+        response['Content-Length'] = size
+        use_file_wrapper(request, response, f, 0, size - 1, blksize)
     response['Content-Disposition'] = 'attachment; filename=%s' % \
                                       os.path.basename(filename)
-    response['Content-Length'] = os.path.getsize(filename)
+    return set_validators(response, st)
+
+#############################################################################
+#
+def send_zipfile(request, members, archive_name = 'archive.zip',
+                 compression = zipfile.ZIP_DEFLATED, blksize = 65536,
+                 pool = None):
+    """
+    Send a ZIP archive of the given files, made as it is sent (see
+    asutils.zipstream) so that the download starts right away and nothing
+    is written to disk.
+
+    members: a list of file names, or of (file name, name in the archive)
+             pairs.
+
+    compression: zipfile.ZIP_STORED for files that are already compressed
+                 (video, images.) Then we also know the archive's size and
+                 send a Content-Length.
+
+    pool: a multiprocessing pool to deflate the members in, several at a
+          time (see asutils.zipstream.)
+    """
+    stream = zipstream.ZipStream(members, compression, blksize, pool = pool)
+    response = HttpResponse(iter(stream), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % \
+                                      archive_name
+    length = stream.length()
+    if length is not None:
+        response['Content-Length'] = length
     return response
 
 #############################################################################
 #
-def send_zipfile(request, filename):
-    """                                                                         
-    Create a ZIP file on disk and transmit it in chunks of 8KB,                 
-    without loading the whole file into memory. A similar approach can          
-    be used for large dynamic PDF files.                                        
-    """
-    temp = tempfile.TemporaryFile()
-    archive = zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED)
-    for index in range(10):
-        archive.write(filename, 'file%d.txt' % index)
-    archive.close()
-    wrapper = FileWrapper(temp)
-    response = HttpResponse(wrapper, content_type='application/zip')
-    response['Content-Disposition'] = 'attachment; filename=%s.zip' % \
-                                      os.path.basename(filename)
-    response['Content-Length'] = temp.tell()
-    temp.seek(0)
+def file_etag(st):
+    """
+    The ETag for a file, from the result of os.stat() on it. It changes if
+    the file is modified or replaced.
+    """
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime))
+
+#############################################################################
+#
+def set_validators(response, st):
+    """
+    Set the ETag and Last-Modified headers of a response for the file that
+    os.stat() gave us 'st' for.
+    """
+    response['ETag'] = file_etag(st)
+    response['Last-Modified'] = http_date(st.st_mtime)
     return response
 
+#############################################################################
+#
+def not_modified(request, st):
+    """
+    Returns a 304 response if the client's copy of the file that os.stat()
+    gave us 'st' for is current (its 'If-None-Match' has the file's ETag,
+    or failing that, the file has not been modified since the date in its
+    'If-Modified-Since'), otherwise None.
+
+    This only needs the os.stat() so we do it before opening the file.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_none_match is not None:
+        # If-None-Match compares weakly, and wins over If-Modified-Since
+        #
+        etag = file_etag(st)
+        etags = [x.startswith('W/') and x[2:] or x \
+                 for x in [y.strip() for y in if_none_match.split(',')]]
+        if '*' not in etags and etag not in etags:
+            return None
+    elif if_modified_since is not None:
+        try:
+            since = mktime_tz(parsedate_tz(if_modified_since.split(';')[0]))
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if int(st.st_mtime) > since:
+            return None
+    else:
+        return None
+
+    return set_validators(HttpResponseNotModified(), st)
+
+#############################################################################
+#
+def if_range_matches(request, etag, mtime):
+    """
+    True if the request has no 'If-Range' header or if the ETag or date in
+    it is that of the file (whose ETag is 'etag' and modification time is
+    'mtime'.) If it is not the client's copy of the file is out of date and
+    it must get all of it instead of the ranges it asked for.
+    """
+    value = request.META.get('HTTP_IF_RANGE')
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        # Weak ETags never match for ranges.
+        #
+        return value == etag
+    try:
+        return mktime_tz(parsedate_tz(value)) == int(mtime)
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+#############################################################################
+#
+def parse_range_header(header, size):
+    """
+    Parse the value of a 'Range' header for a file of 'size' bytes.
+
+    Returns a list of (start, end) (inclusive) byte positions, sorted with
+    overlapping and adjacent ranges merged. Ends past the end of the file
+    are cut down to it. Suffix ranges ('-500') are the last that many bytes
+    of the file.
+
+    Returns None if the header is not a byte range we understand (or asks
+    for more than MAX_RANGES ranges), in which case it should be ignored.
+    Returns an empty list if none of the ranges are in the file (ie: the
+    response should be a 416.)
+    """
+    if '=' not in header:
+        return None
+    units, specs = header.split('=', 1)
+    if units.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    found = False
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        match = range_spec_re.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        found = True
+
+        if not first:
+            # A suffix range. An empty suffix is not in the file.
+            #
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            start = max(size - length, 0)
+            end = size - 1
+        else:
+            start = int(first)
+            if last:
+                end = int(last)
+                if end < start:
+                    return None
+            else:
+                end = size - 1
+            if start >= size:
+                continue
+            end = min(end, size - 1)
+        ranges.append((start, end))
+
+    if not found:
+        return None
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+#############################################################################
+#
+def requested_ranges(request, st):
+    """
+    Work out from the 'Range' header what bits and bytes of the file that
+    os.stat() gave us 'st' for to send to the client.
+
+    Returns None if they want the entire file (there is no 'Range' header,
+    it is for a different version of the file, or we ignore it), an empty
+    list if the response should be a 416 and otherwise the list of ranges
+    (see parse_range_header())
+    """
+    if 'HTTP_RANGE' not in request.META or \
+           not if_range_matches(request, file_etag(st), st.st_mtime):
+        return None
+    return parse_range_header(request.META['HTTP_RANGE'], st.st_size)
+
 #############################################################################
 #
 class StreamFileWrapper(FileWrapper):
@@ -92,7 +757,7 @@ class StreamFileWrapper(FileWrapper):
         Call our parent's initialize. Then set our start/end/curr pointers and
         seek the file to that position.
         """
-        if start > end:
+        if start > end + 1:
             raise NameError("request end must be greater or equal to start. Start: %d, end: %d" % (start, end))
         
         FileWrapper.__init__(self, filelike, blksize)
@@ -115,7 +780,7 @@ class StreamFileWrapper(FileWrapper):
 
         NOTE: This will advance self.curr.
         """
-        if self.curr >= self.end:
+        if self.curr > self.end:
             return None
 
         data = self.filelike.read(min(self.blksize, (self.end - self.curr) + 1))
@@ -140,57 +805,272 @@ class StreamFileWrapper(FileWrapper):
         if data:
             return data
         raise StopIteration
+
+    # What python 3 (and wsgiref's FileWrapper there) calls 'next()'
+    #
+    __next__ = next
     
 #############################################################################
 #
-def stream_file(request, filename, content_type):
+def get_mapping(filename, st):
+    """
+    Return a read only memory map of the file that os.stat() gave us 'st'
+    for. We keep the last MAX_MAPPINGS files we mapped (keyed by path,
+    inode and modification time) so repeated requests for a hot file (ie:
+    a video people are seeking around in) share one mapping, and the pages
+    of the file in the page cache, instead of each of them reading it.
+
+    We never close a mapping ourselves, even when it is dropped from the
+    cache, as responses may still be sending from it. It goes away when the
+    last of them is done with it.
+
+    NOTE: Truncating a file while it is mapped makes reading the part that
+          went away crash the process (SIGBUS.) Only map files that are
+          replaced, not rewritten, when they change.
+
+    Returns None for an empty file (which can not be mapped.)
+    """
+    if st.st_size == 0:
+        return None
+    path = os.path.abspath(filename)
+    key = (path, st.st_ino, st.st_mtime)
+    _mappings_lock.acquire()
+    try:
+        mapping = _mappings.get(key)
+        if mapping is not None:
+            return mapping
+
+        f = open(filename, 'rb')
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        # Forget the mappings of older versions of the file, and the oldest
+        # mappings if we have too many.
+        #
+        for old in [x for x in _mapping_order if x[0] == path]:
+            _mapping_order.remove(old)
+            del _mappings[old]
+        _mappings[key] = mapping
+        _mapping_order.append(key)
+        while len(_mapping_order) > MAX_MAPPINGS:
+            del _mappings[_mapping_order.pop(0)]
+        return mapping
+    finally:
+        _mappings_lock.release()
+
+#############################################################################
+#
+class MmapFileWrapper(object):
+    """
+    Like StreamFileWrapper but the bytes from 'start' to 'end' (inclusive)
+    come from a memory map of the file (see get_mapping()) instead of a
+    read() of the file for every block.
+
+    NOTE: Each block is still a copy of that part of the map. Django turns
+          whatever a response's iterator gives it in to a string before it
+          is sent, so handing it a buffer or memoryview of the map would
+          not save the copy. What the map saves is a system call per block
+          and, for a file many requests are sending at once, having its
+          pages in memory once.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, mapping, start, end, blksize = 131072):
+        self.mapping = mapping
+        self.start = start
+        self.curr = start
+        self.end = end
+        self.blksize = blksize
+
+    def __iter__(self):
+        return self
+
+    #########################################################################
+    #
+    def next(self):
+        if self.curr > self.end:
+            raise StopIteration
+        length = min(self.blksize, self.end - self.curr + 1)
+        data = self.mapping[self.curr:self.curr + length]
+        self.curr += length
+        return data
+
+    __next__ = next
+
+    #########################################################################
+    #
+    def close(self):
+        # The mapping is shared, we just stop using it.
+        #
+        self.mapping = None
+
+#############################################################################
+#
+class MultipartRangeWrapper(object):
+    """
+    The body of a 'multipart/byteranges' response: for each of 'ranges' a
+    part with its Content-Type and Content-Range headers followed by that
+    range of the file, read as the response is sent (or sliced from
+    'mapping', a memory map of the file, if we are given one.)
+    """
+
+    #########################################################################
+    #
+    def __init__(self, filelike, ranges, size, content_type, blksize = 131072,
+                 mapping = None):
+        self.filelike = filelike
+        self.mapping = mapping
+        self.ranges = ranges
+        self.size = size
+        self.content_type = content_type
+        self.blksize = blksize
+        self.boundary = '%032x' % random.getrandbits(128)
+
+    #########################################################################
+    #
+    def part_header(self, start, end):
+        return ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: '
+                'bytes %d-%d/%d\r\n\r\n' % (self.boundary, self.content_type,
+                                             start, end,
+                                             self.size)).encode('ascii')
+
+    #########################################################################
+    #
+    def trailer(self):
+        return ('\r\n--%s--\r\n' % self.boundary).encode('ascii')
+
+    #########################################################################
+    #
+    def length(self):
+        """
+        The length of the whole body, for the Content-Length header.
+        """
+        length = len(self.trailer())
+        for start, end in self.ranges:
+            length += len(self.part_header(start, end)) + end - start + 1
+        return length
+
+    #########################################################################
+    #
+    def __iter__(self):
+        for start, end in self.ranges:
+            yield self.part_header(start, end)
+            if self.mapping is not None:
+                wrapper = MmapFileWrapper(self.mapping, start, end,
+                                          self.blksize)
+            else:
+                wrapper = StreamFileWrapper(self.filelike, start, end,
+                                            self.blksize)
+            for data in wrapper:
+                yield data
+        yield self.trailer()
+
+    #########################################################################
+    #
+    def close(self):
+        if self.filelike is not None:
+            self.filelike.close()
+
+#############################################################################
+#
+def stream_file(request, filename, content_type, use_mmap = None):
     """
     This method is used to stream media files and the like to a
     client. Basically this is used to honor partial and range fetches.
 
+    We handle range requests as RFC 7233 says: several ranges in one
+    request (sent back as a 'multipart/byteranges' response), suffix ranges
+    ('bytes=-500' is the last 500 bytes), 416 if none of the ranges are in
+    the file and 'If-Range' (if the file changed since the client got the
+    ETag or date it gives us we send the whole file.) A Range header we can
+    not make sense of is ignored.
+
+    Like send_file() we send a 304 if the client's copy is current.
+
+    If 'use_mmap' is True (or it is None and settings.SENDFILE_MMAP is True)
+    the file is sent from a memory map of it shared with other requests for
+    the same file (see get_mapping()) This is good for files that get lots
+    of range requests. It is not used with the WSGI server's file wrapper.
+
     NOTE: Since clients can stream really large files (HD movies, for instance,
     will well over 4gb for 1080p) it is extremely questionable to have this
     being passed through a django instance. Perhaps we should have a C program
     that does the actual streaming and have the media server redirect to it.
+
+    That is what a SENDFILE_BACKEND does. If we have one the web server
+    sends the file, and handles the range, instead of us.
     """
 
-    size = os.path.getsize(filename)
-    
-    # Pull out of the 'http_range' header the information for what bits and
-    # bytes to send to the client. If no 'http_range' header exists, then
-    # they want the entire range.
-    #
-    if request.META.has_key('HTTP_RANGE'):
-        search = http_range_re.search(request.META['HTTP_RANGE'])
-        if search.group('start'):
-            fstart = int(search.group('start'))
-        else:
-            fstart = 0
-            
-        if search.group('end'):
-            fend = int(search.group('end'))
-        else:
-            fend = size - 1
-    else:
-        fstart = 0
-        fend = size - 1
+    st = os.stat(filename)
+    response = not_modified(request, st)
+    if response is not None:
+        return response
 
-    num_bytes = fend - fstart + 1;
+    response = offload(request, filename, content_type)
+    if response is not None:
+        return set_validators(response, st)
 
-    wrapper = StreamFileWrapper(file(filename), fstart, fend)
+    size = st.st_size
+    ranges = requested_ranges(request, st)
 
-    # If the number of bytes we need to send equals the file size
-    # then we can send back a complete response. Otherwise
-    # we need to send babck a partial content response.
-    #
-    if num_bytes == size:
-        response = HttpResponse(wrapper, content_type = str(content_type))
-        response['Content-Length'] = str(size)
-        response['Accept-Ranges'] = 'bytes'
-    else:
-        response = HttpResponse(wrapper, status = 206,
+    if ranges is not None and len(ranges) == 0:
+        response = HttpResponse('', status = 416,
                                 content_type = str(content_type))
-        response['Content-Range'] = 'bytes %d-%d/%d' % (fstart, fend, size)
+        response['Content-Range'] = 'bytes */%d' % size
+        response['Accept-Ranges'] = 'bytes'
+        return set_validators(response, st)
+
+    if use_mmap is None:
+        use_mmap = getattr(settings, 'SENDFILE_MMAP', False)
+    mapping = None
+    if use_mmap:
+        mapping = get_mapping(filename, st)
+
+    if not ranges or len(ranges) == 1:
+        if ranges:
+            fstart, fend = ranges[0]
+        else:
+            fstart, fend = 0, size - 1
+        num_bytes = fend - fstart + 1
+
+        if mapping is not None:
+            wrapper = MmapFileWrapper(mapping, fstart, fend)
+        else:
+            f = open(filename, 'rb', 0)
+            wrapper = StreamFileWrapper(f, fstart, fend)
+
+        # If the number of bytes we need to send equals the file size
+        # then we can send back a complete response. Otherwise
+        # we need to send back a partial content response.
+        #
+        if num_bytes == size:
+            response = instrumented_response(wrapper, stream_file, request,
+                                             filename, num_bytes,
+                                             str(content_type))
+        else:
+            response = instrumented_response(wrapper, stream_file, request,
+                                             filename, num_bytes,
+                                             str(content_type), status = 206)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (fstart, fend, size)
         response['Content-Length'] = str(num_bytes)
-            
-    return response
+        if mapping is None:
+            use_file_wrapper(request, response, f, fstart, fend,
+                             wrapper.blksize)
+    else:
+        if mapping is not None:
+            f = None
+        else:
+            f = open(filename, 'rb', 0)
+        wrapper = MultipartRangeWrapper(f, ranges, size, str(content_type),
+                                        mapping = mapping)
+        response = instrumented_response(wrapper, stream_file, request,
+                                         filename, wrapper.length(),
+                                         'multipart/byteranges; boundary=%s' % \
+                                         wrapper.boundary, status = 206)
+        response['Content-Length'] = str(wrapper.length())
+
+    response['Accept-Ranges'] = 'bytes'
+    return set_validators(response, st)
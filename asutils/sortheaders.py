@@ -10,11 +10,60 @@ The source for this came from djangosnippets.org:
   
 """
 
+import base64
 
+from django.db import models
+from django.db.models import Q
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.utils import simplejson
 
 ORDER_VAR = 'o'
 ORDER_TYPE_VAR = 'ot'
 
+# The query parameters holding a keyset pagination cursor. 'after' is the
+# cursor of the last object on the previous page when paging forward,
+# 'before' is the cursor of the first object on the next page when paging
+# backwards.
+#
+CURSOR_AFTER_VAR = 'after'
+CURSOR_BEFORE_VAR = 'before'
+
+def cursor_signer():
+    """
+    The signer for keyset pagination cursors. See SortHeaders.make_cursor()
+    """
+    return signing.Signer(salt = 'asutils.sortheaders.cursor')
+
+class KeysetPage(object):
+    """
+    One page of objects from ``SortHeaders.get_keyset_page``.
+
+    object_list
+        The objects on this page, in sort order.
+
+    has_next, has_previous
+        Whether there is a page after/before this one.
+
+    next_cursor, previous_cursor
+        The values for the ``after``/``before`` query parameters that
+        fetch the next and previous pages (``None`` if there is no
+        such page.)
+    """
+    def __init__(self, object_list, has_next, has_previous,
+                 next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
 class SortHeaders:
     """
     Handles generation of an argument for the Django ORM's
@@ -81,6 +130,7 @@ class SortHeaders:
                 pass # Use the default
         if ORDER_TYPE_VAR in params and params[ORDER_TYPE_VAR] in ('asc', 'desc'):
             self.order_type = params[ORDER_TYPE_VAR]
+        self.params = params
 
     def headers(self):
         """
@@ -120,3 +170,211 @@ class SortHeaders:
             self.order_type == 'desc' and '-' or '',
             self.header_defs[self.order_field][1],
         )
+
+    def get_order_by_list(self):
+        """
+        Like ``get_order_by`` but returns a list of ordering criteria
+        that ends with the primary key (in the same direction) so that
+        objects with the same value for the sort field always come out
+        in the same order. Keyset pagination needs this.
+        """
+        criterion = self.header_defs[self.order_field][1]
+        prefix = self.order_type == 'desc' and '-' or ''
+        if criterion in ('pk', 'id'):
+            return ['%s%s' % (prefix, criterion)]
+        return ['%s%s' % (prefix, criterion), '%spk' % prefix]
+
+    def sort_field(self, model):
+        """
+        Returns the tuple (field, nullable) for the current sort criterion
+        on the given model. 'field' is the model field at the end of the
+        criterion (ie: the 'name' field of the model 'author' refers to for
+        ``author__name``) and 'nullable' is True if the sort value of an
+        object can be NULL, because that field or any relationship on the
+        way to it is nullable.
+
+        A criterion that ends in a relationship (ie: ``author``) sorts by
+        the primary key it refers to, so that is the field we return.
+        """
+        criterion = self.header_defs[self.order_field][1]
+        opts = model._meta
+        nullable = False
+        f = None
+        for name in criterion.split('__'):
+            if name == 'pk':
+                f = opts.pk
+            else:
+                f = opts.get_field(name)
+            nullable = nullable or f.null
+            if f.rel is not None:
+                opts = f.rel.to._meta
+                f = f.rel.get_related_field()
+        return f, nullable
+
+    def sort_value(self, obj):
+        """
+        The value of the current sort field for the given object. The
+        sort criterion may span relationships, ie: ``author__name``.
+        """
+        value = obj
+        for name in self.header_defs[self.order_field][1].split('__'):
+            if value is None:
+                break
+            value = getattr(value, name)
+        if isinstance(value, models.Model):
+            value = value.pk
+        return value
+
+    def make_cursor(self, obj):
+        """
+        Returns an opaque string encoding the given object's value for
+        the current sort field and its primary key. Handing it back as
+        ``after`` (or ``before``) fetches the objects following (or
+        preceding) that object in the current sort order.
+
+        The cursor is signed (with ``SECRET_KEY``) and records the sort
+        field it was made for, so ``parse_cursor`` only has to deal with
+        cursors we made for this sort.
+        """
+        value = self.sort_value(obj)
+        if value is not None and \
+           not isinstance(value, (bool, int, long, float, basestring)):
+            value = unicode(value)
+        data = simplejson.dumps([self.header_defs[self.order_field][1],
+                                 value, obj.pk])
+        data = base64.urlsafe_b64encode(data).rstrip('=')
+        return cursor_signer().sign(data)
+
+    def parse_cursor(self, cursor, model):
+        """
+        The reverse of ``make_cursor``. Returns the tuple (sort value,
+        primary key), converted by the ``to_python`` of the sort field and
+        primary key of ``model``, or ``None`` if the cursor is not one of
+        ours, is for a different sort field or its values can not be
+        converted. A sort value of ``None`` means the object's sort value
+        is NULL.
+        """
+        try:
+            data = str(cursor_signer().unsign(str(cursor)))
+            data = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+            criterion, value, pk = simplejson.loads(data)
+        except (signing.BadSignature, TypeError, ValueError, UnicodeError):
+            return None
+        if criterion != self.header_defs[self.order_field][1]:
+            return None
+
+        field, nullable = self.sort_field(model)
+        try:
+            pk = model._meta.pk.to_python(pk)
+            if value is not None:
+                value = field.to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            return None
+        if pk is None or (value is None and not nullable):
+            return None
+        return value, pk
+
+    def keyset_segments(self, queryset):
+        """
+        The parts of ``queryset`` that ``get_keyset_page`` pages through,
+        in the current sort order, as a list of (nulls, query set,
+        ordering) tuples where 'nulls' is True for the part whose sort
+        value is NULL.
+
+        Where databases put NULLs in an ``ORDER BY`` varies so if the sort
+        value can be NULL we do it ourselves: the objects with a sort value
+        in sort order, followed by those without one in primary key order
+        (the other way around when sorting in descending order.)
+        """
+        field, nullable = self.sort_field(queryset.model)
+        order_by = self.get_order_by_list()
+        if not nullable:
+            return [(False, queryset, order_by)]
+
+        criterion = self.header_defs[self.order_field][1]
+        segments = [(False, queryset.filter(**{'%s__isnull' % criterion:
+                                                False}), order_by),
+                    (True, queryset.filter(**{'%s__isnull' % criterion:
+                                               True}), order_by[-1:])]
+        if self.order_type == 'desc':
+            segments.reverse()
+        return segments
+
+    def get_keyset_page(self, queryset, per_page):
+        """
+        Returns a ``KeysetPage`` of up to ``per_page`` objects from
+        ``queryset``, sorted by ``get_order_by_list``, starting after
+        (or ending before) the cursor in the request's ``after``
+        (``before``) query parameter.
+
+        Unlike OFFSET based pages this filters on the sort value and
+        primary key of the object at the edge of the previous page, so
+        fetching a page deep in to a large sorted listing costs the same
+        as fetching the first one (given an index on the sort field.)
+
+        A cursor that is not valid (see ``parse_cursor``) is ignored and
+        we return the first page.
+
+        If the sort value can be NULL the objects without one come after
+        the others (see ``keyset_segments``.) A page that spans the two
+        takes a query for each.
+        """
+        criterion = self.header_defs[self.order_field][1]
+
+        cursor = None
+        backwards = False
+        if CURSOR_BEFORE_VAR in self.params:
+            cursor = self.parse_cursor(self.params[CURSOR_BEFORE_VAR],
+                                       queryset.model)
+            backwards = cursor is not None
+        if cursor is None and CURSOR_AFTER_VAR in self.params:
+            cursor = self.parse_cursor(self.params[CURSOR_AFTER_VAR],
+                                       queryset.model)
+
+        segments = self.keyset_segments(queryset)
+        if backwards:
+            # Walk backwards from the cursor and put the page back in
+            # order once we have it.
+            #
+            segments = [(nulls, qs, [x.startswith('-') and x[1:] or '-' + x \
+                                     for x in order_by]) \
+                        for nulls, qs, order_by in reversed(segments)]
+
+        if cursor is not None:
+            # Skip the parts before the one the cursor is in and only take
+            # the objects after the cursor from that one.
+            #
+            value, pk = cursor
+            while segments[0][0] != (value is None):
+                segments.pop(0)
+            nulls, qs, order_by = segments[0]
+            op = order_by[0].startswith('-') and 'lt' or 'gt'
+            if nulls or criterion in ('pk', 'id'):
+                qs = qs.filter(**{'pk__%s' % op: pk})
+            else:
+                qs = qs.filter(Q(**{'%s__%s' % (criterion, op): value}) |
+                               Q(**{criterion: value, 'pk__%s' % op: pk}))
+            segments[0] = (nulls, qs, order_by)
+
+        objects = []
+        for nulls, qs, order_by in segments:
+            wanted = per_page + 1 - len(objects)
+            objects.extend(qs.order_by(*order_by)[:wanted])
+            if len(objects) > per_page:
+                break
+        more = len(objects) > per_page
+        objects = objects[:per_page]
+        if backwards:
+            objects.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = cursor is not None, more
+
+        next_cursor = previous_cursor = None
+        if objects:
+            if has_next:
+                next_cursor = self.make_cursor(objects[-1])
+            if has_previous:
+                previous_cursor = self.make_cursor(objects[0])
+        return KeysetPage(objects, has_next, has_previous,
+                          next_cursor, previous_cursor)
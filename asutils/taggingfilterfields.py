@@ -20,14 +20,141 @@ This is in its own module to separate out the dependency on the
 
 # Django imports
 #
+from django.db import connection
+from django.db.models.query import EmptyQuerySet
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+
+# EmptyResultSet moved in django 1.11
+#
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
 
 # 3rd party django imports
 #
 import tagging.managers
+import tagging.models
+import tagging.settings
 
 # asutils imports
 #
 import filterfields
+import querycache
+import tagindex
+
+# The query parameters that edit the 'tag_any' and 'tag_all' parameters.
+# See TaggingFilterFields.augment_request()
+#
+TAG_EDIT_PARAMS = ('add_tag_any', 'add_tag_all', 'del_tag_any', 'del_tag_all')
+
+############################################################################
+#
+def merge_tags(existing, add, remove):
+    """
+    Given three comma separated strings of tags return the list of tags in
+    'existing' followed by the tags in 'add', without any of the tags in
+    'remove'. Each tag appears once, in the order it was first seen, and
+    empty tags are dropped.
+    """
+    removed = set(remove.split(','))
+    seen = set()
+    tags = []
+    for tag in existing.split(',') + add.split(','):
+        if tag and tag not in seen and tag not in removed:
+            seen.add(tag)
+            tags.append(tag)
+    return tags
+
+# The most tags a 'tags' expression may have.
+#
+MAX_EXPRESSION_TAGS = 100
+
+############################################################################
+#
+def parse_tag_expression(value):
+    """
+    Parse a tag expression given as the 'tags' query parameter.
+
+    The expression is a comma separated list of terms that must all be
+    true. A term is a tag, a set of tags separated by '|' of which an
+    object must have at least one, or a tag preceded by '-' that an object
+    must not have. ie: 'a,b|c,-d' matches the objects tagged 'a' and either
+    'b' or 'c' but not 'd'.
+
+    Returns a tuple of (groups, excluded) where 'groups' is a list of lists
+    of tags (an object must have a tag from every one of them) and
+    'excluded' is the list of tags an object must not have.
+
+    Raises filterfields.FilterValueError if the expression is malformed.
+    """
+    groups = []
+    excluded = []
+    count = 0
+    for term in value.split(','):
+        term = term.strip()
+        if not term:
+            continue
+        if tagging.settings.FORCE_LOWERCASE_TAGS:
+            term = term.lower()
+        if term.startswith('-'):
+            tag = term[1:].strip()
+            if not tag or '|' in tag or tag.startswith('-'):
+                raise filterfields.FilterValueError("tags: bad exclusion %r" % \
+                                                    term)
+            excluded.append(tag)
+            count += 1
+        else:
+            group = [x.strip() for x in term.split('|')]
+            if [x for x in group if not x or x.startswith('-')]:
+                raise filterfields.FilterValueError("tags: bad term %r" % term)
+            groups.append(group)
+            count += len(group)
+        if count > MAX_EXPRESSION_TAGS:
+            raise filterfields.FilterValueError("tags: more than %d tags" % \
+                                                MAX_EXPRESSION_TAGS)
+    return groups, excluded
+
+# The ModelTaggedItemManager found for each model (or None if it does not
+# have one.) The key is the model. See find_tagged_manager()
+#
+_tagged_managers = {}
+
+############################################################################
+#
+def find_tagged_manager(model):
+    """
+    Look for an instance of ModelTaggedItemManager in the attributes of the
+    given model and return it, or None if there is not one.
+
+    NOTE: We stop at the first one we find.
+
+    Going through every attribute of a model is not cheap (and getting some
+    of them can do work) so we remember what we found for each model and
+    only look the first time we are asked.
+    """
+    try:
+        return _tagged_managers[model]
+    except KeyError:
+        pass
+
+    tagged = None
+    for field_name in dir(model):
+        try:
+            attr = getattr(model, field_name)
+        except AttributeError:
+            # Getting attribute errors while examing the model
+            # are okay.. just skip over those. This means that they
+            # did not match anyways.
+            #
+            continue
+        if isinstance(attr, tagging.managers.ModelTaggedItemManager):
+            tagged = attr
+            break
+
+    _tagged_managers[model] = tagged
+    return tagged
 
 ############################################################################
 #
@@ -37,8 +164,8 @@ class TaggingFilterFields(filterfields.FilterFields):
 
     When instantiated it will see if the model it is being
     instantiated with has any fields that are instances of
-    tagging.managers.ModelTaggedItemManager. If it does it will record
-    that field.
+    tagging.managers.ModelTaggedItemManager (or use the one it is given.)
+    If it does it will record that field.
 
     When building the query set for that model based on the HTTP
     REQUEST it was created with, it will look for 'tag_any' and
@@ -47,37 +174,35 @@ class TaggingFilterFields(filterfields.FilterFields):
     of the tags provided or all ('tag_all') of the tag provided in the request.
 
     The request can not use both 'tag_any' and 'tag_all'.
+
+    A 'tags' request parameter with a tag expression (ie: 'a,b|c,-d', see
+    parse_tag_expression()) may be given as well, on its own or along
+    with 'tag_any' or 'tag_all'.
     """
 
     ########################################################################
     #
-    def __init__(self, request, model, field_names):
+    def __init__(self, request, model, field_names, tagged = None):
+        """
+        tagged: The ModelTaggedItemManager to filter tags with, or the name
+                of the attribute of the model that it is. If not given we
+                look for one on the model (see 'find_tagged_manager()')
+        """
 
         # First do the initialization in our parent class.
         #
         super(TaggingFilterFields, self).__init__(request, model, field_names)
 
-        # and now look for an instance of ModelTaggedItemManager
-        # in the attributes of the model we were passed. If we find
-        # it record it so we can use it later.
-        #
-        # NOTE: We stop at the first one we find.
-        #
         self.tags_all = None
         self.tags_any = None
-        self.tagged = None
-        for field_name in dir(model):
-            try:
-                if isinstance(getattr(model,field_name),
-                              tagging.managers.ModelTaggedItemManager):
-                    self.tagged = getattr(model,field_name)
-                    break
-            except AttributeError:
-                # Getting attribute errors while examing the model
-                # are okay.. just skip over those. This means that they
-                # did not match anyways.
-                #
-                pass
+        self.tag_groups = None
+        self.tags_excluded = None
+        if tagged is None:
+            self.tagged = find_tagged_manager(model)
+        elif isinstance(tagged, basestring):
+            self.tagged = getattr(model, tagged)
+        else:
+            self.tagged = tagged
 
         # Process the GET parameters to see if the user is trying to
         # change their filter down by adding new tags to use in a
@@ -111,62 +236,242 @@ class TaggingFilterFields(filterfields.FilterFields):
 
         This processing is done after 'add_tag_any' and 'add_tag_all'
 
-        XXX We do not check for the user trying to use 'add_tag_any' and
-            'add_tag_all' at the same time. We basiclly check 'add_tag_any'
-            first, and if that fails we look for 'add_tag_all'.
+        All of 'add_tag_any', 'add_tag_all', 'del_tag_any' and 'del_tag_all'
+        are applied if more than one of them is given. The tags keep the
+        order they were given in (existing tags first, then added ones) so
+        the same request always produces the same query string.
 
         NOTE: This will create a new GET QueryDict, and set it on the
               request object. ie: this basically re-writes the
               parameters as if the user had simply specified the
               additional tag on 'tag_any' or 'tag_all'.
         """
+        get = self.request.GET
 
-        if self.request.GET.has_key('add_tag_any'):
-            new_tags = self.request.GET['add_tag_any'].split(',')
-            if self.request.GET.has_key('tag_any'):
-                new_tags.extend(self.request.GET['tag_any'].split(','))
-            new_get = self.request.GET.copy()
-            del new_get['add_tag_any']
-
-            # the set(new_tags)) is to remove any duplicated tags.
-            #
-            new_get['tag_any'] = ','.join(set(new_tags))
-            self.request.GET = new_get
-            return
-        
-        elif self.request.GET.has_key('add_tag_all'):
-            new_tags = self.request.GET['add_tag_all'].split(',')
-            if self.request.GET.has_key('tag_all'):
-                new_tags.extend(self.request.GET['tag_all'].split(','))
-            new_get = self.request.GET.copy()
-            del new_get['add_tag_all']
-            new_get['tag_all'] = ','.join(set(new_tags))
-            self.request.GET = new_get
-            return
-        
-        # Look for tags to remove from our filter.
+        # Nothing to do unless one of our edit parameters is present, in
+        # which case we will only copy the GET QueryDict once.
         #
-        if self.request.GET.has_key('del_tag_any'):
-            del_tags = set(self.request.GET['del_tag_any'].split(','))
-            if self.request.GET.has_key('tag_any'):
-                new_get = self.request.GET.copy()
-                del new_get['del_tag_any']
-                new_tags = set(self.request.GET['tag_any'].split(','))
-                new_get['tag_any'] = ','.join(new_tags - del_tags)
-                self.request.GET = new_get
+        edits = [x for x in TAG_EDIT_PARAMS if x in get]
+        if not edits:
             return
 
-        elif self.request.GET.has_key('del_tag_all'):
-            del_tags = set(self.request.GET['del_tag_all'].split(','))
-            if self.request.GET.has_key('tag_all'):
-                new_get = self.request.GET.copy()
-                del new_get['del_tag_all']
-                new_tags = set(self.request.GET['tag_all'].split(','))
-                new_get['tag_all'] = ','.join(new_tags - del_tags)
-                self.request.GET = new_get
-            return
+        new_get = get.copy()
+        for param in edits:
+            del new_get[param]
+
+        for param in ('tag_any', 'tag_all'):
+            add_param, del_param = 'add_' + param, 'del_' + param
+            if add_param not in get and param not in get:
+                # Deleting tags from a filter that is not there changes
+                # nothing.
+                #
+                continue
+            if add_param not in get and del_param not in get:
+                continue
+            new_get[param] = ','.join(merge_tags(get.get(param, ''),
+                                                 get.get(add_param, ''),
+                                                 get.get(del_param, '')))
+        self.request.GET = new_get
         return
             
+    ########################################################################
+    #
+    def cache_models(self):
+        """
+        Tagging or untagging an object changes what our tag filters return
+        without saving the object, so TaggedItem changes matter too.
+        """
+        models = super(TaggingFilterFields, self).cache_models()
+        if self.tagged is not None:
+            models.append(tagging.models.TaggedItem)
+        return models
+
+    ########################################################################
+    #
+    def filter_key_params(self):
+        """
+        Our filter also depends on the 'tag_any' or 'tag_all' query
+        parameter. The tags are sorted so that the order they were given in
+        does not matter.
+        """
+        params = super(TaggingFilterFields, self).filter_key_params()
+        if self.tagged is not None:
+            for param in ('tag_any', 'tag_all'):
+                if self.request.GET.get(param):
+                    tags = sorted(set(self.request.GET[param].split(',')))
+                    params.append((param, tags))
+                    break
+            if self.request.GET.get('tags'):
+                groups, excluded = parse_tag_expression(self.request.GET['tags'])
+                params.append(('tags', (sorted(sorted(set(x)) for x in groups),
+                                        sorted(set(excluded)))))
+        return params
+
+    ########################################################################
+    #
+    def facet_counts(self, limit = None, cached = False, timeout = None,
+                     queryset = None):
+        """
+        Return the tags of the objects in our filtered query set, most
+        used first, as a list of Tag objects each with a 'count' attribute
+        that is the number of those objects that have it (like
+        Tag.objects.usage_for_model(counts = True) does.)
+
+        This is a single aggregate query over the TaggedItem table with the
+        SQL of our filtered query set as a sub-query. We build it ourselves
+        (like django-tagging's usage_for_queryset() does) because our query
+        set may have 'extra()' clauses that refer to the model's table by
+        name, which break when django nests the query set and renames its
+        tables.
+
+        limit: return only this many of the most used tags.
+
+        cached: if True the result is cached in django's cache under
+                'cache_key()' for 'timeout' seconds (the cache's default if
+                None.) Tagging, untagging, saving or deleting an object
+                makes the cached result stale.
+
+        queryset: our filtered query set if you already have it.
+
+        If we have no tagged item manager, or our filtered query set can not
+        have anything in it, there are no tags to count and we return an
+        empty list.
+        """
+        if self.tagged is None:
+            return []
+
+        if cached:
+            key = self.cache_key('facets', limit)
+            tags = cache.get(key)
+            if tags is not None:
+                return tags
+
+        if queryset is None:
+            queryset = self.get_query_set()
+        tags = self.count_tags(queryset, limit)
+
+        if cached:
+            cache.set(key, tags, timeout)
+        return tags
+
+    ########################################################################
+    #
+    def count_tags(self, queryset, limit = None):
+        """
+        The query that facet_counts() does, on the given query set.
+        """
+        # The SQL of a query set from 'none()' has no WHERE clause at all,
+        # so using it as a sub-query would count the tags of every object.
+        # A filter that can match nothing (ie: 'pk__in' an empty list, which
+        # a tag index gives us for tags no object has) raises
+        # EmptyResultSet when we ask for its SQL.
+        #
+        if isinstance(queryset, EmptyQuerySet):
+            return []
+        try:
+            subquery, params = querycache.query_sql(queryset.order_by() \
+                                                    .values_list('pk'))
+        except EmptyResultSet:
+            return []
+
+        ct = ContentType.objects.get_for_model(self.model)
+        qn = connection.ops.quote_name
+        tag = tagging.models.Tag._meta
+        sql = """
+        SELECT %(tag)s.%(tag_pk)s, %(tag)s.%(name)s, COUNT(*)
+        FROM %(tag)s, %(tagged_item)s
+        WHERE %(tagged_item)s.tag_id = %(tag)s.%(tag_pk)s
+          AND %(tagged_item)s.content_type_id = %%s
+          AND %(tagged_item)s.object_id IN (%(subquery)s)
+        GROUP BY %(tag)s.%(tag_pk)s, %(tag)s.%(name)s
+        ORDER BY 3 DESC, %(tag)s.%(name)s""" % {
+            'tag' : qn(tag.db_table),
+            'tag_pk' : qn(tag.pk.column),
+            'name' : qn('name'),
+            'tagged_item' : qn(tagging.models.TaggedItem._meta.db_table),
+            'subquery' : subquery,
+            }
+        if limit is not None:
+            sql += " LIMIT %d" % int(limit)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, [ct.pk] + list(params))
+        tags = []
+        for tag_id, name, count in cursor.fetchall():
+            t = tagging.models.Tag(id = tag_id, name = name)
+            t.count = count
+            tags.append(t)
+        return tags
+
+    ########################################################################
+    #
+    def filter_tag_expression(self, queryset, groups, excluded):
+        """
+        Filter the given query set down to the objects that have a tag from
+        every one of 'groups' and none of the tags in 'excluded' (see
+        parse_tag_expression())
+
+        If there is a tag index for our model the ids are worked out from
+        it with a single query for the ids of the tags. Otherwise every
+        group becomes a sub-query on the TaggedItem table and all of the
+        excluded tags one 'NOT EXISTS' sub-query, so the whole expression
+        is still a single query.
+        """
+        index = tagindex.get_index(self.model)
+        if index is not None:
+            names = set(excluded)
+            for group in groups:
+                names.update(group)
+            tag_ids = dict(tagging.models.Tag.objects \
+                           .filter(name__in = list(names)) \
+                           .values_list('name', 'id'))
+            ids = None
+            for group in groups:
+                group_ids = set()
+                for tag in group:
+                    if tag in tag_ids:
+                        group_ids.update(index.object_ids(tag_ids[tag]))
+                if ids is None:
+                    ids = group_ids
+                else:
+                    ids.intersection_update(group_ids)
+            if ids is not None:
+                for tag in excluded:
+                    if tag in tag_ids:
+                        ids.difference_update(index.object_ids(tag_ids[tag]))
+                return queryset.filter(pk__in = sorted(ids))
+            for tag in excluded:
+                if tag in tag_ids:
+                    queryset = queryset.exclude(pk__in = \
+                                    list(index.object_ids(tag_ids[tag])))
+            return queryset
+
+        ct = ContentType.objects.get_for_model(self.model)
+        for group in groups:
+            queryset = queryset.filter(pk__in = tagging.models.TaggedItem \
+                                       .objects.filter(content_type = ct,
+                                                       tag__name__in = group) \
+                                       .values('object_id'))
+        if excluded:
+            qn = connection.ops.quote_name
+            queryset = queryset.extra(where = [
+                "NOT EXISTS (SELECT 1 FROM %(tagged_item)s asutils_ti "
+                "WHERE asutils_ti.content_type_id = %%s "
+                "AND asutils_ti.object_id = %(model)s.%(pk)s "
+                "AND asutils_ti.tag_id IN "
+                "(SELECT %(tag)s.%(tag_pk)s FROM %(tag)s "
+                "WHERE %(tag)s.%(name)s IN (%(names)s)))" % {
+                    'tagged_item' : qn(tagging.models.TaggedItem._meta.db_table),
+                    'model' : qn(self.model._meta.db_table),
+                    'pk' : qn(self.model._meta.pk.column),
+                    'tag' : qn(tagging.models.Tag._meta.db_table),
+                    'tag_pk' : qn(tagging.models.Tag._meta.pk.column),
+                    'name' : qn('name'),
+                    'names' : ','.join(['%s'] * len(excluded)),
+                    }],
+                params = [ct.pk] + list(excluded))
+        return queryset
+
     ########################################################################
     #
     def get_query_set(self):
@@ -176,11 +481,14 @@ class TaggingFilterFields(filterfields.FilterFields):
         'tag_any' or 'tag_all' in our HTTP REQUEST object, further
         filter the query set we got from our parent class instance by
         calling 'with_all' or 'with_any' methods on our
-        TaggedItemManager.
+        TaggedItemManager (or on the model's tag index if it has one, see
+        asutils.tagindex)
 
         NOTE: This has the side affect that it sets up the instance
               variable 'self.tags_any' or 'self.tags_all' with a list
-              of strings that are the tags being filtered on.
+              of strings that are the tags being filtered on (and
+              'self.tag_groups' and 'self.tags_excluded' for a 'tags'
+              expression.)
         """
 
         orig_queryset = filterfields.FilterFields.get_query_set(self)
@@ -190,14 +498,33 @@ class TaggingFilterFields(filterfields.FilterFields):
         if self.tagged is None:
             return orig_queryset
 
+        # A tag expression is applied first. Any 'tag_any' or 'tag_all'
+        # filter further narrows what it matches.
+        #
+        if self.request.GET.get('tags'):
+            groups, excluded = parse_tag_expression(self.request.GET['tags'])
+            if groups or excluded:
+                self.tag_groups = groups
+                self.tags_excluded = excluded
+                orig_queryset = self.filter_tag_expression(orig_queryset,
+                                                           groups, excluded)
+
         # We have a tagged item manager.. see if the user is asking for
         # filtering based on tags.
         #
+        # If there is a tag index for our model we let it work out the ids
+        # of the objects with the tags instead of going to the database.
+        #
+        index = tagindex.get_index(self.model)
+
         if self.request.GET.has_key('tag_any'):
             self.tags_any = self.request.GET['tag_any'].split(',')
             if len(self.tags_any) == 0 or len(self.request.GET['tag_any']) ==0:
                 self.tags_any = None
                 return orig_queryset
+            if index is not None:
+                return index.filter(orig_queryset,
+                                    any = self.request.GET['tag_any'])
             return self.tagged.with_any(self.request.GET['tag_any'],
                                         orig_queryset)
         elif self.request.GET.has_key('tag_all'):
@@ -205,6 +532,9 @@ class TaggingFilterFields(filterfields.FilterFields):
             if len(self.tags_all) == 0 or len(self.request.GET['tag_all']) ==0:
                 self.tags_all = None
                 return orig_queryset
+            if index is not None:
+                return index.filter(orig_queryset,
+                                    all = self.request.GET['tag_all'])
             return self.tagged.with_all(self.request.GET['tag_all'],
                                         orig_queryset)
         else:
@@ -0,0 +1,261 @@
+#
+# File: $Id$
+#
+"""
+An index of which objects have which tags, kept in django's cache, so that
+filtering by tags is done with set operations in memory instead of the
+GROUP BY/HAVING queries over the TaggedItem table that django-tagging's
+'with_any' and 'with_all' do.
+
+For every (content type, tag) we keep the sorted ids of the objects with
+that tag as an array of integers (which pickles to something much smaller
+than a list.) The set for a tag is read from the TaggedItem table the first
+time it is asked for. Every (content type, tag) has a generation (see
+asutils.querycache) that is part of the set's cache key and is bumped
+whenever an object is tagged with or untagged from that tag, so the set is
+read again the next time.
+
+The result of combining the sets is applied to a query set as a 'pk__in'
+(and, for excluded tags, an 'exclude(pk__in)') filter. This works best
+when the tags being filtered on are on a modest number of objects. Some
+databases (ie: sqlite) limit how many values can be given to 'IN'.
+
+To use it register the model whose tags you want indexed:
+
+    from asutils import tagindex
+    tagindex.register(Video)
+
+TaggingFilterFields will use the index for a model if there is one.
+
+This is in its own module to separate out the dependency on the
+'django tagging' app written by James Bennett.
+"""
+
+# System imports
+#
+from array import array
+
+# Django imports
+#
+from django.core.cache import cache
+from django.db.models import signals
+from django.contrib.contenttypes.models import ContentType
+
+# 3rd party django imports
+#
+from tagging.models import TaggedItem
+from tagging.utils import get_tag_list
+
+# asutils imports
+#
+from asutils import querycache
+
+# The registered tag indexes. The key is the model.
+#
+_indexes = {}
+
+# Whether we are listening for TaggedItem saves and deletes yet.
+#
+_connected = False
+
+#############################################################################
+#
+def tag_generation_key(content_type_id, tag_id):
+    """
+    The cache key for the generation of the set of objects of the given
+    content type that have the given tag.
+    """
+    return "asutils.tagindex.gen.%d.%d" % (content_type_id, tag_id)
+
+#############################################################################
+#
+def tag_key(content_type_id, tag_id, generation):
+    """
+    The cache key for the ids of the objects of the given content type that
+    have the given tag, as of the given generation.
+    """
+    return "asutils.tagindex.%d.%d.%d" % (content_type_id, tag_id, generation)
+
+#############################################################################
+#
+def _tagged_item_changed(sender, instance, **kwargs):
+    """
+    An object was tagged or untagged. Start a new generation for that tag
+    so its set is read again the next time it is needed.
+
+    Deleting the cached set instead would not be enough. Someone who read
+    the set from the database just before the change could put it back in
+    the cache just after we deleted it. With a new generation they put it
+    under the old generation's key, which is never asked for again.
+    """
+    querycache.bump_key_generation(tag_generation_key(instance.content_type_id,
+                                                      instance.tag_id))
+
+#############################################################################
+#
+class TagIndex(object):
+    """
+    The tag index for one model.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, model, timeout = None):
+        """
+        model: the model whose objects' tags we are indexing.
+
+        timeout: how long to keep the set for a tag in the cache. The
+                 cache's default if not given.
+        """
+        self.model = model
+        self.timeout = timeout
+
+    #########################################################################
+    #
+    def content_type(self):
+        return ContentType.objects.get_for_model(self.model)
+
+    #########################################################################
+    #
+    def tag_ids(self, tags):
+        """
+        The ids of the given tags (a comma separated string or a list of
+        names, anything tagging.utils.get_tag_list() accepts.) Tags that do
+        not exist are left out.
+        """
+        return [tag.pk for tag in get_tag_list(tags)]
+
+    #########################################################################
+    #
+    def object_ids(self, tag_id):
+        """
+        The sorted ids of the objects of our model that have the tag with
+        the given id, as an array of integers.
+        """
+        ct = self.content_type()
+        generation = querycache.key_generation(tag_generation_key(ct.pk,
+                                                                  tag_id))
+        key = tag_key(ct.pk, tag_id, generation)
+        ids = cache.get(key)
+        if ids is None:
+            ids = array('l', TaggedItem.objects.filter(content_type = ct,
+                                                       tag = tag_id) \
+                                               .order_by('object_id') \
+                                               .values_list('object_id',
+                                                            flat = True))
+            cache.set(key, ids, self.timeout)
+        return ids
+
+    #########################################################################
+    #
+    def with_any(self, tags):
+        """
+        The set of ids of the objects that have any of the given tags.
+        """
+        ids = set()
+        for tag_id in self.tag_ids(tags):
+            ids.update(self.object_ids(tag_id))
+        return ids
+
+    #########################################################################
+    #
+    def with_all(self, tags):
+        """
+        The set of ids of the objects that have all of the given tags. Like
+        django-tagging's 'with_all' tags that do not exist are ignored.
+        """
+        tag_ids = self.tag_ids(tags)
+        if not tag_ids:
+            return set()
+
+        # Start with the smallest set so that every intersection after it
+        # is as cheap as possible.
+        #
+        sets = sorted([self.object_ids(x) for x in tag_ids], key = len)
+        ids = set(sets[0])
+        for other in sets[1:]:
+            if not ids:
+                break
+            ids.intersection_update(other)
+        return ids
+
+    #########################################################################
+    #
+    def matching(self, any = None, all = None, exclude = None):
+        """
+        Combine the objects with 'any' of some tags, 'all' of some tags and
+        none of the 'exclude' tags.
+
+        Returns a tuple of (ids, excluded). 'ids' is the set of ids the
+        objects must be in, or None if neither 'any' nor 'all' was given.
+        'excluded' is the set of ids the objects must not be in.
+        """
+        ids = None
+        if any:
+            ids = self.with_any(any)
+        if all:
+            if ids is None:
+                ids = self.with_all(all)
+            elif ids:
+                ids.intersection_update(self.with_all(all))
+
+        excluded = set()
+        if exclude:
+            excluded = self.with_any(exclude)
+            if ids is not None:
+                ids.difference_update(excluded)
+                excluded = set()
+        return ids, excluded
+
+    #########################################################################
+    #
+    def filter(self, queryset, any = None, all = None, exclude = None):
+        """
+        Filter the given query set of our model down to the objects with
+        'any' of some tags, 'all' of some tags and none of the 'exclude'
+        tags. See 'matching()'
+        """
+        ids, excluded = self.matching(any, all, exclude)
+        if ids is not None:
+            queryset = queryset.filter(pk__in = sorted(ids))
+        if excluded:
+            queryset = queryset.exclude(pk__in = sorted(excluded))
+        return queryset
+
+#############################################################################
+#
+def register(model, timeout = None):
+    """
+    Start using a tag index for the given model.
+
+    Registering a model again replaces its previous tag index.
+
+    Returns the TagIndex.
+    """
+    global _connected
+    if not _connected:
+        signals.post_save.connect(_tagged_item_changed, sender = TaggedItem,
+                                  weak = False)
+        signals.post_delete.connect(_tagged_item_changed, sender = TaggedItem,
+                                    weak = False)
+        _connected = True
+    index = TagIndex(model, timeout)
+    _indexes[model] = index
+    return index
+
+#############################################################################
+#
+def unregister(model):
+    """
+    Stop using the tag index for the given model (if it has one.)
+    """
+    _indexes.pop(model, None)
+    return
+
+#############################################################################
+#
+def get_index(model):
+    """
+    Return the TagIndex registered for the given model, or None.
+    """
+    return _indexes.get(model)
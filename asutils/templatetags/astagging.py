@@ -9,12 +9,98 @@ some templating utilities for use in how I use the django-tagging application.
 #
 import django.utils.dateformat
 from django import template
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.contrib.contenttypes.models import ContentType
+
+# 3rd party django imports
+#
+from tagging.models import TaggedItem
+from tagging.fields import TagField
+from tagging.utils import edit_string_for_tags
 
 #
 # This is a template library
 #
 register = template.Library()
 
+#############################################################################
+#
+def prefetched_attr(tag_field):
+    """
+    The name of the attribute prefetch_tags() puts the tags for 'tag_field'
+    on an object under.
+    """
+    return '_%s_prefetched_tags' % tag_field
+
+#############################################################################
+#
+def prefetch_tags(objects, tag_field):
+    """
+    Fetch the tags of all of the given objects with one query and attach
+    them to the objects, so that rendering 'tags_for_object' for each of
+    them (ie: on a list page) does not do a query per object.
+
+    The objects may be of different models. The query asks for the tagged
+    items of each content type's objects at once and gets their tags with
+    them.
+
+    Each object gets the list of its Tag objects (sorted by name) as the
+    attribute 'prefetched_attr(tag_field)' which 'tags_for_object' uses.
+    If 'tag_field' is a TagField we also fill in its cache so that
+    getattr(object, tag_field) does not go to the database.
+
+    Returns the objects as a list.
+    """
+    objects = list(objects)
+    by_type = {}
+    for obj in objects:
+        setattr(obj, prefetched_attr(tag_field), [])
+        ct = ContentType.objects.get_for_model(obj)
+        by_type.setdefault(ct.pk, {}).setdefault(obj.pk, []).append(obj)
+    if not by_type:
+        return objects
+
+    q = None
+    for ct_id, objs in by_type.items():
+        ct_q = Q(content_type = ct_id, object_id__in = objs.keys())
+        if q is None:
+            q = ct_q
+        else:
+            q = q | ct_q
+
+    for item in TaggedItem.objects.filter(q).select_related('tag'):
+        for obj in by_type[item.content_type_id].get(item.object_id, ()):
+            getattr(obj, prefetched_attr(tag_field)).append(item.tag)
+
+    for obj in objects:
+        tags = getattr(obj, prefetched_attr(tag_field))
+        tags.sort(key = lambda x: x.name)
+        try:
+            field = obj._meta.get_field(tag_field)
+        except FieldDoesNotExist:
+            field = None
+        if isinstance(field, TagField):
+            field._set_instance_tag_cache(obj, edit_string_for_tags(tags))
+    return objects
+
+#############################################################################
+#
+@register.simple_tag
+def prefetch_object_tags(objects, tag_field):
+    """
+    A template tag that calls prefetch_tags() for the given objects, ie:
+
+       {% prefetch_object_tags object_list 'tags' %}
+       {% for foo in object_list %}
+         {% tags_for_object foo 'tags' %}
+       {% endfor %}
+
+    It renders nothing.
+    """
+    prefetch_tags(objects, tag_field)
+    return ''
+
 #############################################################################
 #
 @register.inclusion_tag("astagging/tags_for_object.html")
@@ -52,9 +138,15 @@ def tags_for_object(object, tag_field):
     absolute url's to views that will add and remove a tag from
     foo. The tag to be added or removed is past as the 'tag' field of
     a form as a string via POST to those url's.
+
+    If the tags of the object were fetched by prefetch_tags() we use those
+    instead of asking the object for them.
     """
 
+    tags = getattr(object, prefetched_attr(tag_field), None)
+    if tags is None:
+        tags = getattr(object, tag_field)
     return {
         'object' : object,
-        'tags'   : getattr(object, tag_field)
+        'tags'   : tags
         }
@@ -160,14 +160,16 @@ def table_header(context, headers):
     # we need to pull out of the query string we generate the GET parameters
     # that are set by the SortHeaders class.
     #
+    # A keyset pagination cursor only makes sense for the sort order it
+    # was made for so those go too.
+    #
     ORDER_VAR = 'o'
     ORDER_TYPE_VAR = 'ot'
 
     get = context['request'].GET.copy()
-    if ORDER_VAR in get:
-        del get[ORDER_VAR]
-    if ORDER_TYPE_VAR in get:
-        del get[ORDER_TYPE_VAR]
+    for var in (ORDER_VAR, ORDER_TYPE_VAR, 'after', 'before'):
+        if var in get:
+            del get[var]
 
     return { 'headers': headers,
              'query'  : get.urlencode(), }
@@ -177,17 +179,40 @@ def table_header(context, headers):
 # This code was gotten from: http://code.djangoproject.com/wiki/PaginatorTag
 #
 @register.inclusion_tag("asutils/paginator.html", takes_context=True)
-def paginator(context, adjacent_pages=5):
+def paginator(context, adjacent_pages=5, hits=None):
     """
     Adds pagination context variables for first, adjacent and next page
     links in addition to those already populated by the object_list generic
     view.
+
+    If 'hits' is given it is used as the number of objects being paginated
+    instead of the 'hits' in the context, and the number of pages and
+    next/previous links are worked out from it. This lets you use a count
+    from FilterFields.count() (which may be cached or an estimate) ie:
+
+        {% paginator 5 filter_count %}
     """
+    if hits is None:
+        hits = context["hits"]
+        pages = context["pages"]
+        next = context["next"]
+        previous = context["previous"]
+        has_next = context["has_next"]
+        has_previous = context["has_previous"]
+    else:
+        hits = int(hits)
+        per_page = context["results_per_page"]
+        pages = max(1, int(math.ceil(hits / float(per_page))))
+        has_next = context["page"] < pages
+        has_previous = context["page"] > 1
+        next = has_next and context["page"] + 1 or None
+        previous = has_previous and context["page"] - 1 or None
+
     page_numbers = \
                  [n for n in \
                   range(context["page"] - adjacent_pages, context["page"] + \
                         adjacent_pages + 1) \
-                  if n > 0 and n <= context["pages"]]
+                  if n > 0 and n <= pages]
 
     # If the page/context we are rendering was a GET with query
     # parameters, then pass that in to our template so that we can
@@ -214,18 +239,49 @@ def paginator(context, adjacent_pages=5):
         query = None
 
     return {
-        "hits": context["hits"],
+        "hits": hits,
         "query" : query,
         "results_per_page": context["results_per_page"],
         "page": context["page"],
-        "pages": context["pages"],
+        "pages": pages,
         "page_numbers": page_numbers,
-        "next": context["next"],
-        "previous": context["previous"],
-        "has_next": context["has_next"],
-        "has_previous": context["has_previous"],
+        "next": next,
+        "previous": previous,
+        "has_next": has_next,
+        "has_previous": has_previous,
         "show_first": 1 not in page_numbers,
-        "show_last": context["pages"] not in page_numbers,
+        "show_last": pages not in page_numbers,
+    }
+
+#############################################################################
+#
+@register.inclusion_tag("asutils/keyset_paginator.html", takes_context=True)
+def keyset_paginator(context, page):
+    """
+    The keyset pagination companion to the 'paginator' tag. 'page' is a
+    KeysetPage from SortHeaders.get_keyset_page() and instead of page
+    numbers we render first/previous/next links that carry the cursor of
+    the object at the edge of this page.
+
+       {% keyset_paginator page %}
+
+    Like the 'paginator' tag the rest of the GET query parameters (sorting,
+    filtering) are preserved, but the old cursor parameters are dropped.
+    """
+    query = None
+    if 'request' in context and context["request"].method == "GET":
+        copy = context["request"].GET.copy()
+        for var in ('after', 'before', 'page'):
+            if var in copy:
+                del copy[var]
+        query = copy.urlencode() or None
+
+    return {
+        "query": query,
+        "has_next": page.has_next,
+        "has_previous": page.has_previous,
+        "next_cursor": page.next_cursor,
+        "previous_cursor": page.previous_cursor,
     }
 
 #
@@ -0,0 +1,346 @@
+#
+# File: $Id$
+#
+"""
+A simple inverted index for searching the text in a model's fields, and a
+FilterSpec so that FilterFields can use it.
+
+Searching several text columns with 'icontains' means the database has to
+scan every row of the table. Instead we break the text of the fields we
+want to search in to tokens and keep, for every token, the ids of the
+objects that have it (the 'postings' for that token.) A search is then a
+lookup of the postings for each token in the query.
+
+The postings are kept in the TextIndexPosting table and are updated
+whenever an object of an indexed model is saved or deleted. That model is
+in this app, not in asutils, so add 'asutils.textindex' (and
+'django.contrib.contenttypes') to INSTALLED_APPS and run syncdb to create
+its table.
+
+Only models whose primary key is a positive integer can be indexed.
+
+To use it register the model and the fields you want to search:
+
+    from asutils import textindex
+    textindex.register(Video, ('title', 'description'))
+
+and include the name of the index ('q' by default) in the field names
+you give to FilterFields:
+
+    FilterFields(request, Video, ('title', 'length', 'q'))
+
+A request with '?q=cheese toast' will then be filtered to the videos
+that have both 'cheese' and 'toast' in their title or description.
+
+If you register a model that already has objects you need to call
+'reindex()' on the TextIndex once to index them.
+"""
+
+# System imports
+#
+import re
+
+# Django imports
+#
+from django.db import transaction, IntegrityError
+from django.db.models import signals, Count
+from django.contrib.contenttypes.models import ContentType
+
+# asutils imports
+#
+from asutils import filterfields
+from asutils.textindex.models import TextIndexPosting
+
+# 'atomic' is new in django 1.6. Before that commit_on_success is the
+# closest thing.
+#
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    atomic = transaction.commit_on_success
+
+# Tokens are runs of letters and digits. We lower case everything so
+# searches are case insensitive.
+#
+token_re = re.compile(r'\w+', re.UNICODE)
+
+# Tokens longer than this are dropped. It is the max_length of
+# TextIndexPosting.token
+#
+MAX_TOKEN_LENGTH = 64
+
+# The most different tokens a search may have, so that a query string with
+# thousands of words can not make us read the postings for all of them.
+#
+MAX_SEARCH_TOKENS = 32
+
+# The registered text indexes. The key is the model.
+#
+_indexes = {}
+
+# The kinds of primary key whose values fit in TextIndexPosting.object_id
+#
+INTEGER_PK_TYPES = ('AutoField', 'IntegerField', 'PositiveIntegerField',
+                    'SmallIntegerField', 'PositiveSmallIntegerField')
+
+#############################################################################
+#
+def tokenize(text, min_length = 2):
+    """
+    Break the given text up in to the tokens we index. Tokens are lower
+    cased and tokens shorter than 'min_length' or longer than
+    MAX_TOKEN_LENGTH are dropped.
+    """
+    if not text:
+        return []
+    return [x for x in token_re.findall(unicode(text).lower()) \
+            if min_length <= len(x) <= MAX_TOKEN_LENGTH]
+
+#############################################################################
+#
+class TextIndex(object):
+    """
+    The inverted index for the text in some of the fields of a model.
+
+    This also stands in for a model field as far as FilterFields is
+    concerned (see filterfields.add_pseudo_field()) which is why it has a
+    'name', 'verbose_name' and 'rel'.
+    """
+
+    rel = None
+
+    #########################################################################
+    #
+    def __init__(self, model, field_names, name = 'q', min_length = 2):
+        """
+        model: the model whose objects we are indexing.
+
+        field_names: the names of the fields of the model whose text we index.
+
+        name: the name of the query parameter used to search the index.
+
+        min_length: tokens shorter than this are not indexed or searched for.
+        """
+        self.model = model
+        self.field_names = tuple(field_names)
+        self.name = name
+        self.verbose_name = "search"
+        self.min_length = min_length
+
+    #########################################################################
+    #
+    def content_type(self):
+        """
+        The content type of our model. Django caches these so this does
+        not go to the database after the first time.
+        """
+        return ContentType.objects.get_for_model(self.model)
+
+    #########################################################################
+    #
+    def tokens(self, instance):
+        """
+        Return the set of tokens in the indexed fields of the given object.
+        """
+        tokens = set()
+        for field_name in self.field_names:
+            tokens.update(tokenize(getattr(instance, field_name),
+                                   self.min_length))
+        return tokens
+
+    #########################################################################
+    #
+    def update(self, instance):
+        """
+        Bring the postings for the given object up to date. We only touch
+        the postings for tokens that were added or removed since the last
+        time the object was indexed, and the new ones are inserted in one
+        query.
+
+        This is done in a transaction. If the same object is being saved
+        somewhere else at the same time we may both try to add the same
+        posting. Whoever loses gets an IntegrityError, so we try again
+        (once) with the postings the other one added.
+        """
+        tokens = self.tokens(instance)
+        try:
+            self._update(instance, tokens)
+        except IntegrityError:
+            self._update(instance, tokens)
+        return
+
+    #########################################################################
+    #
+    def _update(self, instance, tokens):
+        ct = self.content_type()
+        postings = TextIndexPosting.objects.filter(content_type = ct,
+                                                   object_id = instance.pk)
+        with atomic():
+            existing = set(postings.values_list('token', flat = True))
+            stale = existing - tokens
+            if stale:
+                postings.filter(token__in = list(stale)).delete()
+            TextIndexPosting.objects.bulk_create(
+                [TextIndexPosting(content_type = ct, token = token,
+                                  object_id = instance.pk) \
+                 for token in sorted(tokens - existing)])
+        return
+
+    #########################################################################
+    #
+    def remove(self, instance):
+        """
+        Remove all of the postings for the given object.
+        """
+        TextIndexPosting.objects.filter(content_type = self.content_type(),
+                                        object_id = instance.pk).delete()
+        return
+
+    #########################################################################
+    #
+    def reindex(self):
+        """
+        Index every object of our model. Postings for objects that no longer
+        exist are thrown away.
+        """
+        TextIndexPosting.objects.filter(content_type = self.content_type()) \
+                                .exclude(object_id__in = \
+                                         self.model._default_manager.values('pk')) \
+                                .delete()
+        for instance in self.model._default_manager.all():
+            self.update(instance)
+        return
+
+    #########################################################################
+    #
+    def search(self, query):
+        """
+        Return a query set of the ids of the objects that have every token
+        in the given query. This is meant to be used as the value of a
+        'pk__in' filter so the whole search happens in the database as one
+        sub-query over the postings.
+
+        If the query has no tokens every object matches. If it has more
+        than MAX_SEARCH_TOKENS different tokens we raise FilterValueError.
+        """
+        tokens = list(set(tokenize(query, self.min_length)))
+        if not tokens:
+            return self.model._default_manager.values('pk')
+        if len(tokens) > MAX_SEARCH_TOKENS:
+            raise filterfields.FilterValueError("more than %d words" % \
+                                                MAX_SEARCH_TOKENS)
+
+        # The postings for any of the tokens, grouped by object. Postings
+        # are unique so an object has every token if its group has one row
+        # for each of them.
+        #
+        return TextIndexPosting.objects \
+                               .filter(content_type = self.content_type(),
+                                       token__in = tokens) \
+                               .values('object_id') \
+                               .annotate(matched = Count('id')) \
+                               .filter(matched = len(tokens)) \
+                               .values('object_id')
+
+    #########################################################################
+    #
+    def post_save(self, sender, instance, **kwargs):
+        self.update(instance)
+
+    #########################################################################
+    #
+    def post_delete(self, sender, instance, **kwargs):
+        self.remove(instance)
+
+#############################################################################
+#
+def register(model, field_names, name = 'q', min_length = 2):
+    """
+    Start maintaining a text index for the given fields of 'model' and make
+    it available to FilterFields as a field named 'name'.
+
+    Registering a model again replaces its previous text index.
+
+    Raises ValueError if the model's primary key is not an integer (see
+    INTEGER_PK_TYPES.)
+
+    Returns the TextIndex.
+    """
+    pk = model._meta.pk
+    while pk.rel is not None:
+        # A primary key that is a relation (ie: a OneToOneField for multi
+        # table inheritance) has the values of the primary key it refers to.
+        #
+        pk = pk.rel.to._meta.pk
+    if pk.get_internal_type() not in INTEGER_PK_TYPES:
+        raise ValueError("Can not index %s, asutils.textindex only supports "
+                         "integer primary keys" % model._meta.object_name)
+
+    unregister(model)
+    index = TextIndex(model, field_names, name, min_length)
+    _indexes[model] = index
+    signals.post_save.connect(index.post_save, sender = model, weak = False)
+    signals.post_delete.connect(index.post_delete, sender = model,
+                                weak = False)
+    filterfields.add_pseudo_field(model, index)
+    return index
+
+#############################################################################
+#
+def unregister(model):
+    """
+    Stop maintaining the text index for the given model (if it has one.)
+    The postings already in the index are left alone.
+    """
+    index = _indexes.pop(model, None)
+    if index is None:
+        return
+    signals.post_save.disconnect(index.post_save, sender = model,
+                                 weak = False)
+    signals.post_delete.disconnect(index.post_delete, sender = model,
+                                   weak = False)
+    filterfields.remove_pseudo_field(model, index)
+    return
+
+#############################################################################
+#
+def get_index(model):
+    """
+    Return the TextIndex registered for the given model, or None.
+    """
+    return _indexes.get(model)
+
+############################################################################
+#
+class TextSearchFilterSpec(filterfields.FilterSpec):
+    """
+    A FilterSpec for a TextIndex. Unlike the filter specs for model fields
+    the query parameter is just the name of the index, ie: '?q=cheese toast'
+    and it is turned in to a 'pk__in' filter on the ids of the objects that
+    have all of the tokens in the query.
+    """
+
+    field_lookups = { 'search' : 'pk__in' }
+
+    ########################################################################
+    #
+    def __init__(self, f, model, field_path = None):
+        super(TextSearchFilterSpec, self).__init__(f, model, field_path)
+
+        # Our query parameter is the name of the index on its own.
+        #
+        if 'search' in self.lookup_map:
+            self.query_params = { self.field_path : 'search' }
+
+    ########################################################################
+    #
+    def field_lookup(self, param):
+        return self.lookup_map['search']
+
+    ########################################################################
+    #
+    def field_value(self, value, field_lookup = None):
+        return self.field.search(value)
+
+filterfields.FilterSpec.register(lambda f: isinstance(f, TextIndex),
+                                 TextSearchFilterSpec)
@@ -0,0 +1,43 @@
+#
+# File: $Id$
+#
+"""
+The model for asutils.textindex. It is an app of its own so that only
+projects that use the text index need its table (and
+django.contrib.contenttypes.) Add 'asutils.textindex' to INSTALLED_APPS
+and run syncdb to create it.
+"""
+
+# Django imports
+#
+from django.db import models
+from django.contrib.contenttypes.models import ContentType
+
+#############################################################################
+#
+class TextIndexPosting(models.Model):
+    """
+    One entry in the inverted index maintained by asutils.textindex: the
+    object with id 'object_id' of the model given by 'content_type' has the
+    token 'token' in one of its indexed fields.
+
+    All of the postings for a token are the rows with that content type and
+    token. The unique index on (content_type, token, object_id) keeps them
+    sorted by object id so looking up a token is an index range scan.
+
+    'object_id' is an integer so only models with integer primary keys can
+    be indexed (see asutils.textindex.register())
+    """
+    content_type = models.ForeignKey(ContentType)
+    token = models.CharField(max_length = 64)
+    object_id = models.PositiveIntegerField()
+
+    class Meta:
+        # This table was 'asutils_textindexposting' when the model was part
+        # of the asutils app. Keep the name so existing indexes still work.
+        #
+        db_table = 'asutils_textindexposting'
+        unique_together = (('content_type', 'token', 'object_id'),)
+
+    def __unicode__(self):
+        return u"%s: %s %d" % (self.token, self.content_type, self.object_id)
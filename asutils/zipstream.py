@@ -0,0 +1,395 @@
+#
+# File: $Id$
+#
+"""
+Write a ZIP archive of some files as a stream of strings, compressing each
+file as it is read, so an archive can be sent to a client as it is made
+instead of being written to a temporary file first (see
+sendfile.send_zipfile())
+
+Since we send the start of each member before we know its CRC or how big
+it compressed to, every member's local header has the 'data descriptor'
+flag set and the CRC and sizes follow the member's data. Members (or
+archives) too big for the 32 bit fields in a ZIP file get ZIP64 extra
+fields and a ZIP64 end of central directory record.
+
+Members can be deflated or STORED (for files like video and images that
+are already compressed and do not get any smaller.) If every member is
+stored we know how big the archive will be before we start and 'length()'
+says so.
+
+Deflating is most of the work of making an archive. If you give ZipStream a
+pool (a multiprocessing.pool.ThreadPool, or a multiprocessing.Pool) the
+members are deflated in it, several at a time, while we send the ones before
+them. zlib lets go of the GIL while it compresses so a thread pool uses all
+of the cores. The archive is still sent in order. Make the pool once and
+share it, ie:
+
+    from multiprocessing.pool import ThreadPool
+    zip_pool = ThreadPool(4)
+    ...
+    return send_zipfile(request, files, pool = zip_pool)
+
+A member deflated in the pool is held in memory until it is sent, so files
+bigger than 'max_pooled_size' are deflated as they are sent instead.
+"""
+
+# System imports
+#
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+# Where the 32 bit fields of a ZIP file run out. 0xffffffff (and 0xffff
+# for the number of entries) means 'look in the ZIP64 fields' so a value
+# equal to the limit needs ZIP64 too, just like one past it.
+#
+ZIP64_LIMIT = 0xffffffff
+ZIP_MAX_ENTRIES = 0xffff
+
+# Signatures
+#
+LOCAL_HEADER_SIG = 0x04034b50
+DATA_DESCRIPTOR_SIG = 0x08074b50
+CENTRAL_DIR_SIG = 0x02014b50
+END_OF_CENTRAL_DIR_SIG = 0x06054b50
+ZIP64_END_OF_CENTRAL_DIR_SIG = 0x06064b50
+ZIP64_LOCATOR_SIG = 0x07064b50
+ZIP64_EXTRA_ID = 0x0001
+
+# General purpose flag bits
+#
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+#############################################################################
+#
+def dos_date_time(mtime):
+    """
+    The (date, time) of the given time in seconds since the epoch the way
+    a ZIP file wants them. ZIP files can not have dates before 1980.
+    """
+    t = time.localtime(mtime)
+    if t[0] < 1980:
+        return (1 << 5) | 1, 0
+    return (((t[0] - 1980) << 9) | (t[1] << 5) | t[2],
+            (t[3] << 11) | (t[4] << 5) | (t[5] // 2))
+
+#############################################################################
+#
+def compress_file(filename, level = 6, blksize = 65536):
+    """
+    Deflate a whole file (for ZipStream's pool.) Returns a tuple of the
+    deflated data, the file's CRC and its size.
+
+    This is a module level function so that a multiprocessing.Pool can
+    pickle it.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    chunks = []
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(blksize)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc) & 0xffffffff
+            size += len(data)
+            chunks.append(compressor.compress(data))
+    finally:
+        f.close()
+    chunks.append(compressor.flush())
+    return struct.pack('').join(chunks), crc, size
+
+#############################################################################
+#
+class ZipMember(object):
+    """
+    One file in the archive. 'crc', 'compress_size' and 'file_size' are
+    filled in as the file is written.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, filename, arcname, compression):
+        st = os.stat(filename)
+        self.filename = filename
+        if isinstance(arcname, type(u'')):
+            self.arcname = arcname.encode('utf-8')
+            self.flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+        else:
+            self.arcname = arcname
+            self.flags = FLAG_DATA_DESCRIPTOR
+        self.compression = compression
+        self.expected_size = st.st_size
+        self.mode = st.st_mode
+        self.date, self.time = dos_date_time(st.st_mtime)
+
+        # Like zipfile, allow for deflating making a file a bit bigger.
+        #
+        self.zip64 = st.st_size * 1.05 >= ZIP64_LIMIT
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.offset = 0
+
+    #########################################################################
+    #
+    def version(self):
+        if self.zip64:
+            return 45
+        return 20
+
+    #########################################################################
+    #
+    def local_header(self):
+        if self.zip64:
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, 0, 0)
+            size = 0xffffffff
+        else:
+            extra = struct.pack('')
+            size = 0
+        return struct.pack('<LHHHHHLLLHH', LOCAL_HEADER_SIG, self.version(),
+                           self.flags, self.compression, self.time,
+                           self.date, 0, size, size, len(self.arcname),
+                           len(extra)) + self.arcname + extra
+
+    #########################################################################
+    #
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack('<LLQQ', DATA_DESCRIPTOR_SIG, self.crc,
+                               self.compress_size, self.file_size)
+        return struct.pack('<LLLL', DATA_DESCRIPTOR_SIG, self.crc,
+                           self.compress_size, self.file_size)
+
+    #########################################################################
+    #
+    def central_dir_entry(self):
+        """
+        This member's entry in the central directory. Any of the sizes or
+        the offset that do not fit in 32 bits go in a ZIP64 extra field.
+        """
+        fields = []
+        file_size = self.file_size
+        compress_size = self.compress_size
+        offset = self.offset
+        if file_size >= ZIP64_LIMIT:
+            fields.append(file_size)
+            file_size = 0xffffffff
+        if compress_size >= ZIP64_LIMIT:
+            fields.append(compress_size)
+            compress_size = 0xffffffff
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = 0xffffffff
+        if fields:
+            extra = struct.pack('<HH' + 'Q' * len(fields), ZIP64_EXTRA_ID,
+                                8 * len(fields), *fields)
+            version = 45
+        else:
+            extra = struct.pack('')
+            version = self.version()
+        return struct.pack('<LHHHHHHLLLHHHHHLL', CENTRAL_DIR_SIG,
+                           (3 << 8) | version, version, self.flags,
+                           self.compression, self.time, self.date, self.crc,
+                           compress_size, file_size, len(self.arcname),
+                           len(extra), 0, 0, 0, (self.mode & 0xffff) << 16,
+                           offset) + self.arcname + extra
+
+#############################################################################
+#
+class ZipStream(object):
+    """
+    Iterating over a ZipStream gives the bytes of a ZIP archive of the
+    given files, a block at a time.
+
+    members: a list of file names, or of (file name, name in the archive)
+             pairs. If only a file name is given its name in the archive is
+             the base name of the file.
+
+    compression: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+
+    blksize: how much of a file to read at a time.
+
+    pool: a multiprocessing pool to deflate members in (see above.)
+
+    ahead: how many members to have the pool working on at once.
+
+    max_pooled_size: files bigger than this are not deflated in the pool.
+    """
+
+    #########################################################################
+    #
+    def __init__(self, members, compression = zipfile.ZIP_DEFLATED,
+                 blksize = 65536, level = 6, pool = None, ahead = 8,
+                 max_pooled_size = 33554432):
+        self.members = []
+        for member in members:
+            if isinstance(member, (list, tuple)):
+                filename, arcname = member
+            else:
+                filename, arcname = member, os.path.basename(member)
+            self.members.append(ZipMember(filename, arcname, compression))
+        self.compression = compression
+        self.blksize = blksize
+        self.level = level
+        self.pool = pool
+        self.ahead = ahead
+        self.max_pooled_size = max_pooled_size
+
+    #########################################################################
+    #
+    def length(self):
+        """
+        The size of the archive, if we can know it before writing it (every
+        member is stored) or None.
+        """
+        if self.compression != zipfile.ZIP_STORED:
+            return None
+        offset = 0
+        central_dir = 0
+        for member in self.members:
+            member.offset = offset
+            member.file_size = member.compress_size = member.expected_size
+            offset += len(member.local_header()) + member.file_size + \
+                      len(member.data_descriptor())
+            central_dir += len(member.central_dir_entry())
+        return offset + central_dir + \
+               len(self.end_records(offset, central_dir))
+
+    #########################################################################
+    #
+    def read_blocks(self, member):
+        """
+        The contents of a member's file, a block at a time.
+        """
+        f = open(member.filename, 'rb')
+        try:
+            while True:
+                data = f.read(self.blksize)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
+    #########################################################################
+    #
+    def member_data(self, member):
+        """
+        The (compressed) data of a member, a block at a time. Sets the
+        member's CRC and sizes as it goes.
+        """
+        member.crc = member.compress_size = member.file_size = 0
+        if member.compression == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+
+        for data in self.read_blocks(member):
+            member.crc = zlib.crc32(data, member.crc) & 0xffffffff
+            member.file_size += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                member.compress_size += len(data)
+                yield data
+        if compressor is not None:
+            data = compressor.flush()
+            member.compress_size += len(data)
+            yield data
+
+    #########################################################################
+    #
+    def compressed_members(self):
+        """
+        A (member, data) tuple for each member, in order, where 'data' is an
+        iterator over the member's (compressed) data.
+
+        With a pool we keep up to 'ahead' members being deflated in it. When
+        we get to a member we wait for the pool to finish it, if it has not
+        already, while the pool carries on with the ones after it.
+        """
+        if self.pool is None or self.compression != zipfile.ZIP_DEFLATED:
+            for member in self.members:
+                yield member, self.member_data(member)
+            return
+
+        pending = []
+        members = iter(self.members)
+        more = True
+        while True:
+            while more and len(pending) < self.ahead:
+                member = next(members, None)
+                if member is None:
+                    more = False
+                elif member.expected_size > self.max_pooled_size:
+                    pending.append((member, None))
+                else:
+                    pending.append((member, self.pool.apply_async(
+                        compress_file, (member.filename, self.level,
+                                        self.blksize))))
+            if not pending:
+                break
+
+            member, result = pending.pop(0)
+            if result is None:
+                yield member, self.member_data(member)
+            else:
+                data, member.crc, member.file_size = result.get()
+                member.compress_size = len(data)
+                yield member, [data]
+
+    #########################################################################
+    #
+    def end_records(self, offset, size):
+        """
+        The end of central directory record (and, if we need them, the ZIP64
+        end of central directory record and locator) for a central directory
+        of 'size' bytes at 'offset'.
+        """
+        count = len(self.members)
+        records = struct.pack('')
+        if count >= ZIP_MAX_ENTRIES or offset >= ZIP64_LIMIT or \
+               size >= ZIP64_LIMIT:
+            records = struct.pack('<LQHHLLQQQQ', ZIP64_END_OF_CENTRAL_DIR_SIG,
+                                  44, 45, 45, 0, 0, count, count, size,
+                                  offset) + \
+                      struct.pack('<LLQL', ZIP64_LOCATOR_SIG, 0,
+                                  offset + size, 1)
+            count = min(count, ZIP_MAX_ENTRIES)
+            size = min(size, 0xffffffff)
+            offset = min(offset, 0xffffffff)
+        return records + struct.pack('<LHHHHLLH', END_OF_CENTRAL_DIR_SIG, 0, 0,
+                                     count, count, size, offset, 0)
+
+    #########################################################################
+    #
+    def __iter__(self):
+        offset = 0
+        for member, member_data in self.compressed_members():
+            member.offset = offset
+            header = member.local_header()
+            yield header
+            for data in member_data:
+                yield data
+            if not member.zip64 and (member.file_size >= ZIP64_LIMIT or
+                                     member.compress_size >= ZIP64_LIMIT):
+                raise zipfile.LargeZipFile("%s grew past the ZIP64 limit "
+                                           "while we were sending it" % \
+                                           member.filename)
+            descriptor = member.data_descriptor()
+            yield descriptor
+            offset += len(header) + member.compress_size + len(descriptor)
+
+        size = 0
+        for member in self.members:
+            entry = member.central_dir_entry()
+            size += len(entry)
+            yield entry
+        yield self.end_records(offset, size)
@@ -23,7 +23,7 @@ setup(
     author='Eric "Scanner" Luce',
     author_email='scanner@apricot.com',
     url='https://github.com/scanner/django-asutils.git',
-    packages=['asutils', 'asutils.templatetags'],
+    packages=['asutils', 'asutils.templatetags', 'asutils.textindex'],
     package_data={'asutils': ['templates/*/*.html']},
     classifiers=['Development Status :: 4 - Beta',
                  'Environment :: Web Environment',
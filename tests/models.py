@@ -0,0 +1,50 @@
+#
+# File: $Id$
+#
+"""
+Models used by the asutils tests.
+"""
+
+# Django imports
+#
+from django.db import models
+
+# 3rd party django imports
+#
+import tagging
+
+#############################################################################
+#
+class Publisher(models.Model):
+    name = models.CharField(max_length = 64)
+
+    def __unicode__(self):
+        return self.name
+
+#############################################################################
+#
+class Author(models.Model):
+    name = models.CharField(max_length = 64)
+    publisher = models.ForeignKey(Publisher, null = True)
+
+    def __unicode__(self):
+        return self.name
+
+#############################################################################
+#
+class Book(models.Model):
+    title = models.CharField(max_length = 128)
+    pages = models.IntegerField(default = 0)
+    price = models.DecimalField(max_digits = 8, decimal_places = 2,
+                                default = 0)
+    rating = models.FloatField(default = 0)
+    published = models.DateField(null = True)
+    in_print = models.BooleanField(default = True)
+    author = models.ForeignKey(Author, null = True)
+
+    def __unicode__(self):
+        return self.title
+
+tagging.register(Book)
+tagging.register(Publisher, tag_descriptor_attr = 'labels',
+                 tagged_item_manager_attr = 'labelled')
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Run the asutils tests. From the top of the source tree:
+
+    python tests/runtests.py
+
+They need django and django-tagging to be installed. Any arguments are
+passed on as the test labels, ie: 'tests.SortHeadersTest'
+"""
+
+# System imports
+#
+import os
+import sys
+
+#############################################################################
+#
+def main(labels):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+
+    from django.conf import settings
+    from django.test.utils import get_runner
+
+    runner = get_runner(settings)(verbosity = 1, interactive = False,
+                                  failfast = False)
+    return runner.run_tests(labels or ['tests'])
+
+if __name__ == '__main__':
+    sys.exit(bool(main(sys.argv[1:])))
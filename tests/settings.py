@@ -0,0 +1,32 @@
+#
+# File: $Id$
+#
+"""
+The django settings the asutils tests run with. See runtests.py
+"""
+
+DATABASES = {
+    'default' : {
+        'ENGINE' : 'django.db.backends.sqlite3',
+        'NAME'   : ':memory:',
+        },
+    }
+
+CACHES = {
+    'default' : {
+        'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+INSTALLED_APPS = (
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'tagging',
+    'asutils',
+    'asutils.textindex',
+    'tests',
+    )
+
+SECRET_KEY = 'asutils-tests-not-secret'
+
+SENDFILE_BACKEND = 'python'
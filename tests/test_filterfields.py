@@ -0,0 +1,210 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.filterfields
+"""
+
+from __future__ import absolute_import
+
+# Django imports
+#
+from django.test import TestCase
+from django.http import QueryDict
+
+# asutils imports
+#
+from asutils import filterfields
+from asutils.middleware import FilterErrorMiddleware
+
+# Test imports
+#
+from tests.models import Book
+
+#############################################################################
+#
+class FakeRequest(object):
+    """
+    Just enough of a request for FilterFields.
+    """
+    def __init__(self, query = ''):
+        self.GET = QueryDict(query)
+        self.META = {}
+        self.method = 'GET'
+
+FIELDS = ('title', 'pages', 'price', 'rating', 'published', 'in_print',
+          'author__name')
+
+#############################################################################
+#
+class FilterPlanTest(TestCase):
+
+    def tearDown(self):
+        filterfields.invalidate_filter_plans()
+
+    def test_plan_is_shared(self):
+        plan = filterfields.get_filter_plan(Book, FIELDS)
+        self.assertTrue(plan is filterfields.get_filter_plan(Book, FIELDS))
+        filterfields.invalidate_filter_plans(Book)
+        self.assertFalse(plan is filterfields.get_filter_plan(Book, FIELDS))
+
+    def test_dispatch(self):
+        plan = filterfields.get_filter_plan(Book, FIELDS)
+        self.assertEqual(plan.dispatch['title__contains'][2],
+                         'title__icontains')
+        self.assertEqual(plan.dispatch['author__name__exact'][2],
+                         'author__name__iexact')
+        self.assertFalse('title__year' in plan.dispatch)
+
+    def test_filter_kwargs(self):
+        plan = filterfields.get_filter_plan(Book, FIELDS)
+        kwargs = plan.filter_kwargs(QueryDict('title__contains=dune&'
+                                              'pages__in=1,2,3&bogus=1'))
+        self.assertEqual(kwargs, {'title__icontains' : 'dune',
+                                  'pages__in' : [1, 2, 3]})
+
+    def test_params(self):
+        request = FakeRequest('title__exact=dune&bogus=1')
+        ff = filterfields.FilterFields(request, Book, FIELDS)
+        self.assertFalse('params' in ff.__dict__)
+        self.assertEqual(ff.params, {'title__exact' : 'dune', 'bogus' : '1'})
+
+    def test_get_query_set(self):
+        Book.objects.create(title = 'Dune', pages = 412)
+        Book.objects.create(title = 'Emma', pages = 474)
+        ff = filterfields.FilterFields(FakeRequest('title__exact=dune'), Book,
+                                       FIELDS)
+        self.assertEqual([x.title for x in ff.get_query_set()], ['Dune'])
+
+#############################################################################
+#
+class FieldPolicyTest(TestCase):
+
+    def tearDown(self):
+        filterfields.set_field_policy(Book, 'title')
+
+    def kwargs(self, query):
+        plan = filterfields.get_filter_plan(Book, FIELDS)
+        return plan.filter_kwargs(QueryDict(query))
+
+    def test_non_ascii(self):
+        Book.objects.create(title = u'Caf\xe9')
+        self.assertEqual(self.kwargs('title__exact=caf%C3%A9'),
+                         {'title__iexact' : u'caf\xe9'})
+        ff = filterfields.FilterFields(FakeRequest('title__exact=Caf%C3%A9'),
+                                       Book, FIELDS)
+        self.assertEqual([x.title for x in ff.get_query_set()], [u'Caf\xe9'])
+
+    def test_case_sensitive(self):
+        filterfields.set_field_policy(Book, 'title',
+                                      case = filterfields.CASE_SENSITIVE)
+        self.assertEqual(self.kwargs('title__exact=Dune&'
+                                     'title__startswith=Du'),
+                         {'title__exact' : 'Dune',
+                          'title__startswith' : 'Du'})
+
+    def test_case_lower(self):
+        filterfields.set_field_policy(Book, 'title',
+                                      case = filterfields.CASE_LOWER)
+        self.assertEqual(self.kwargs('title__iexact=CAF%C3%89&'
+                                     'title__startswith=Ca&'
+                                     'title__regex=%5CD&title__gt=B'),
+                         {'title__exact' : u'caf\xe9',
+                          'title__startswith' : 'ca',
+                          'title__iregex' : '\\D',
+                          'title__gt' : 'B'})
+        Book.objects.create(title = u'caf\xe9')
+        Book.objects.create(title = u'Caf\xe9')
+        ff = filterfields.FilterFields(FakeRequest('title__exact=CAF%C3%89'),
+                                       Book, FIELDS)
+        self.assertEqual([x.title for x in ff.get_query_set()], [u'caf\xe9'])
+
+    def test_lookups(self):
+        filterfields.set_field_policy(Book, 'title',
+                                      lookups = ('exact', 'startswith'))
+        self.assertEqual(self.kwargs('title__exact=a&title__startswith=b&'
+                                     'title__contains=c'),
+                         {'title__iexact' : 'a', 'title__istartswith' : 'b'})
+        filterfields.set_field_policy(Book, 'title',
+                                      case = filterfields.CASE_LOWER,
+                                      lookups = { 'exact' : None,
+                                                  'contains' : 'search' })
+        self.assertEqual(self.kwargs('title__exact=A&title__contains=B&'
+                                     'title__gt=c'),
+                         {'title__exact' : 'a', 'title__search' : 'b'})
+
+    def test_unknown_case(self):
+        self.assertRaises(ValueError, filterfields.set_field_policy, Book,
+                          'title', case = 'upper')
+
+#############################################################################
+#
+class ValueParsingTest(TestCase):
+
+    def test_parse_int(self):
+        self.assertEqual(filterfields.parse_int(' -42 '), -42)
+        self.assertEqual(filterfields.parse_int(str(2 ** 63 - 1)), 2 ** 63 - 1)
+        self.assertEqual(filterfields.parse_int(str(-2 ** 63)), -2 ** 63)
+        for value in ('', 'x', '1.5', '1e3', str(2 ** 63), str(-2 ** 63 - 1),
+                      '9' * 20, '9' * 21, '9' * 100000):
+            self.assertRaises(filterfields.FilterValueError,
+                              filterfields.parse_int, value)
+
+    def test_parse_numbers(self):
+        self.assertEqual(str(filterfields.parse_decimal('1.50')), '1.50')
+        self.assertEqual(filterfields.parse_float('1e3'), 1000.0)
+        for value in ('NaN', 'Infinity', '1e3', '1.2.3', '-'):
+            self.assertRaises(filterfields.FilterValueError,
+                              filterfields.parse_decimal, value)
+        self.assertEqual(filterfields.parse_float('-1.5e300'), -1.5e300)
+        for value in ('nan', 'inf', '1e1000', '1' * 50, '1e999', '-1e999',
+                      '9' * 40 + 'e300'):
+            self.assertRaises(filterfields.FilterValueError,
+                              filterfields.parse_float, value)
+
+    def test_parse_list_and_range(self):
+        self.assertEqual(filterfields.parse_list('1,2,3',
+                                                 filterfields.parse_int, 3),
+                         [1, 2, 3])
+        self.assertRaises(filterfields.FilterValueError,
+                          filterfields.parse_list, '1,2,3,4',
+                          filterfields.parse_int, 3)
+        self.assertEqual(filterfields.parse_range('1,2',
+                                                  filterfields.parse_int),
+                         [1, 2])
+        for value in ('1', '2,1', '1,2,3', '1,'):
+            self.assertRaises(filterfields.FilterValueError,
+                              filterfields.parse_range, value,
+                              filterfields.parse_int)
+
+    def test_parse_dates_and_bools(self):
+        self.assertEqual(str(filterfields.parse_date('2008-07-24')),
+                         '2008-07-24')
+        self.assertEqual(str(filterfields.parse_datetime('2008-07-24T10:11')),
+                         '2008-07-24 10:11:00')
+        self.assertTrue(filterfields.parse_bool('Yes'))
+        self.assertFalse(filterfields.parse_bool('0'))
+        for value in ('2008-02-30', '24/07/2008', 'today'):
+            self.assertRaises(filterfields.FilterValueError,
+                              filterfields.parse_date, value)
+        self.assertRaises(filterfields.FilterValueError,
+                          filterfields.parse_bool, 'maybe')
+
+    def test_bad_query_is_filter_value_error(self):
+        for query in ('pages__exact=99999999999999999999',
+                      'pages__in=' + ','.join(['1'] * 101),
+                      'price__gt=NaN', 'rating__gt=1e999',
+                      'rating__lt=-1e999', 'rating__exact=nan',
+                      'published__range=2009-01-01,2008-01-01',
+                      'in_print__exact=perhaps'):
+            ff = filterfields.FilterFields(FakeRequest(query), Book, FIELDS)
+            self.assertRaises(filterfields.FilterValueError, ff.get_query_set)
+
+    def test_middleware_400(self):
+        request = FakeRequest('pages__exact=99999999999999999999')
+        ff = filterfields.FilterFields(request, Book, FIELDS)
+        try:
+            ff.get_query_set()
+        except filterfields.FilterValueError as e:
+            response = FilterErrorMiddleware().process_exception(request, e)
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,149 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.querycache and the cached counts of asutils.filterfields
+"""
+
+from __future__ import absolute_import
+
+# System imports
+#
+import os
+import sys
+import subprocess
+
+# Django imports
+#
+from django.test import TestCase
+from django.core.cache import cache
+
+# asutils imports
+#
+from asutils import filterfields
+from asutils import querycache
+
+# Test imports
+#
+from tests.models import Book
+from tests.test_filterfields import FakeRequest, FIELDS
+
+# Run in a new python: load the apps, save a Book and only then look at
+# its generation. Nothing in that process ever builds a cache key.
+#
+SAVE_ONLY = """
+from django.core.management import call_command
+call_command('syncdb', interactive = False, verbosity = 0)
+from tests.models import Book
+Book.objects.create(title = 'Dune')
+from asutils import querycache
+print(querycache.generation(Book))
+"""
+
+#############################################################################
+#
+class GenerationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_save_and_delete(self):
+        gen = querycache.generation(Book)
+        book = Book.objects.create(title = 'Dune')
+        self.assertEqual(querycache.generation(Book), gen + 1)
+        book.delete()
+        self.assertEqual(querycache.generation(Book), gen + 2)
+
+    def test_deferred(self):
+        Book.objects.create(title = 'Dune')
+        gen = querycache.generation(Book)
+        book = Book.objects.defer('title').get()
+        book.save()
+        self.assertEqual(querycache.generation(Book), gen + 1)
+
+    def test_save_only_process(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE = 'tests.settings',
+                   PYTHONPATH = os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))))
+        process = subprocess.Popen([sys.executable, '-c', SAVE_ONLY],
+                                   env = env, stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        self.assertEqual(output.strip(), '2')
+
+    def test_cached_count(self):
+        Book.objects.create(title = 'Dune')
+        ff = filterfields.FilterFields(FakeRequest('title__exact=dune'), Book,
+                                       FIELDS)
+        self.assertEqual(ff.count(filterfields.COUNT_CACHED), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(ff.count(filterfields.COUNT_CACHED), 1)
+        Book.objects.create(title = 'dune')
+        self.assertEqual(ff.count(filterfields.COUNT_CACHED), 2)
+
+#############################################################################
+#
+class CachedQuerySetTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for i, title in enumerate(('Dune', 'Emma', 'Ivanhoe', 'Ulysses')):
+            Book.objects.create(title = title, pages = 100 * (i + 1))
+
+    def cached(self, query, order_by = ('title',)):
+        ff = filterfields.FilterFields(FakeRequest(query), Book, FIELDS)
+        return ff.get_cached_query_set(order_by = order_by)
+
+    def titles(self, books):
+        return [x.title for x in books]
+
+    def test_keys(self):
+        a = self.cached('pages__gte=200&title__contains=e')
+        b = self.cached('title__contains=e&pages__gte=200')
+        self.assertEqual(a.make_key('ids', ('title',), 0, 2),
+                         b.make_key('ids', ('title',), 0, 2))
+        self.assertNotEqual(a.make_key('ids', ('title',), 0, 2),
+                            a.make_key('ids', ('-title',), 0, 2))
+        self.assertNotEqual(a.make_key('ids', ('title',), 0, 2),
+                            a.make_key('ids', ('title',), 2, 4))
+        self.assertNotEqual(a.make_key('ids', ('title',), 0, 2),
+                            self.cached('pages__gte=300&title__contains=e'
+                                        ).make_key('ids', ('title',), 0, 2))
+
+    def test_orderings_and_slices(self):
+        self.assertEqual(self.titles(self.cached('')[0:2]), ['Dune', 'Emma'])
+        self.assertEqual(self.titles(self.cached('')[2:4]),
+                         ['Ivanhoe', 'Ulysses'])
+        self.assertEqual(self.titles(self.cached('', ('-title',))[0:2]),
+                         ['Ulysses', 'Ivanhoe'])
+
+    def test_hit(self):
+        ids = [Book.objects.get(title = x).pk for x in ('Emma', 'Ivanhoe')]
+        self.assertEqual(self.cached('pages__gte=200').count(), 3)
+        self.assertEqual(self.titles(self.cached('pages__gte=200')[0:2]),
+                         ['Emma', 'Ivanhoe'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cached('pages__gte=200').count(), 3)
+            self.assertEqual(self.cached('pages__gte=200').get_ids(0, 2), ids)
+        # The page itself is one fetch by primary key.
+        #
+        with self.assertNumQueries(1):
+            self.assertEqual(self.titles(self.cached('pages__gte=200')[0:2]),
+                             ['Emma', 'Ivanhoe'])
+
+    def test_save(self):
+        self.assertEqual(self.titles(self.cached('')[0:2]), ['Dune', 'Emma'])
+        self.assertEqual(self.cached('').count(), 4)
+        Book.objects.create(title = 'Beloved')
+        self.assertEqual(self.titles(self.cached('')[0:2]),
+                         ['Beloved', 'Dune'])
+        self.assertEqual(self.cached('').count(), 5)
+
+    def test_delete(self):
+        self.assertEqual(self.titles(self.cached('')[0:2]), ['Dune', 'Emma'])
+        self.assertEqual(self.cached('').count(), 4)
+        Book.objects.get(title = 'Dune').delete()
+        self.assertEqual(self.titles(self.cached('')[0:2]),
+                         ['Emma', 'Ivanhoe'])
+        self.assertEqual(self.cached('').count(), 3)
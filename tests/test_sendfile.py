@@ -0,0 +1,497 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.sendfile
+"""
+
+from __future__ import absolute_import
+
+# System imports
+#
+import os
+import time
+import shutil
+import tempfile
+from wsgiref.util import FileWrapper
+
+# Django imports
+#
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.http import http_date
+
+# asutils imports
+#
+from asutils import sendfile
+
+DATA = ''.join([chr(x % 251) for x in range(100000)])
+
+#############################################################################
+#
+class SendfileTestCase(TestCase):
+    """
+    Makes a file with DATA in it for each test.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'data.bin')
+        f = open(self.filename, 'wb')
+        f.write(DATA)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def request(self, **meta):
+        return RequestFactory().get('/', **meta)
+
+    def body(self, response):
+        return ''.join([str(x) for x in response])
+
+#############################################################################
+#
+class FileWrapperTest(SendfileTestCase):
+
+    def wrapped(self, **meta):
+        environ = {'wsgi.file_wrapper' : FileWrapper}
+        request = self.request(**environ)
+        request.META.update(meta)
+        return environ, sendfile.stream_file(request, self.filename,
+                                             'application/octet-stream')
+
+    def test_usable(self):
+        environ, response = self.wrapped()
+        self.assertTrue(sendfile.file_wrapper_usable(environ, response))
+        self.assertEqual(''.join(FileWrapper(response.file_to_stream)), DATA)
+        environ, response = self.wrapped(HTTP_RANGE = 'bytes=10-19')
+        self.assertTrue(sendfile.file_wrapper_usable(environ, response))
+        self.assertEqual(''.join(FileWrapper(response.file_to_stream)),
+                         DATA[10:20])
+        response.close()
+
+    def test_not_without_file_wrapper(self):
+        response = sendfile.send_file(self.request(), self.filename)
+        self.assertFalse(sendfile.file_wrapper_usable({}, response))
+        self.assertEqual(self.body(response), DATA)
+
+    def test_content_read_by_middleware(self):
+        # ie: GZipMiddleware, or CommonMiddleware making an ETag. They read
+        # the content (which reads the file) and put back what they want
+        # to send.
+        #
+        for meta, expected in (({}, DATA),
+                               ({'HTTP_RANGE' : 'bytes=10-19'}, DATA[10:20])):
+            environ, response = self.wrapped(**meta)
+            response.content = response.content
+            self.assertFalse(sendfile.file_wrapper_usable(environ, response))
+            self.assertTrue(self.body(response) == expected)
+            response.close()
+
+    def test_response_changed(self):
+        environ, response = self.wrapped()
+        response.status_code = 304
+        self.assertFalse(sendfile.file_wrapper_usable(environ, response))
+        environ, response = self.wrapped()
+        response['Content-Encoding'] = 'gzip'
+        self.assertFalse(sendfile.file_wrapper_usable(environ, response))
+        response.close()
+
+#############################################################################
+#
+class RangeTest(SendfileTestCase):
+
+    def test_parse_range_header(self):
+        parse = sendfile.parse_range_header
+        self.assertEqual(parse('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse('bytes=900-', 1000), [(900, 999)])
+        self.assertEqual(parse('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse('bytes=-5000', 1000), [(0, 999)])
+        self.assertEqual(parse('bytes=990-5000', 1000), [(990, 999)])
+        self.assertEqual(parse('Bytes = 0-9 , 20-29', 1000),
+                         [(0, 9), (20, 29)])
+        # Overlapping and adjacent ranges are merged and sorted.
+        #
+        self.assertEqual(parse('bytes=50-99,0-9,5-20,21-30', 1000),
+                         [(0, 30), (50, 99)])
+        # Nothing in the file: a 416.
+        #
+        self.assertEqual(parse('bytes=1000-', 1000), [])
+        self.assertEqual(parse('bytes=-0', 1000), [])
+        self.assertEqual(parse('bytes=0-', 0), [])
+        # Ranges we ignore.
+        #
+        for header in ('', 'bytes', 'bytes=', 'items=0-9', 'bytes=9-0',
+                       'bytes=-', 'bytes=a-b', 'bytes=0-9;x', 'bytes=1-2-3',
+                       'bytes=' + ','.join(['%d-%d' % (x * 10, x * 10)
+                                            for x in range(65)])):
+            self.assertEqual(parse(header, 1000), None)
+        self.assertEqual(len(parse('bytes=' + ','.join(
+            ['%d-%d' % (x * 10, x * 10) for x in range(64)]), 1000)), 64)
+
+    def stream(self, **meta):
+        return sendfile.stream_file(self.request(**meta), self.filename,
+                                    'application/octet-stream')
+
+    def test_single_range(self):
+        response = self.stream(HTTP_RANGE = 'bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/%d' % \
+                         len(DATA))
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertTrue(self.body(response) == DATA[100:200])
+
+        response = self.stream(HTTP_RANGE = 'bytes=-10')
+        self.assertTrue(self.body(response) == DATA[-10:])
+
+        response = self.stream(HTTP_RANGE = 'bytes=0-')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.body(response) == DATA)
+
+    def test_unsatisfiable(self):
+        response = self.stream(HTTP_RANGE = 'bytes=%d-' % len(DATA))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(DATA))
+
+    def test_multiple_ranges(self):
+        for use_mmap in (False, True):
+            response = sendfile.stream_file(
+                self.request(HTTP_RANGE = 'bytes=0-9,-10'), self.filename,
+                'application/octet-stream', use_mmap = use_mmap)
+            self.assertEqual(response.status_code, 206)
+            boundary = response['Content-Type'].split('boundary=')[1]
+            body = self.body(response)
+            self.assertEqual(len(body), int(response['Content-Length']))
+            parts = body.split('--%s' % boundary)
+            self.assertEqual(parts[0], '\r\n')
+            self.assertEqual(parts[-1], '--\r\n')
+            self.assertEqual(len(parts), 4)
+            for part, (start, end) in zip(parts[1:3],
+                                          [(0, 9), (len(DATA) - 10,
+                                                    len(DATA) - 1)]):
+                headers, data = part.split('\r\n\r\n', 1)
+                self.assertTrue('Content-Range: bytes %d-%d/%d' % \
+                                (start, end, len(DATA)) in headers)
+                self.assertEqual(data, DATA[start:end + 1] + '\r\n')
+
+    def test_if_range(self):
+        st = os.stat(self.filename)
+        etag = sendfile.file_etag(st)
+        response = self.stream(HTTP_RANGE = 'bytes=0-9', HTTP_IF_RANGE = etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.stream(HTTP_RANGE = 'bytes=0-9',
+                               HTTP_IF_RANGE = '"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.stream(HTTP_RANGE = 'bytes=0-9',
+                               HTTP_IF_RANGE = 'W/' + etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.stream(HTTP_RANGE = 'bytes=0-9',
+                               HTTP_IF_RANGE = response['Last-Modified'])
+        self.assertEqual(response.status_code, 206)
+        response = self.stream(HTTP_RANGE = 'bytes=0-9',
+                               HTTP_IF_RANGE = 'not a date')
+        self.assertEqual(response.status_code, 200)
+
+    def test_mmap(self):
+        for meta, status, expected in (({}, 200, DATA),
+                                       ({'HTTP_RANGE' : 'bytes=5-70004'}, 206,
+                                        DATA[5:70005])):
+            response = sendfile.stream_file(self.request(**meta),
+                                            self.filename,
+                                            'application/octet-stream',
+                                            use_mmap = True)
+            self.assertEqual(response.status_code, status)
+            self.assertFalse(hasattr(response, 'file_to_stream'))
+            self.assertTrue(self.body(response) == expected)
+
+#############################################################################
+#
+def custom_backend(request, filename, content_type):
+    response = HttpResponse('', content_type = content_type)
+    response['X-Custom'] = filename
+    return response
+
+#############################################################################
+#
+class BackendTest(SendfileTestCase):
+
+    def send(self, backend, **extra):
+        with override_settings(SENDFILE_BACKEND = backend, **extra):
+            return sendfile.send_file(self.request(), self.filename,
+                                      'application/octet-stream')
+
+    def check_offloaded(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertFalse(hasattr(response, 'file_to_stream'))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=data.bin')
+        self.assertEqual(response['ETag'],
+                         sendfile.file_etag(os.stat(self.filename)))
+
+    def test_python(self):
+        response = self.send('python')
+        self.assertTrue(self.body(response) == DATA)
+        for header in ('X-Sendfile', 'X-Accel-Redirect',
+                       'X-LIGHTTPD-send-file'):
+            self.assertFalse(response.has_header(header))
+
+    def test_xsendfile(self):
+        response = self.send('xsendfile')
+        self.check_offloaded(response)
+        self.assertEqual(response['X-Sendfile'], self.filename)
+
+    def test_lighttpd(self):
+        response = self.send('lighttpd')
+        self.check_offloaded(response)
+        self.assertEqual(response['X-LIGHTTPD-send-file'], self.filename)
+
+    def test_nginx(self):
+        response = self.send('nginx', SENDFILE_NGINX_LOCATIONS = \
+                             [('/elsewhere', '/nope/'),
+                              (self.dir + '/', '/protected/')])
+        self.check_offloaded(response)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/data.bin')
+
+    def test_nginx_locations(self):
+        locations = [(os.path.join(self.dir, 'media'), '/protected/media'),
+                     (self.dir, '/protected')]
+        with override_settings(SENDFILE_NGINX_LOCATIONS = locations):
+            self.assertEqual(sendfile.nginx_location(
+                os.path.join(self.dir, 'media', 'a b', 'caf\xc3\xa9.mp4')),
+                '/protected/media/a%20b/caf%C3%A9.mp4')
+            self.assertEqual(sendfile.nginx_location(
+                os.path.join(self.dir, 'mediafile')), '/protected/mediafile')
+            self.assertEqual(sendfile.nginx_location('/etc/passwd'), None)
+
+    def test_nginx_not_under_a_location(self):
+        # nginx can not get at the file so we send it ourselves.
+        #
+        response = self.send('nginx', SENDFILE_NGINX_LOCATIONS = \
+                             [(self.dir + 'x', '/protected/')])
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertTrue(self.body(response) == DATA)
+
+    def test_custom(self):
+        for backend in ('tests.test_sendfile.custom_backend', custom_backend):
+            response = self.send(backend)
+            self.check_offloaded(response)
+            self.assertEqual(response['X-Custom'], self.filename)
+
+    def test_stream_file(self):
+        # The web server handles the range.
+        #
+        with override_settings(SENDFILE_BACKEND = 'xsendfile'):
+            response = sendfile.stream_file(self.request(
+                HTTP_RANGE = 'bytes=0-9'), self.filename, 'video/mp4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['X-Sendfile'], self.filename)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+
+#############################################################################
+#
+class ConditionalTest(SendfileTestCase):
+
+    def setUp(self):
+        SendfileTestCase.setUp(self)
+        st = os.stat(self.filename)
+        self.etag = sendfile.file_etag(st)
+        self.last_modified = http_date(st.st_mtime)
+
+    def responses(self, method = 'get', **meta):
+        request = getattr(RequestFactory(), method)('/', **meta)
+        yield sendfile.send_file(request, self.filename)
+        yield sendfile.stream_file(request, self.filename, 'text/plain')
+
+    def assertStatus(self, status, **meta):
+        for response in self.responses(**meta):
+            self.assertEqual(response.status_code, status)
+            if status == 304:
+                self.assertEqual(response.content, '')
+                self.assertEqual(response['ETag'], self.etag)
+                self.assertEqual(response['Last-Modified'],
+                                 self.last_modified)
+                for header in ('Content-Length', 'Content-Disposition',
+                               'Content-Range', 'Accept-Ranges'):
+                    self.assertFalse(response.has_header(header), header)
+            else:
+                self.assertTrue(self.body(response) == DATA)
+                self.assertEqual(response['ETag'],
+                                 sendfile.file_etag(os.stat(self.filename)))
+
+    def test_if_none_match(self):
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = self.etag)
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = 'W/' + self.etag)
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = '"a", %s , "b"' % \
+                          self.etag)
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = '*')
+        self.assertStatus(200, HTTP_IF_NONE_MATCH = '"stale"')
+        self.assertStatus(200, HTTP_IF_NONE_MATCH = self.etag[:-2] + '"')
+
+    def test_if_modified_since(self):
+        self.assertStatus(304, HTTP_IF_MODIFIED_SINCE = self.last_modified)
+        self.assertStatus(304, HTTP_IF_MODIFIED_SINCE = \
+                          self.last_modified + '; length=100000')
+        self.assertStatus(304, HTTP_IF_MODIFIED_SINCE = \
+                          http_date(time.time() + 60))
+        self.assertStatus(200, HTTP_IF_MODIFIED_SINCE = \
+                          http_date(os.stat(self.filename).st_mtime - 60))
+        self.assertStatus(200, HTTP_IF_MODIFIED_SINCE = 'yesterday')
+
+    def test_if_none_match_wins(self):
+        # A stale ETag means the client's copy is out of date even if the
+        # date says it is not.
+        #
+        self.assertStatus(200, HTTP_IF_NONE_MATCH = '"stale"',
+                          HTTP_IF_MODIFIED_SINCE = self.last_modified)
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = self.etag,
+                          HTTP_IF_MODIFIED_SINCE = \
+                          http_date(os.stat(self.filename).st_mtime - 60))
+
+    def test_ranges(self):
+        # A current client does not get the range either.
+        #
+        self.assertStatus(304, HTTP_IF_NONE_MATCH = self.etag,
+                          HTTP_RANGE = 'bytes=0-9')
+
+    def test_modified(self):
+        os.utime(self.filename, (time.time() + 120, time.time() + 120))
+        self.assertStatus(200, HTTP_IF_NONE_MATCH = self.etag)
+        self.assertStatus(200, HTTP_IF_MODIFIED_SINCE = self.last_modified)
+
+    def test_only_get_and_head(self):
+        self.assertEqual(sendfile.not_modified(
+            RequestFactory().head('/', HTTP_IF_NONE_MATCH = self.etag),
+            os.stat(self.filename)).status_code, 304)
+        self.assertEqual(sendfile.not_modified(
+            RequestFactory().post('/', HTTP_IF_NONE_MATCH = self.etag),
+            os.stat(self.filename)), None)
+
+#############################################################################
+#
+class FileSentTest(SendfileTestCase):
+
+    def setUp(self):
+        SendfileTestCase.setUp(self)
+        self.sent = []
+        sendfile.file_sent.connect(self.receiver)
+
+    def tearDown(self):
+        sendfile.file_sent.disconnect(self.receiver)
+        SendfileTestCase.tearDown(self)
+
+    def receiver(self, sender, **kwargs):
+        kwargs['sender'] = sender
+        self.sent.append(kwargs)
+
+    def check_sent(self, **expected):
+        self.assertEqual(len(self.sent), 1)
+        sent = self.sent[0]
+        self.assertTrue(sent['duration'] >= 0)
+        self.assertEqual(sent['filename'], self.filename)
+        for key, value in expected.items():
+            self.assertEqual(sent[key], value, key)
+
+    def test_full(self):
+        response = sendfile.send_file(self.request(), self.filename)
+        self.assertTrue(self.body(response) == DATA)
+        self.assertEqual(self.sent, [])
+        response.close()
+        response.close()
+        self.check_sent(sender = sendfile.send_file, status = 200,
+                        ranged = False, bytes_expected = len(DATA),
+                        bytes_sent = len(DATA), aborted = False)
+
+    def test_ranged(self):
+        for meta, expected in (({'HTTP_RANGE' : 'bytes=10-109'}, 100),
+                               ({'HTTP_RANGE' : 'bytes=0-9,-10'}, None)):
+            response = sendfile.stream_file(self.request(**meta),
+                                            self.filename, 'text/plain')
+            body = self.body(response)
+            response.close()
+            self.check_sent(sender = sendfile.stream_file, status = 206,
+                            ranged = True, bytes_expected = len(body),
+                            bytes_sent = len(body), aborted = False)
+            if expected is not None:
+                self.assertEqual(len(body), expected)
+            self.sent = []
+
+    def test_aborted(self):
+        response = sendfile.send_file(self.request(), self.filename,
+                                      blksize = 1000)
+        self.assertEqual(len(next(iter(response))), 1000)
+        response.close()
+        self.check_sent(status = 200, bytes_expected = len(DATA),
+                        bytes_sent = 1000, aborted = True)
+
+    def test_file_wrapper(self):
+        # The WSGI server sends the file so we can not tell how much of it
+        # got sent.
+        #
+        environ = RequestFactory()._base_environ(
+            PATH_INFO = '/send/', QUERY_STRING = 'path=' + self.filename)
+        environ['wsgi.file_wrapper'] = FileWrapper
+        started = []
+        handler = sendfile.SendfileWSGIHandler()
+        with override_settings(ROOT_URLCONF = 'tests.urls'):
+            result = handler(environ, lambda *args: started.append(args))
+        self.assertTrue(isinstance(result, FileWrapper))
+        self.assertEqual(started[0][0], '200 OK')
+        self.assertTrue(''.join(result) == DATA)
+        result.close()
+        self.check_sent(status = 200, bytes_expected = len(DATA),
+                        bytes_sent = None, aborted = None)
+
+#############################################################################
+#
+class AdaptiveBlockSizeTest(SendfileTestCase):
+
+    def test_next_size(self):
+        adaptive = sendfile.AdaptiveBlockSize(minimum = 1024,
+                                              maximum = 8192, fast = 0.01,
+                                              slow = 0.25)
+        self.assertEqual(adaptive.next_size(2048, 0.001), 4096)
+        self.assertEqual(adaptive.next_size(8192, 0.001), 8192)
+        self.assertEqual(adaptive.next_size(6000, 0.001), 8192)
+        self.assertEqual(adaptive.next_size(2048, 0.1), 2048)
+        self.assertEqual(adaptive.next_size(2048, 1), 1024)
+        self.assertEqual(adaptive.next_size(1024, 1), 1024)
+        self.assertEqual(adaptive.next_size(1500, 1), 1024)
+
+    def block_sizes(self, adaptive, blksize):
+        with override_settings(SENDFILE_ADAPTIVE_BLKSIZE = adaptive):
+            response = sendfile.send_file(self.request(), self.filename,
+                                          blksize = blksize)
+        sizes = [len(x) for x in response]
+        response.close()
+        self.assertEqual(sum(sizes), len(DATA))
+        return sizes
+
+    def test_fast_client(self):
+        adaptive = sendfile.AdaptiveBlockSize(minimum = 1024,
+                                              maximum = 16384, fast = 1000,
+                                              slow = 2000)
+        sizes = self.block_sizes(adaptive, 1024)
+        self.assertEqual(sizes[:6], [1024, 2048, 4096, 8192, 16384, 16384])
+        self.assertEqual(max(sizes), 16384)
+
+    def test_slow_client(self):
+        adaptive = sendfile.AdaptiveBlockSize(minimum = 2048,
+                                              maximum = 16384, fast = -2,
+                                              slow = -1)
+        sizes = self.block_sizes(adaptive, 8192)
+        self.assertEqual(sizes[:4], [8192, 4096, 2048, 2048])
+        self.assertEqual(min(sizes[:-1]), 2048)
+
+    def test_fixed(self):
+        self.assertEqual(set(self.block_sizes(False, 8192)[:-1]), set([8192]))
+        self.assertEqual(sendfile.get_adaptive_blksize(), None)
+        with override_settings(SENDFILE_ADAPTIVE_BLKSIZE = True):
+            self.assertTrue(isinstance(sendfile.get_adaptive_blksize(),
+                                       sendfile.AdaptiveBlockSize))
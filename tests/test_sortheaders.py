@@ -0,0 +1,116 @@
+#
+# File: $Id$
+#
+"""
+Tests for keyset pagination in asutils.sortheaders
+"""
+
+from __future__ import absolute_import
+
+# System imports
+#
+import base64
+
+# Django imports
+#
+from django.test import TestCase
+from django.utils import simplejson
+
+# asutils imports
+#
+from asutils import sortheaders
+
+# Test imports
+#
+from tests.models import Author, Book
+from tests.test_filterfields import FakeRequest
+
+HEADERS = (('Title', 'title'), ('Pages', 'pages'),
+           ('Author', 'author__name'), ('Id', 'pk'))
+
+#############################################################################
+#
+class KeysetPageTest(TestCase):
+
+    def setUp(self):
+        anne = Author.objects.create(name = 'Anne')
+        bob = Author.objects.create(name = 'Bob')
+        for i, author in enumerate([bob, None, anne, None, bob, anne, None]):
+            Book.objects.create(title = 'Book %d' % i, pages = 100 + i % 3,
+                                author = author)
+
+    def headers(self, query = ''):
+        return sortheaders.SortHeaders(FakeRequest(query), HEADERS)
+
+    def walk(self, order_field, order_type, per_page = 2):
+        """
+        Page forward through every book, then back again from the last
+        page. Returns the pks in the order seen going each way.
+        """
+        query = 'o=%d&ot=%s' % (order_field, order_type)
+        page = self.headers(query).get_keyset_page(Book.objects.all(),
+                                                   per_page)
+        pages = [page]
+        while page.has_next:
+            page = self.headers(query + '&after=' + page.next_cursor) \
+                   .get_keyset_page(Book.objects.all(), per_page)
+            pages.append(page)
+        forward = [x.pk for p in pages for x in p]
+
+        backward = [x.pk for x in pages[-1]]
+        page = pages[-1]
+        while page.has_previous:
+            page = self.headers(query + '&before=' + page.previous_cursor) \
+                   .get_keyset_page(Book.objects.all(), per_page)
+            backward = [x.pk for x in page] + backward
+        return forward, backward
+
+    def test_walk(self):
+        for order_type in ('asc', 'desc'):
+            for order_field in range(len(HEADERS)):
+                sh = self.headers('o=%d&ot=%s' % (order_field, order_type))
+                expected = [x.pk for x in Book.objects.filter(
+                    pk__in = [b.pk for b in Book.objects.all()]) \
+                    .order_by(*sh.get_order_by_list())]
+                forward, backward = self.walk(order_field, order_type)
+                self.assertEqual(sorted(forward), sorted(expected))
+                self.assertEqual(len(forward), len(set(forward)))
+                self.assertEqual(forward, backward)
+                if order_field != 2:
+                    self.assertEqual(forward, expected)
+
+    def test_nulls_last(self):
+        forward, backward = self.walk(2, 'asc', per_page = 3)
+        nulls = list(Book.objects.filter(author = None).order_by('pk') \
+                     .values_list('pk', flat = True))
+        self.assertEqual(forward[-len(nulls):], nulls)
+        forward, backward = self.walk(2, 'desc', per_page = 3)
+        self.assertEqual(forward[:len(nulls)], nulls[::-1])
+
+    def test_cursor_round_trip(self):
+        sh = self.headers('o=1')
+        book = Book.objects.get(title = 'Book 4')
+        self.assertEqual(sh.parse_cursor(sh.make_cursor(book), Book),
+                         (book.pages, book.pk))
+
+    def bad_cursors(self):
+        signer = sortheaders.cursor_signer()
+        def signed(data):
+            return signer.sign(base64.urlsafe_b64encode(
+                simplejson.dumps(data)).rstrip('='))
+        return ['', 'garbage', signed(['title', 'a', 'x']),
+                signed(['pages', {'a' : 1}, 1]), signed(['pages', 'x', 1]),
+                signed(['pages', None, 1]), signed(['pages', 1, None]),
+                signed(['title', 'a']), signed('title'),
+                signed(['author__name', 'Anne', 1]),
+                base64.urlsafe_b64encode(simplejson.dumps(['pages', 1, 1]))]
+
+    def test_bad_cursor(self):
+        first = [x.pk for x in self.headers('o=1') \
+                 .get_keyset_page(Book.objects.all(), 3)]
+        for cursor in self.bad_cursors():
+            for var in ('after', 'before'):
+                sh = self.headers('o=1&%s=%s' % (var, cursor))
+                self.assertEqual(sh.parse_cursor(cursor, Book), None)
+                page = sh.get_keyset_page(Book.objects.all(), 3)
+                self.assertEqual([x.pk for x in page], first)
@@ -0,0 +1,318 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.tagindex, asutils.taggingfilterfields and the astagging
+template tags
+"""
+
+from __future__ import absolute_import
+
+# Django imports
+#
+from django.test import TestCase
+from django.core.cache import cache
+from django.template import Template, Context
+from django.contrib.contenttypes.models import ContentType
+
+# 3rd party django imports
+#
+from tagging.models import Tag
+
+# asutils imports
+#
+from asutils import filterfields
+from asutils import tagindex
+from asutils import taggingfilterfields
+from asutils.templatetags import astagging
+from asutils.taggingfilterfields import TaggingFilterFields, merge_tags, \
+     parse_tag_expression
+
+# Test imports
+#
+from tests.models import Author, Book, Publisher
+from tests.test_filterfields import FakeRequest
+
+#############################################################################
+#
+class TagIndexTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.index = tagindex.register(Book)
+        self.dune = Book.objects.create(title = 'Dune')
+        self.emma = Book.objects.create(title = 'Emma')
+        self.dune.tags = 'scifi classic'
+        self.emma.tags = 'classic'
+
+    def tearDown(self):
+        tagindex.unregister(Book)
+
+    def ids(self, tag):
+        return list(self.index.object_ids(Tag.objects.get(name = tag).pk))
+
+    def test_sets(self):
+        self.assertEqual(self.index.with_any('scifi,classic'),
+                         set([self.dune.pk, self.emma.pk]))
+        self.assertEqual(self.index.with_all('scifi,classic'),
+                         set([self.dune.pk]))
+        self.assertEqual(list(self.index.filter(Book.objects.all(),
+                                                all = 'classic',
+                                                exclude = 'scifi')),
+                         [self.emma])
+
+    def test_invalidation(self):
+        self.assertEqual(self.ids('scifi'), [self.dune.pk])
+        self.emma.tags = 'classic scifi'
+        self.assertEqual(self.ids('scifi'), [self.dune.pk, self.emma.pk])
+        self.dune.tags = 'classic'
+        self.assertEqual(self.ids('scifi'), [self.emma.pk])
+
+    def test_change_while_reading(self):
+        # The tag changes after we read the set from the database but
+        # before we put it in the cache. What we read must not stick.
+        #
+        set_ = cache.set
+        def racing_set(key, value, timeout = None):
+            cache.set = set_
+            self.emma.tags = 'classic scifi'
+            set_(key, value, timeout)
+        cache.set = racing_set
+        try:
+            self.assertEqual(self.ids('scifi'), [self.dune.pk])
+        finally:
+            cache.set = set_
+        self.assertEqual(self.ids('scifi'), [self.dune.pk, self.emma.pk])
+
+#############################################################################
+#
+class FacetCountsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        Book.objects.create(title = 'Dune').tags = 'scifi classic'
+        Book.objects.create(title = 'Emma').tags = 'classic'
+        Book.objects.create(title = 'Ubik').tags = 'scifi'
+
+    def tearDown(self):
+        tagindex.unregister(Book)
+
+    def facets(self, query, **kwargs):
+        ff = TaggingFilterFields(FakeRequest(query), Book, ('title',))
+        return [(x.name, x.count) for x in ff.facet_counts(**kwargs)]
+
+    def test_counts(self):
+        self.assertEqual(self.facets(''), [('classic', 2), ('scifi', 2)])
+        self.assertEqual(self.facets('tag_any=scifi'),
+                         [('scifi', 2), ('classic', 1)])
+        self.assertEqual(self.facets('tags=-scifi'), [('classic', 1)])
+        self.assertEqual(self.facets('title__exact=dune', limit = 1),
+                         [('classic', 1)])
+        self.assertEqual(self.facets('tag_all=scifi,classic', cached = True),
+                         [('classic', 1), ('scifi', 1)])
+
+    def test_empty(self):
+        for query in ('tag_any=nonexistent', 'tag_all=nonexistent',
+                      'title__exact=nothing', 'tags=nonexistent'):
+            self.assertEqual(self.facets(query), [])
+            self.assertEqual(self.facets(query, cached = True), [])
+
+    def test_empty_with_index(self):
+        tagindex.register(Book)
+        for query in ('tag_any=nonexistent', 'tag_all=nonexistent',
+                      'tags=nonexistent', 'tag_any=scifi&tags=-scifi'):
+            self.assertEqual(self.facets(query), [])
+        self.assertEqual(self.facets('tag_any=scifi'),
+                         [('scifi', 2), ('classic', 1)])
+
+#############################################################################
+#
+class AugmentRequestTest(TestCase):
+
+    def get(self, query):
+        ff = TaggingFilterFields(FakeRequest(query), Book, ('title',))
+        return dict(ff.request.GET.items())
+
+    def test_merge_tags(self):
+        self.assertEqual(merge_tags('a,b', 'c,a', 'b'), ['a', 'c'])
+        self.assertEqual(merge_tags('b,a,,b', 'c,a,c', ''), ['b', 'a', 'c'])
+        self.assertEqual(merge_tags('', '', 'a'), [])
+
+    def test_add_and_del(self):
+        self.assertEqual(self.get('tag_any=a,b&add_tag_any=c,a&'
+                                  'del_tag_any=b'),
+                         {'tag_any' : 'a,c'})
+        self.assertEqual(self.get('del_tag_any=b&add_tag_any=c,a&'
+                                  'tag_any=a,b'),
+                         {'tag_any' : 'a,c'})
+        self.assertEqual(self.get('tag_all=x,y&del_tag_all=x,y'),
+                         {'tag_all' : ''})
+        self.assertEqual(self.get('add_tag_all=y,x,y&title__exact=dune'),
+                         {'tag_all' : 'y,x', 'title__exact' : 'dune'})
+
+    def test_any_and_all(self):
+        self.assertEqual(self.get('tag_any=a&tag_all=b&add_tag_any=c&'
+                                  'add_tag_all=d,b&del_tag_any=a'),
+                         {'tag_any' : 'c', 'tag_all' : 'b,d'})
+
+    def test_nothing_to_edit(self):
+        self.assertEqual(self.get('del_tag_any=a'), {})
+        self.assertEqual(self.get('tag_any=a&del_tag_all=a'),
+                         {'tag_any' : 'a'})
+        request = FakeRequest('tag_any=a,b')
+        get = request.GET
+        TaggingFilterFields(request, Book, ('title',))
+        self.assertTrue(request.GET is get)
+
+    def test_filters(self):
+        Book.objects.create(title = 'Dune').tags = 'scifi classic'
+        Book.objects.create(title = 'Emma').tags = 'classic'
+        ff = TaggingFilterFields(FakeRequest('tag_any=scifi,romance&'
+                                             'add_tag_any=classic&'
+                                             'del_tag_any=scifi'),
+                                 Book, ('title',))
+        self.assertEqual(sorted(x.title for x in ff.get_query_set()),
+                         ['Dune', 'Emma'])
+        self.assertEqual(ff.tags_any, ['romance', 'classic'])
+
+#############################################################################
+#
+class FindTaggedManagerTest(TestCase):
+
+    def setUp(self):
+        taggingfilterfields._tagged_managers.clear()
+
+    def test_custom_name(self):
+        Publisher.objects.create(name = 'Gollancz').labels = 'scifi'
+        Publisher.objects.create(name = 'Penguin').labels = 'classic'
+        manager = taggingfilterfields.find_tagged_manager(Publisher)
+        self.assertTrue(manager is Publisher.labelled)
+        self.assertTrue(manager.model is Publisher)
+        ff = TaggingFilterFields(FakeRequest('tag_any=scifi'), Publisher,
+                                 ('name',))
+        self.assertEqual([x.name for x in ff.get_query_set()], ['Gollancz'])
+        self.assertTrue(taggingfilterfields.find_tagged_manager(Book) is
+                        Book.tagged)
+
+    def test_cached(self):
+        manager = taggingfilterfields.find_tagged_manager(Publisher)
+        self.assertTrue(taggingfilterfields.find_tagged_manager(Author) is
+                        None)
+
+        # Asking again does not look through the model's attributes.
+        #
+        def no_dir(model):
+            raise AssertionError("looked through %s again" % model)
+        taggingfilterfields.dir = no_dir
+        try:
+            self.assertTrue(taggingfilterfields.find_tagged_manager(Publisher)
+                            is manager)
+            self.assertTrue(taggingfilterfields.find_tagged_manager(Author)
+                            is None)
+        finally:
+            del taggingfilterfields.dir
+
+#############################################################################
+#
+class TagExpressionTest(TestCase):
+
+    def setUp(self):
+        Book.objects.create(title = 'Dune').tags = 'scifi classic'
+        Book.objects.create(title = 'Emma').tags = 'classic romance'
+        Book.objects.create(title = 'Ubik').tags = 'scifi'
+        Book.objects.create(title = 'Zork')
+
+    def tearDown(self):
+        tagindex.unregister(Book)
+
+    def titles(self, expression):
+        ff = TaggingFilterFields(FakeRequest('tags=' + expression), Book,
+                                 ('title',))
+        return sorted(x.title for x in ff.get_query_set())
+
+    def test_parse(self):
+        self.assertEqual(parse_tag_expression('a,b|c,-d'),
+                         ([['a'], ['b', 'c']], ['d']))
+        self.assertEqual(parse_tag_expression(' a , b | c ,- d '),
+                         ([['a'], ['b', 'c']], ['d']))
+        self.assertEqual(parse_tag_expression('-a,-b'), ([], ['a', 'b']))
+        self.assertEqual(parse_tag_expression(',,'), ([], []))
+
+    def test_malformed(self):
+        for value in ('-', 'a,-', 'a|', '|a', 'a||b', 'a|-b', '-a|b', '--'):
+            self.assertRaises(filterfields.FilterValueError,
+                              parse_tag_expression, value)
+            ff = TaggingFilterFields(FakeRequest('tags=' + value), Book,
+                                     ('title',))
+            self.assertRaises(filterfields.FilterValueError, ff.get_query_set)
+
+    def test_limit(self):
+        limit = taggingfilterfields.MAX_EXPRESSION_TAGS
+        tags = ['t%d' % x for x in range(limit + 1)]
+        groups, excluded = parse_tag_expression(','.join(tags[:limit]))
+        self.assertEqual(len(groups), limit)
+        for value in (','.join(tags), '|'.join(tags),
+                      ','.join('-' + x for x in tags),
+                      '|'.join(tags[:limit]) + ',-' + tags[limit]):
+            self.assertRaises(filterfields.FilterValueError,
+                              parse_tag_expression, value)
+
+    def test_filter(self):
+        for indexed in (False, True):
+            if indexed:
+                tagindex.register(Book)
+            self.assertEqual(self.titles('scifi,classic'), ['Dune'])
+            self.assertEqual(self.titles('scifi|romance'),
+                             ['Dune', 'Emma', 'Ubik'])
+            self.assertEqual(self.titles('classic,-scifi'), ['Emma'])
+            self.assertEqual(self.titles('-scifi'), ['Emma', 'Zork'])
+            self.assertEqual(self.titles('-scifi,-classic'), ['Zork'])
+            self.assertEqual(self.titles('-nonexistent'),
+                             ['Dune', 'Emma', 'Ubik', 'Zork'])
+
+#############################################################################
+#
+class PrefetchTagsTest(TestCase):
+
+    def setUp(self):
+        Book.objects.create(title = 'Dune').tags = 'scifi classic'
+        Book.objects.create(title = 'Emma').tags = 'romance classic'
+        Book.objects.create(title = 'Ubik').tags = 'scifi'
+        Book.objects.create(title = 'Zork')
+        Publisher.objects.create(name = 'Gollancz').labels = 'scifi'
+        ContentType.objects.clear_cache()
+
+    def test_prefetch(self):
+        books = list(Book.objects.order_by('title'))
+        with self.assertNumQueries(2):
+            astagging.prefetch_tags(books, 'tags')
+        with self.assertNumQueries(0):
+            self.assertEqual([[x.name for x in astagging.tags_for_object(
+                                   book, 'tags')['tags']] for book in books],
+                             [['classic', 'scifi'], ['classic', 'romance'],
+                              ['scifi'], []])
+
+    def test_mixed_models(self):
+        objects = list(Book.objects.filter(title = 'Dune')) + \
+                  list(Publisher.objects.all())
+        with self.assertNumQueries(3):
+            astagging.prefetch_tags(objects, 'tags')
+        self.assertEqual([[x.name for x in getattr(obj,
+                             astagging.prefetched_attr('tags'))] \
+                          for obj in objects],
+                         [['classic', 'scifi'], ['scifi']])
+
+    def test_render(self):
+        books = list(Book.objects.order_by('title'))
+        loop = ("{% for book in books %}"
+                "{% tags_for_object book 'tags' %}"
+                "{% endfor %}")
+        context = Context({ 'books' : books })
+        with self.assertNumQueries(2):
+            html = Template("{% load astagging %}"
+                            "{% prefetch_object_tags books 'tags' %}" +
+                            loop).render(context)
+        self.assertEqual(html.count('class="del_tag"'), 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(Template("{% load astagging %}" + loop) \
+                             .render(context), html)
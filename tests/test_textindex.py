@@ -0,0 +1,97 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.textindex
+"""
+
+from __future__ import absolute_import
+
+# Django imports
+#
+from django.test import TestCase
+from django.db import models
+
+# asutils imports
+#
+from asutils import filterfields
+from asutils import textindex
+from asutils.textindex.models import TextIndexPosting
+
+# Test imports
+#
+from tests.models import Book
+from tests.test_filterfields import FakeRequest
+
+#############################################################################
+#
+class TextIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = textindex.register(Book, ('title',))
+
+    def tearDown(self):
+        textindex.unregister(Book)
+
+    def search(self, query):
+        return sorted(Book.objects.filter(pk__in = self.index.search(query)) \
+                                  .values_list('title', flat = True))
+
+    def test_search(self):
+        Book.objects.create(title = 'Cheese on Toast')
+        Book.objects.create(title = 'Cheese and Wine')
+        self.assertEqual(self.search('cheese'),
+                         ['Cheese and Wine', 'Cheese on Toast'])
+        self.assertEqual(self.search('TOAST cheese'), ['Cheese on Toast'])
+        self.assertEqual(self.search('bread'), [])
+
+    def test_update(self):
+        book = Book.objects.create(title = 'Cheese on Toast')
+        book.title = 'Beans on Toast'
+        book.save()
+        self.assertEqual(sorted(TextIndexPosting.objects \
+                                .values_list('token', flat = True)),
+                         ['beans', 'on', 'toast'])
+        book.delete()
+        self.assertEqual(TextIndexPosting.objects.count(), 0)
+
+    def test_too_many_tokens(self):
+        Book.objects.create(title = 'w0 w1 w2')
+        words = ['w%d' % x for x in range(textindex.MAX_SEARCH_TOKENS)]
+        self.assertEqual(self.search(' '.join(words)), [])
+        self.assertEqual(self.search(' '.join(words[:3] * 100)), ['w0 w1 w2'])
+        words = ['w%d' % x for x in range(1200)]
+        self.assertRaises(filterfields.FilterValueError, self.index.search,
+                          ' '.join(words))
+        ff = filterfields.FilterFields(FakeRequest('q=' + '+'.join(words)),
+                                       Book, ('title', 'q'))
+        self.assertRaises(filterfields.FilterValueError, ff.get_query_set)
+
+    def test_concurrent_update(self):
+        # Someone else adds the same posting after we have read the
+        # existing ones but before we insert ours.
+        #
+        book = Book.objects.create(title = 'Toast')
+        book.title = 'Cheese Toast'
+        manager = TextIndexPosting.objects
+        bulk_create = manager.bulk_create
+        def racing_bulk_create(objs):
+            manager.bulk_create = bulk_create
+            TextIndexPosting.objects.create(content_type = \
+                                            self.index.content_type(),
+                                            token = 'cheese',
+                                            object_id = book.pk)
+            return bulk_create(objs)
+        manager.bulk_create = racing_bulk_create
+        try:
+            book.save()
+        finally:
+            manager.bulk_create = bulk_create
+        self.assertEqual(self.search('cheese toast'), ['Cheese Toast'])
+
+    def test_integer_pk_only(self):
+        class Keyed(models.Model):
+            key = models.CharField(max_length = 8, primary_key = True)
+            class Meta:
+                app_label = 'tests'
+        self.assertRaises(ValueError, textindex.register, Keyed, ('key',))
@@ -0,0 +1,174 @@
+#
+# File: $Id$
+#
+"""
+Tests for asutils.zipstream
+"""
+
+from __future__ import absolute_import
+
+# System imports
+#
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+# Django imports
+#
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+# asutils imports
+#
+from asutils import sendfile
+from asutils import zipstream
+
+FILES = {
+    'empty.txt' : '',
+    'small.txt' : 'hello, world\n',
+    'text.txt' : 'all work and no play makes jack a dull boy\n' * 5000,
+    'binary.bin' : ''.join([chr(x % 251) for x in range(200000)]),
+    }
+
+#############################################################################
+#
+class ZipStreamTest(TestCase):
+    """
+    The archives we make have to be ones zipfile can read back.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.members = []
+        for name in sorted(FILES):
+            filename = os.path.join(self.dir, name)
+            f = open(filename, 'wb')
+            f.write(FILES[name])
+            f.close()
+            self.members.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_archive(self, data):
+        archive = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(sorted(archive.namelist()), sorted(FILES))
+        for name in FILES:
+            self.assertTrue(archive.read(name) == FILES[name])
+        return archive
+
+    def test_deflated(self):
+        stream = zipstream.ZipStream(self.members, blksize = 4096)
+        self.assertEqual(stream.length(), None)
+        archive = self.check_archive(''.join(stream))
+        for info in archive.infolist():
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_stored(self):
+        stream = zipstream.ZipStream(self.members, zipfile.ZIP_STORED,
+                                     blksize = 4096)
+        length = stream.length()
+        data = ''.join(stream)
+        self.assertEqual(len(data), length)
+        archive = self.check_archive(data)
+        for info in archive.infolist():
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+    def test_arcnames(self):
+        members = [(self.members[0], u'dir/caf\xe9.bin')] + self.members[1:]
+        archive = zipfile.ZipFile(StringIO(''.join(
+            zipstream.ZipStream(members))))
+        self.assertEqual(archive.testzip(), None)
+        self.assertTrue(u'dir/caf\xe9.bin' in archive.namelist())
+
+    def test_pool(self):
+        pool = ThreadPool(2)
+        try:
+            stream = zipstream.ZipStream(self.members, pool = pool, ahead = 2,
+                                         max_pooled_size = 100000)
+            self.check_archive(''.join(stream))
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_send_zipfile(self):
+        response = sendfile.send_zipfile(RequestFactory().get('/'),
+                                         self.members, 'files.zip',
+                                         zipfile.ZIP_STORED)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        data = ''.join([str(x) for x in response])
+        self.assertEqual(int(response['Content-Length']), len(data))
+        self.check_archive(data)
+
+    def test_zip64_members(self):
+        # Members too big for 32 bit sizes get a ZIP64 extra field in their
+        # local header and 64 bit sizes in their data descriptor. Pretend
+        # ours are that big.
+        #
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            stream = zipstream.ZipStream(self.members, compression)
+            for member in stream.members:
+                member.zip64 = True
+            length = stream.length()
+            data = ''.join(stream)
+            if length is not None:
+                self.assertEqual(len(data), length)
+            archive = self.check_archive(data)
+            for info in archive.infolist():
+                self.assertEqual(info.create_version, 45)
+            self.assertEqual(struct.unpack('<HLL', data[4:6] + data[18:26]),
+                             (45, 0xffffffff, 0xffffffff))
+
+#############################################################################
+#
+class Zip64LimitTest(TestCase):
+    """
+    0xffffffff in a 32 bit field means 'see the ZIP64 extra field' so a
+    size or offset of exactly that much has to use ZIP64. We can not make
+    4GB files here so we fake the sizes.
+    """
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.member = zipstream.ZipMember(self.filename, 'big.bin',
+                                          zipfile.ZIP_STORED)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def extra(self, entry):
+        name_len, extra_len = struct.unpack('<HH', entry[28:32])
+        return entry[46 + name_len:46 + name_len + extra_len]
+
+    def test_below_limit(self):
+        self.member.file_size = self.member.compress_size = \
+            zipstream.ZIP64_LIMIT - 1
+        self.member.offset = zipstream.ZIP64_LIMIT - 1
+        self.assertEqual(self.extra(self.member.central_dir_entry()), '')
+
+    def test_at_limit(self):
+        self.member.file_size = self.member.compress_size = \
+            zipstream.ZIP64_LIMIT
+        self.member.offset = zipstream.ZIP64_LIMIT
+        entry = self.member.central_dir_entry()
+        self.assertEqual(struct.unpack('<LLL', entry[20:28] + entry[42:46]),
+                         (0xffffffff, 0xffffffff, 0xffffffff))
+        self.assertEqual(struct.unpack('<HHQQQ', self.extra(entry)),
+                         (zipstream.ZIP64_EXTRA_ID, 24,
+                          zipstream.ZIP64_LIMIT, zipstream.ZIP64_LIMIT,
+                          zipstream.ZIP64_LIMIT))
+
+    def test_end_records(self):
+        stream = zipstream.ZipStream([])
+        self.assertEqual(len(stream.end_records(zipstream.ZIP64_LIMIT - 1,
+                                                100)), 22)
+        records = stream.end_records(zipstream.ZIP64_LIMIT, 100)
+        self.assertEqual(struct.unpack('<L', records[:4])[0],
+                         zipstream.ZIP64_END_OF_CENTRAL_DIR_SIG)
+        self.assertEqual(len(records), 56 + 20 + 22)
@@ -0,0 +1,17 @@
+#
+# File: $Id$
+#
+"""
+The test runner in the versions of django asutils supports looks for an
+app's tests in its 'tests' module, so we pull them all in to here.
+"""
+
+from __future__ import absolute_import
+
+from tests.test_filterfields import *
+from tests.test_querycache import *
+from tests.test_sendfile import *
+from tests.test_sortheaders import *
+from tests.test_tagging import *
+from tests.test_textindex import *
+from tests.test_zipstream import *
@@ -0,0 +1,23 @@
+#
+# File: $Id$
+#
+"""
+URLs for the asutils tests that go through a WSGI handler.
+"""
+
+# Django imports
+#
+from django.conf.urls import patterns, url
+
+# asutils imports
+#
+from asutils import sendfile
+
+#############################################################################
+#
+def send(request):
+    return sendfile.send_file(request, request.GET['path'])
+
+urlpatterns = patterns('',
+    url(r'^send/$', send),
+    )